@@ -1,3 +1,12 @@
 from .defs import ChatCompletionLimiter  # type: ignore
 from .defs import DalleLimiter  # type: ignore
 from .defs import TextCompletionLimiter  # type: ignore
+from .tokens import TokenCountCache  # type: ignore
+from .tokens import token_cache  # type: ignore
+from .tokens import prewarm_encoders  # type: ignore
+from .client import RateLimitedOpenAI  # type: ignore
+from .limits import Window  # type: ignore
+from .limits import Tenant  # type: ignore
+from .limits import APIKey  # type: ignore
+from .pool import KeyPool  # type: ignore
+from .limits import RateLimitTimeout  # type: ignore
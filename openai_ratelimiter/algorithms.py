@@ -0,0 +1,631 @@
+import math
+import random
+from typing import Any, List, NamedTuple, Optional, Tuple
+
+from .headers import Observation
+from .usage import Usage
+
+# Algorithms understood by the limiters, mapped to the suffix of their keys so
+# that switching algorithms never reads state written by another one.
+ALGORITHMS = {
+    "fixed": "",
+    "sliding": "_sliding",
+    "gcra": "_gcra",
+}
+
+# The limits of a window of the budget: its max calls and max tokens, None for no
+# limit, and its period in seconds.
+WindowLimits = Tuple[Optional[int], Optional[int], float]
+# The weight, min calls and min tokens of a tenant of the budget.
+TenantLimits = Tuple[float, int, int]
+# (window deadline, window usage)
+FixedWindow = Tuple[float, float]
+# (window start, current window usage, previous window usage)
+SlidingWindow = Tuple[float, float, float]
+
+
+def check_algorithm(algorithm: str) -> str:
+    """
+    Validates the name of a rate limiting algorithm.
+
+    Args:
+        algorithm (str): One of "fixed", "sliding" or "gcra".
+
+    Returns:
+        str: The algorithm name.
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(
+            f"Unknown algorithm {algorithm!r}, expected one of {', '.join(ALGORITHMS)}."
+        )
+    return algorithm
+
+
+def backoff(wait: float, jitter: float = 0.0) -> float:
+    """
+    Adds a random jitter to a wait time so that rejected callers do not all retry
+    at the same instant.
+
+    Args:
+        wait (float): The time until the request fits in seconds.
+        jitter (float): The maximum extra delay in seconds.
+
+    Returns:
+        float: The time to sleep in seconds.
+    """
+    if jitter > 0:
+        return wait + random.uniform(0, jitter)
+    return wait
+
+
+def headroom(max_calls: int, max_tokens: int, calls: float, tokens: float) -> float:
+    """
+    Returns the part of a budget left once `calls` and `tokens` are used, the
+    smaller of the parts of the calls and tokens budgets.
+    """
+    return min((max_calls - calls) / max_calls, (max_tokens - tokens) / max_tokens)
+
+
+def fixed_window(
+    window: Optional[FixedWindow],
+    now: float,
+    period: float,
+    limit: int,
+    cost: int,
+) -> Tuple[float, float, FixedWindow]:
+    """
+    Fixed window counter, the in-memory twin of the Redis fixed window script.
+
+    Args:
+        window (FixedWindow | None): The stored window, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The length of the window in seconds.
+        limit (int): The budget of the window.
+        cost (int): The amount to reserve.
+
+    Returns:
+        Tuple[float, float, FixedWindow]: The seconds to wait before the cost fits
+        (0 if it fits now), the usage before the reservation and the window to store
+        if the reservation is committed.
+    """
+    if window is None or window[0] <= now:
+        window = (now + period, 0)  # the window starts with the first reservation
+    deadline, used = window
+    wait = 0.0
+    if used + cost > limit:
+        wait = deadline - now if used else period
+    return wait, used, (deadline, used + cost)
+
+
+def sliding_window(
+    window: Optional[SlidingWindow],
+    now: float,
+    period: float,
+    limit: int,
+    cost: int,
+) -> Tuple[float, float, SlidingWindow]:
+    """
+    Sliding window counter, the in-memory twin of the Redis sliding window script.
+
+    Args:
+        window (SlidingWindow | None): The stored window, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The length of the window in seconds.
+        limit (int): The budget of the window.
+        cost (int): The amount to reserve.
+
+    Returns:
+        Tuple[float, float, SlidingWindow]: The seconds to wait before the cost fits
+        (0 if it fits now), the usage before the reservation and the window to store
+        if the reservation is committed.
+    """
+    start, current, previous = window or (now, 0, 0)
+    elapsed = math.floor((now - start) / period)
+    if elapsed == 1:
+        previous, current = current, 0
+    elif elapsed > 1:
+        previous, current = 0, 0
+    start += elapsed * period
+    remaining = period - (now - start)
+    used = previous * remaining / period + current
+    wait = 0.0
+    excess = used + cost - limit
+    if excess > 0:
+        if cost > limit:
+            wait = period
+        elif previous > 0 and excess <= previous * remaining / period:
+            wait = excess * period / previous
+        elif current + cost <= limit:
+            wait = remaining
+        else:
+            wait = remaining + (current + cost - limit) * period / current
+    return wait, used, (start, current + cost, previous)
+
+
+def gcra(
+    tat: Optional[float],
+    now: float,
+    period: float,
+    limit: int,
+    cost: int,
+) -> Tuple[float, float, float]:
+    """
+    Generic cell rate algorithm, the in-memory twin of the Redis GCRA script.
+
+    Args:
+        tat (float | None): The stored theoretical arrival time, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The period the limit applies to in seconds.
+        limit (int): The budget of one period.
+        cost (int): The amount to reserve.
+
+    Returns:
+        Tuple[float, float, float]: The seconds to wait before the cost fits (0 if it
+        fits now), the usage before the reservation and the theoretical arrival time
+        to store if the reservation is committed.
+    """
+    tat = max(tat or now, now)
+    new_tat = tat + cost * period / limit
+    wait = max(new_tat - period - now, 0.0)
+    return wait, (tat - now) * limit / period, new_tat
+
+
+def fixed_window_refund(
+    window: FixedWindow, now: float, period: float, limit: int, amount: int
+) -> FixedWindow:
+    deadline, used = window
+    return deadline, max(used - amount, 0)
+
+
+def sliding_window_refund(
+    window: SlidingWindow, now: float, period: float, limit: int, amount: int
+) -> SlidingWindow:
+    start, current, previous = window
+    return start, max(current - amount, 0), previous
+
+
+def gcra_refund(
+    tat: float, now: float, period: float, limit: int, amount: int
+) -> float:
+    return max(tat - amount * period / limit, now)
+
+
+def fixed_window_observe(
+    window: Optional[FixedWindow],
+    now: float,
+    period: float,
+    limit: int,
+    used: int,
+    reset: float,
+) -> FixedWindow:
+    if used <= 0 or reset == 0:
+        return now, 0  # Over, the next reservation starts a new window
+    if reset < 0:
+        # Unknown, the usage fills the current window.
+        if window is None or window[0] <= now:
+            return now + period, used
+        return window[0], used
+    return now + reset, used
+
+
+def sliding_window_observe(
+    window: Optional[SlidingWindow],
+    now: float,
+    period: float,
+    limit: int,
+    used: int,
+    reset: float,
+) -> SlidingWindow:
+    if used <= 0:
+        return now, 0, 0
+    if reset < 0:
+        # Unknown, the usage fills the current window.
+        reset = period
+        if window is not None and window[0] + period > now:
+            reset = window[0] + period - now
+    reset = min(reset, period)
+    return now + reset - period, used, 0
+
+
+def gcra_observe(
+    tat: Optional[float],
+    now: float,
+    period: float,
+    limit: int,
+    used: int,
+    reset: float,
+) -> float:
+    if used <= 0:
+        return now
+    tat = now + used * period / limit
+    if used >= limit:
+        tat += max(reset, 0.0)
+    return tat
+
+
+def reservation_deadline(algorithm: str, state: Any, period: float) -> float:
+    """
+    Returns the time until which a reservation stored in the state can be refunded.
+
+    Args:
+        algorithm (str): The algorithm that produced the state.
+        state (FixedWindow | SlidingWindow | float): The state after the reservation.
+        period (float): The period the limit applies to in seconds.
+
+    Returns:
+        float: The end of the window holding the reservation.
+    """
+    if algorithm == "fixed":
+        return state[0]
+    if algorithm == "sliding":
+        return state[0] + period
+    return state
+
+
+def state_expiry(algorithm: str, state: Any, period: float) -> float:
+    """
+    Returns the time after which the state no longer limits anything, when it can
+    be dropped.
+
+    Args:
+        algorithm (str): The algorithm that produced the state.
+        state (FixedWindow | SlidingWindow | float): The stored state.
+        period (float): The period the limit applies to in seconds.
+
+    Returns:
+        float: The time the state expires.
+    """
+    if algorithm == "sliding":
+        # The previous window still weighs on the next one.
+        return state[0] + 2 * period
+    return reservation_deadline(algorithm, state, period)
+
+
+# The in-memory implementation of each algorithm.
+ALGORITHM_FUNCTIONS = {
+    "fixed": fixed_window,
+    "sliding": sliding_window,
+    "gcra": gcra,
+}
+
+# Credits an amount back to the state of each algorithm, the in-memory twins of
+# the Redis refund scripts.
+REFUND_FUNCTIONS = {
+    "fixed": fixed_window_refund,
+    "sliding": sliding_window_refund,
+    "gcra": gcra_refund,
+}
+
+# Replaces the state of each algorithm with the usage reported by the API, the
+# in-memory twins of the Redis observe scripts.
+OBSERVE_FUNCTIONS = {
+    "fixed": fixed_window_observe,
+    "sliding": sliding_window_observe,
+    "gcra": gcra_observe,
+}
+
+
+def reserve_windows(
+    algorithm: str,
+    states: List[Tuple[Any, Any]],
+    now: float,
+    windows: List[WindowLimits],
+    calls: int,
+    tokens: int,
+) -> Tuple[float, List[Tuple[Any, Any]]]:
+    """
+    Checks a reservation against the calls and tokens counters of extra windows of
+    the budget, such as its daily limits.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        states (List[Tuple[Any, Any]]): The stored calls and tokens states of each window.
+        now (float): The current time in seconds.
+        windows (List[WindowLimits]): The limits of each window.
+        calls (int): The calls to reserve.
+        tokens (int): The tokens to reserve.
+
+    Returns:
+        Tuple[float, List[Tuple[Any, Any]]]: The seconds to wait before the reservation
+        fits in every window (0 if it fits now) and the states to store if it is committed.
+    """
+    function = ALGORITHM_FUNCTIONS[algorithm]
+    wait = 0.0
+    reserved = []
+    for (calls_state, tokens_state), (max_calls, max_tokens, period) in zip(
+        states, windows
+    ):
+        if max_calls is not None:
+            calls_wait, _, calls_state = function(
+                calls_state, now, period, max_calls, calls
+            )
+            wait = max(wait, calls_wait)
+        if max_tokens is not None:
+            tokens_wait, _, tokens_state = function(
+                tokens_state, now, period, max_tokens, tokens
+            )
+            wait = max(wait, tokens_wait)
+        reserved.append((calls_state, tokens_state))
+    return wait, reserved
+
+
+def refund_windows(
+    algorithm: str,
+    states: List[Tuple[Any, Any]],
+    now: float,
+    windows: List[WindowLimits],
+    calls: int,
+    tokens: int,
+) -> List[Tuple[Any, Any]]:
+    """
+    Credits calls and tokens back to the counters of extra windows of the budget.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        states (List[Tuple[Any, Any]]): The stored calls and tokens states of each window.
+        now (float): The current time in seconds.
+        windows (List[WindowLimits]): The limits of each window.
+        calls (int): The calls to give back.
+        tokens (int): The tokens to give back.
+
+    Returns:
+        List[Tuple[Any, Any]]: The states to store.
+    """
+    refund = REFUND_FUNCTIONS[algorithm]
+    refunded = []
+    for (calls_state, tokens_state), (max_calls, max_tokens, period) in zip(
+        states, windows
+    ):
+        if calls > 0 and max_calls is not None and calls_state is not None:
+            calls_state = refund(calls_state, now, period, max_calls, calls)
+        if tokens > 0 and max_tokens is not None and tokens_state is not None:
+            tokens_state = refund(tokens_state, now, period, max_tokens, tokens)
+        refunded.append((calls_state, tokens_state))
+    return refunded
+
+
+class Shares(NamedTuple):
+    """
+    The shares of the budget a reservation is checked against: the part of the
+    budget its priority may fill and the share of its tenant.
+    """
+
+    # The part of the budget the priority of the request may fill, 1 for all of it.
+    share: float
+    # The index of the tenant of the request, None for no tenant.
+    tenant: Optional[int]
+    # The limits of every tenant, and their stored calls and tokens states.
+    tenants: List[TenantLimits]
+    states: List[Tuple[Any, Any]]
+
+
+def reserve_shares(
+    algorithm: str,
+    shares: Shares,
+    states: Tuple[Any, Any],
+    now: float,
+    period: float,
+    limits: Tuple[int, int],
+    calls: int,
+    tokens: int,
+) -> Tuple[float, float, Optional[Tuple[Any, Any]]]:
+    """
+    Checks a reservation against the shares of the budget, the in-memory twin of
+    the shares check of the Redis admission scripts. The reservation must leave
+    free the part of the budget above the share of its priority and the unused
+    minimums of the other tenants. Its tenant may use its minimum, or its weighted
+    part of the budget among the tenants using it, whichever is larger.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        shares (Shares): The shares of the budget.
+        states (Tuple[Any, Any]): The stored calls and tokens states of the budget.
+        now (float): The current time in seconds.
+        period (float): The period the limits apply to in seconds.
+        limits (Tuple[int, int]): The call and token budgets of the period.
+        calls (int): The calls to reserve.
+        tokens (int): The tokens to reserve.
+
+    Returns:
+        Tuple[float, float, Optional[Tuple[Any, Any]]]: The seconds to wait before the
+        reservation fits in the shares of the budget, the seconds to wait before it
+        fits in the share of its tenant (0 if it fits now), and the calls and tokens
+        states of the tenant to store if it is committed, None without a tenant.
+    """
+    function = ALGORITHM_FUNCTIONS[algorithm]
+    costs = (calls, tokens)
+    used = [
+        [
+            function(state, now, period, limit, 0)[1]
+            for state, limit in zip(pair, limits)
+        ]
+        for pair in shares.states
+    ]
+    # The weights of the tenants using the budget, the tenant of the request included.
+    weight = sum(
+        tenant[0]
+        for i, tenant in enumerate(shares.tenants)
+        if i == shares.tenant or any(used[i])
+    )
+    wait = tenant_wait = 0.0
+    reserved = []
+    for j, limit in enumerate(limits):
+        padding = limit * (1 - shares.share)
+        for i, tenant in enumerate(shares.tenants):
+            if i != shares.tenant:
+                padding += max(tenant[j + 1] - used[i][j], 0)
+        if padding > 0:
+            wait = max(
+                wait, function(states[j], now, period, limit, costs[j] + padding)[0]
+            )
+        if shares.tenant is not None:
+            tenant = shares.tenants[shares.tenant]
+            state = shares.states[shares.tenant][j]
+            cap = max(tenant[j + 1], limit * tenant[0] / weight)
+            if cap < limit:
+                tenant_wait = max(
+                    tenant_wait,
+                    function(state, now, period, limit, costs[j] + limit - cap)[0],
+                )
+            reserved.append(function(state, now, period, limit, costs[j])[2])
+    return wait, tenant_wait, (reserved[0], reserved[1]) if reserved else None
+
+
+def admit_batch(
+    algorithm: str,
+    calls: Any,
+    tokens: Any,
+    now: float,
+    period: float,
+    max_calls: int,
+    max_tokens: int,
+    costs: List[int],
+    states: Optional[List[Tuple[Any, Any]]] = None,
+    windows: Optional[List[WindowLimits]] = None,
+    shares: Optional[Shares] = None,
+) -> Tuple[int, float, Any, Any, List[Tuple[Any, Any]], Optional[Tuple[Any, Any]]]:
+    """
+    Admits the longest prefix of a batch of requests that fits in the budget, the
+    in-memory twin of the Redis batch admission script.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        calls (Any): The stored calls state, None if there is none yet.
+        tokens (Any): The stored tokens state, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The period the limits apply to in seconds.
+        max_calls (int): The call budget of the period.
+        max_tokens (int): The token budget of the period.
+        costs (List[int]): The tokens of each request, in order.
+        states (List[Tuple[Any, Any]] | None): The states of the extra windows.
+        windows (List[WindowLimits] | None): The limits of the extra windows.
+        shares (Shares | None): The shares of the budget the batch is checked against.
+
+    Returns:
+        Tuple[int, float, Any, Any, List[Tuple[Any, Any]], Optional[Tuple[Any, Any]]]:
+        The number of admitted requests, the seconds to wait before the next one fits
+        (0 if all were admitted), and the calls, tokens, extra windows and tenant
+        states to store.
+    """
+    function = ALGORITHM_FUNCTIONS[algorithm]
+    states, windows = states or [], windows or []
+    admitted, reserved, wait = 0, 0, 0.0
+    calls_state, tokens_state, extra_states = calls, tokens, states
+    tenant_state = None
+    for cost in costs:
+        calls_wait, _, next_calls = function(
+            calls, now, period, max_calls, admitted + 1
+        )
+        tokens_wait, _, next_tokens = function(
+            tokens, now, period, max_tokens, reserved + cost
+        )
+        extra_wait, next_extra = reserve_windows(
+            algorithm, states, now, windows, admitted + 1, reserved + cost
+        )
+        shares_wait = tenant_wait = 0.0
+        next_tenant = None
+        if shares is not None:
+            shares_wait, tenant_wait, next_tenant = reserve_shares(
+                algorithm,
+                shares,
+                (calls, tokens),
+                now,
+                period,
+                (max_calls, max_tokens),
+                admitted + 1,
+                reserved + cost,
+            )
+        wait = max(calls_wait, tokens_wait, extra_wait, shares_wait, tenant_wait)
+        if wait > 0:
+            break
+        admitted, reserved = admitted + 1, reserved + cost
+        calls_state, tokens_state, extra_states = next_calls, next_tokens, next_extra
+        tenant_state = next_tenant
+    return admitted, wait, calls_state, tokens_state, extra_states, tenant_state
+
+
+def snapshot(
+    algorithm: str,
+    calls: Any,
+    tokens: Any,
+    now: float,
+    period: float,
+    max_calls: int,
+    max_tokens: int,
+) -> Usage:
+    """
+    Returns the usage of the budget, the in-memory twin of the Redis usage script.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        calls (Any): The stored calls state, None if there is none yet.
+        tokens (Any): The stored tokens state, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The period the limits apply to in seconds.
+        max_calls (int): The call budget of the period.
+        max_tokens (int): The token budget of the period.
+
+    Returns:
+        Usage: The snapshot of the budget.
+    """
+    function = ALGORITHM_FUNCTIONS[algorithm]
+    # The wait before the whole budget fits is the time until the usage resets.
+    calls_reset, used_calls, _ = function(calls, now, period, max_calls, max_calls)
+    tokens_reset, used_tokens, _ = function(tokens, now, period, max_tokens, max_tokens)
+    return Usage(
+        round(used_calls),
+        round(used_tokens),
+        max(max_calls - round(used_calls), 0),
+        max(max_tokens - round(used_tokens), 0),
+        max(calls_reset, tokens_reset),
+    )
+
+
+def observe_states(
+    algorithm: str,
+    calls: Any,
+    tokens: Any,
+    now: float,
+    period: float,
+    max_calls: int,
+    max_tokens: int,
+    observation: Observation,
+) -> Tuple[Any, Any]:
+    """
+    Replaces the states with the usage reported by the API, the in-memory twin of
+    the Redis observe script. A state the API reports nothing about is kept, and
+    an unknown reset (-1) keeps the current window.
+
+    Args:
+        algorithm (str): The algorithm of the states.
+        calls (Any): The stored calls state, None if there is none yet.
+        tokens (Any): The stored tokens state, None if there is none yet.
+        now (float): The current time in seconds.
+        period (float): The period the limits apply to in seconds.
+        max_calls (int): The call budget of the period.
+        max_tokens (int): The token budget of the period.
+        observation (Observation): The usage reported by the API.
+
+    Returns:
+        Tuple[Any, Any]: The calls and tokens states to store, an empty state
+        replacing a missing one.
+    """
+    function = OBSERVE_FUNCTIONS[algorithm]
+    if observation.calls is not None and max_calls > 0:
+        calls = function(
+            calls, now, period, max_calls, observation.calls, observation.calls_reset
+        )
+    elif calls is None:
+        calls = function(None, now, period, max_calls, 0, 0.0)
+    if observation.tokens is not None and max_tokens > 0:
+        tokens = function(
+            tokens,
+            now,
+            period,
+            max_tokens,
+            observation.tokens,
+            observation.tokens_reset,
+        )
+    elif tokens is None:
+        tokens = function(None, now, period, max_tokens, 0, 0.0)
+    return calls, tokens
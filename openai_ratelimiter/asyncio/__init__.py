@@ -1,3 +1,6 @@
 from .defs import AsyncChatCompletionLimiter  # type: ignore
 from .defs import AsyncDalleLimiter  # type: ignore
 from .defs import AsyncTextCompletionLimiter  # type: ignore
+from .manager import LimiterManager  # type: ignore
+from .pool import AsyncKeyPool  # type: ignore
+from .client import AsyncRateLimitedOpenAI  # type: ignore
@@ -1,16 +1,92 @@
 import asyncio
+import heapq
+import itertools
+import random
+import time
 import types
-from typing import Dict, Optional, Type, Union
+import uuid
+import weakref
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
 
-import redis.asyncio as redis
-import tiktoken
-from redis.asyncio.lock import Lock
+from ..algorithms import (
+    ALGORITHM_FUNCTIONS,
+    REFUND_FUNCTIONS,
+    WindowLimits,
+    admit_batch,
+    backoff,
+    Shares,
+    check_algorithm,
+    observe_states,
+    refund_windows,
+    reservation_deadline,
+    reserve_shares,
+    reserve_windows,
+    snapshot,
+    state_expiry,
+)
+from ..headers import Observation, observe
+from ..keys import (
+    check_shard_fit,
+    check_shards,
+    in_flight_key,
+    limiter_keys,
+    model_keys,
+    scan_patterns,
+    shard_limit,
+)
+from ..lease import QuotaLease
+from ..limits import (
+    RateLimitTimeout,
+    Tenant,
+    Window,
+    check_limits,
+    check_scheduler,
+    check_shares,
+    check_timeout,
+    in_flight_poll,
+    in_flight_timeout,
+    priority_share,
+    sjf_aging,
+    tenant_index,
+    timeout_deadline,
+    window_args,
+)
+from ..base import BatchAdmission
+from ..scripts import (
+    ADMIT_BATCH_SCRIPTS,
+    ADMIT_SCRIPTS,
+    OBSERVE_SCRIPTS,
+    REFUND_SCRIPTS,
+    USAGE_SCRIPTS,
+    get_script,
+)
+from ..tokens import get_encoder
+from ..usage import Usage, Utilization, usage_tokens, utilization
+
+if TYPE_CHECKING:
+    import redis.asyncio as redis
+    from tiktoken.core import Encoding
 
 # Tokenizer
 
 
 period = 60
 
+# The background tasks giving back the reservations of cancelled callers.
+_undos: "Set[asyncio.Task[None]]" = set()
+
 
 class AsyncRedisLimiter:
     def __init__(
@@ -21,6 +97,18 @@ class AsyncRedisLimiter:
         period: int,
         tokens: int,
         redis: "redis.Redis[bytes]",
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        lease: Optional[QuotaLease] = None,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        priority: int = 0,
+        tenant: Optional[str] = None,
     ):
         self.model_name = model_name
         self.max_calls = max_calls
@@ -28,38 +116,385 @@ class AsyncRedisLimiter:
         self.period = period
         self.tokens = tokens
         self.redis = redis
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.lease = lease
+        self.namespace = namespace
+        self.shards = shards
+        # Requests start on a random shard to spread the load over the shards.
+        self.shard = random.randrange(shards)
+        self.windows = windows
+        self.max_in_flight = max_in_flight
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        self.priorities = priorities
+        self.tenants = tenants
+        self.priority = priority
+        self.tenant = tenant
+        self._priority_share = priority_share(priorities, priority)
+        self._tenant = tenant_index(tenants, tenant)
+        self.used_tokens: Optional[int] = None
+        self._deadline = 0.0
+        self._leased = False
+        # The member of the request in the set of in-flight requests, and whether
+        # it holds a slot there.
+        self._member = uuid.uuid4().hex
+        self._in_flight = False
 
-    async def __aenter__(self):
-        lock = Lock(self.redis, f"{self.model_name}_lock", timeout=self.period)
+    def _keys(self) -> List[str]:
+        shard = self.shard if self.shards > 1 else None
+        return limiter_keys(self.model_name, self.algorithm, self.namespace, shard)
+
+    def _window_keys(self) -> List[str]:
+        """Returns the calls and tokens keys of every window, the main one first."""
+        shard = self.shard if self.shards > 1 else None
+        keys = self._keys()
+        for window in self.windows:
+            keys += limiter_keys(
+                self.model_name, self.algorithm, self.namespace, shard, window.period
+            )
+        return keys
+
+    def _tenant_keys(self, tenants: Sequence[Tenant]) -> List[str]:
+        """Returns the calls and tokens keys of the tenants."""
+        shard = self.shard if self.shards > 1 else None
+        keys = []
+        for tenant in tenants:
+            keys += limiter_keys(
+                self.model_name,
+                self.algorithm,
+                self.namespace,
+                shard,
+                tenant=tenant.name,
+            )
+        return keys
+
+    def _in_flight_key(self) -> str:
+        shard = self.shard if self.shards > 1 else None
+        return in_flight_key(self.model_name, self.namespace, shard)
+
+    def _admit_keys(self) -> List[str]:
+        keys = self._window_keys() + self._tenant_keys(self.tenants)
+        if self.max_in_flight is not None:
+            keys.append(self._in_flight_key())
+        return keys
+
+    def _share(self, limit: Optional[int]) -> Optional[int]:
+        """Returns the part of a limit held by the current shard."""
+        if limit is None or self.shards == 1:
+            return limit
+        return shard_limit(limit, self.shards, self.shard)
+
+    def _limits(self) -> Tuple[int, int]:
+        """Returns the calls and tokens budget of the current shard."""
+        if self.shards == 1:
+            return self.max_calls, self.max_tokens
+        return (
+            shard_limit(self.max_calls, self.shards, self.shard),
+            shard_limit(self.max_tokens, self.shards, self.shard),
+        )
+
+    def _window_args(self) -> List[float]:
+        """Returns the windows of the current shard for the scripts, the main one first."""
+        args = window_args(*self._limits(), self.period)
+        for window in self.windows:
+            args += window_args(
+                self._share(window.calls), self._share(window.tokens), window.period
+            )
+        return args
+
+    def _share_args(self) -> List[float]:
+        """Returns the shares of the budget of the current shard for the scripts."""
+        args = [
+            self._priority_share,
+            0 if self._tenant is None else self._tenant + 1,
+            len(self.tenants),
+        ]
+        for tenant in self.tenants:
+            args += [
+                tenant.weight,
+                self._share(tenant.min_calls),
+                self._share(tenant.min_tokens),
+            ]
+        return args
+
+    def _in_flight_args(self, member: str) -> List[Any]:
+        limit = self._share(self.max_in_flight)
+        return [
+            -1 if limit is None else limit,
+            member,
+            int(in_flight_timeout * 1000),
+            int(in_flight_poll * 1000),
+        ]
 
-        async with lock:
-            while True:
-                self.current_calls = await self.redis.incr(
-                    f"{self.model_name}_api_calls", amount=1
+    def _shard_order(self) -> List[int]:
+        """Returns the shards to try, starting with the current one."""
+        return [(self.shard + i) % self.shards for i in range(self.shards)]
+
+    async def _admit(
+        self, dry_run: bool = False, calls: int = 1, tokens: Optional[int] = None
+    ) -> int:
+        """
+        Runs the admission script of the algorithm once, or once per shard of a
+        sharded budget until a shard admits the request.
+
+        Args:
+            dry_run (bool): Only check the budget without reserving it.
+            calls (int): The number of calls to reserve.
+            tokens (int | None): The number of tokens to reserve, defaults to the request's.
+
+        Returns:
+            int: The milliseconds to wait before the request fits, 0 if it was admitted.
+        """
+        admit = get_script(self.redis, ADMIT_SCRIPTS[self.algorithm])
+        waits = []
+        for self.shard in self._shard_order():
+            wait_ms = self._admitted(
+                await admit(
+                    keys=self._admit_keys(),
+                    args=self._admit_args(dry_run, calls, tokens),
                 )
-                if self.current_calls == 1:
-                    await self.redis.expire(f"{self.model_name}_api_calls", self.period)
-                if self.current_calls <= self.max_calls:
-                    break
-                else:
-                    await lock.release()  # Release the lock before sleeping
-                    await asyncio.sleep(self.period)  # wait for the limit to reset
-                    await lock.acquire()
-
-            while True:
-                self.current_tokens = await self.redis.incrby(
-                    f"{self.model_name}_api_tokens", self.tokens
+            )
+            if not wait_ms:
+                self._in_flight = not dry_run and self.max_in_flight is not None
+                return 0
+            waits.append(wait_ms)
+        return min(waits)
+
+    def _admit_args(
+        self, dry_run: bool = False, calls: int = 1, tokens: Optional[int] = None
+    ) -> List[Any]:
+        return [
+            self.tokens if tokens is None else tokens,
+            int(dry_run),
+            calls,
+            *self._in_flight_args(self._member),
+            *self._share_args(),
+            *self._window_args(),
+        ]
+
+    def _admitted(self, result: List[int]) -> int:
+        _, wait_ms, self.current_calls, self.current_tokens, window_ms = result
+        if window_ms:
+            self._deadline = time.monotonic() + window_ms / 1000
+        return wait_ms
+
+    async def _admit_batch(
+        self, costs: List[int], whole: bool = False
+    ) -> Tuple[int, float]:
+        """
+        Runs the batch admission script of the algorithm once.
+
+        Args:
+            costs (List[int]): The tokens of each request, in order.
+            whole (bool): Admit all the requests or none of them.
+
+        Returns:
+            Tuple[int, float]: The number of admitted requests and the seconds to wait
+            before the next one fits, 0 if all were admitted.
+        """
+        admit = get_script(self.redis, ADMIT_BATCH_SCRIPTS[self.algorithm])
+        waits = []
+        for self.shard in self._shard_order():
+            admitted, wait_ms, window_ms = await admit(
+                keys=self._admit_keys(),
+                args=[
+                    *self._in_flight_args(self._member),
+                    int(whole),
+                    len(costs),
+                    *costs,
+                    *self._share_args(),
+                    *self._window_args(),
+                ],
+            )
+            if admitted:
+                self._deadline = time.monotonic() + window_ms / 1000
+                self._in_flight = self.max_in_flight is not None
+                return admitted, wait_ms / 1000
+            waits.append(wait_ms)
+        return 0, min(waits) / 1000
+
+    async def _usage(self) -> Usage:
+        """Runs the usage script of the algorithm once per shard."""
+        usage = get_script(self.redis, USAGE_SCRIPTS[self.algorithm])
+        calls = tokens = remaining_calls = remaining_tokens = reset_ms = 0
+        for self.shard in range(self.shards):
+            max_calls, max_tokens = self._limits()
+            shard_calls, shard_tokens, shard_reset_ms = await usage(
+                keys=self._keys(), args=[max_calls, max_tokens, self.period]
+            )
+            calls += shard_calls
+            tokens += shard_tokens
+            remaining_calls += max(max_calls - shard_calls, 0)
+            remaining_tokens += max(max_tokens - shard_tokens, 0)
+            reset_ms = max(reset_ms, shard_reset_ms)
+        return Usage(calls, tokens, remaining_calls, remaining_tokens, reset_ms / 1000)
+
+    async def _utilization(self) -> List[Utilization]:
+        """Runs the usage script of the algorithm on every window, once per shard."""
+        usage = get_script(self.redis, USAGE_SCRIPTS[self.algorithm])
+        windows = [Window(self.period, self.max_calls, self.max_tokens), *self.windows]
+        used = [[0, 0] for _ in windows]
+        for self.shard in range(self.shards):
+            keys, args = self._window_keys(), self._window_args()
+            for i, counters in enumerate(used):
+                max_calls, max_tokens, window_period = args[3 * i : 3 * i + 3]
+                # A counter without a limit is read against a limit of 1 and ignored.
+                calls, tokens, _ = await usage(
+                    keys=keys[2 * i : 2 * i + 2],
+                    args=[max(max_calls, 1), max(max_tokens, 1), window_period],
                 )
-                if self.current_tokens == self.tokens:
-                    await self.redis.expire(
-                        f"{self.model_name}_api_tokens", self.period
-                    )
-                if self.current_tokens <= self.max_tokens:
-                    break
-                else:
-                    await lock.release()  # Release the lock before sleeping
-                    await asyncio.sleep(self.period)  # wait for the limit to reset
-                    await lock.acquire()
+                counters[0] += calls
+                counters[1] += tokens
+        return [
+            utilization(window.period, window.calls, window.tokens, calls, tokens)
+            for window, (calls, tokens) in zip(windows, used)
+        ]
+
+    async def _observe(self, observation: Observation):
+        """
+        Runs the observe script of the algorithm once per shard, each shard taking
+        its part of the reported usage.
+        """
+        observe = get_script(self.redis, OBSERVE_SCRIPTS[self.algorithm])
+        for self.shard in range(self.shards):
+            max_calls, max_tokens = self._limits()
+            share = observation.share(
+                self.max_calls, self.max_tokens, max_calls, max_tokens
+            )
+            await observe(
+                keys=self._keys(),
+                args=[
+                    -1 if share.calls is None else share.calls,
+                    -1 if share.tokens is None else share.tokens,
+                    int(share.calls_reset * 1000),
+                    int(share.tokens_reset * 1000),
+                    max_calls,
+                    max_tokens,
+                    self.period,
+                ],
+            )
+
+    async def _admit_leased(self) -> bool:
+        """
+        Admits the request from the local lease, renewing the lease from Redis when
+        it runs out.
+
+        Returns:
+            bool: True if the request was admitted, False if the shared budget cannot
+            cover a new lease.
+        """
+        assert self.lease is not None
+        self._leased, self._deadline = self.lease.take(self.tokens)
+        if self._leased:
+            return True
+        await self._give_back(*self.lease.drain())
+        calls, tokens = self.lease.size(self.tokens, self.max_calls, self.max_tokens)
+        if await self._admit(calls=calls, tokens=tokens):
+            return False
+        replaced = self.lease.grant(calls, tokens, self._deadline, self.tokens)
+        await self._give_back(*replaced)
+        self._leased = True
+        return True
+
+    async def _give_back(self, calls: int, tokens: int, deadline: float):
+        if (calls > 0 or tokens > 0) and time.monotonic() < deadline:
+            refund = get_script(self.redis, REFUND_SCRIPTS[self.algorithm])
+            keys, args = self._window_keys(), self._window_args()
+            if self._tenant is not None:
+                # The counters of the tenant are refunded as one more window.
+                keys += self._tenant_keys([self.tenants[self._tenant]])
+                args += window_args(*self._limits(), self.period)
+            await refund(keys=keys, args=[calls, tokens, *args])
+
+    async def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the window it was reserved in. Nothing is
+        credited once that window is over.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        if self._leased:
+            assert self.lease is not None
+            self.lease.give_back(tokens, calls, self._deadline)
+        else:
+            await self._give_back(calls, tokens, self._deadline)
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        self.used_tokens = usage_tokens(usage)
+
+    async def _try_admit(self, leased: bool) -> int:
+        if leased and await self._admit_leased():
+            return 0
+        return await self._admit()
+
+    async def _admit_shielded(self, leased: bool = False) -> int:
+        """
+        Runs an admission that the cancellation of the caller does not interrupt, a
+        reservation made while the caller was being cancelled is given back.
+
+        Args:
+            leased (bool): Try the local lease first.
+
+        Returns:
+            int: The milliseconds to wait before the request fits, 0 if it was admitted.
+        """
+        admission = asyncio.ensure_future(self._try_admit(leased))
+        try:
+            return await asyncio.shield(admission)
+        except asyncio.CancelledError:
+            admission.add_done_callback(self._admission_cancelled)
+            raise
+
+    def _admission_cancelled(self, admission: "asyncio.Future[int]"):
+        if admission.cancelled() or admission.exception() is not None:
+            return
+        if not admission.result():
+            self._undo_later()
+
+    def _undo_later(self):
+        """Gives back the reservation of a cancelled caller in the background."""
+        undo = asyncio.ensure_future(self._undo())
+        # Keep a reference until the reservation is given back.
+        _undos.add(undo)
+        undo.add_done_callback(_undos.discard)
+
+    async def _undo(self):
+        await self.refund(self.tokens, 1)
+        if self._in_flight:
+            self._in_flight = False
+            await self.redis.zrem(self._in_flight_key(), self._member)
+
+    async def __aenter__(self):
+        deadline = timeout_deadline(self.timeout)
+        leased = self.lease is not None
+        while True:
+            wait_ms = await self._admit_shielded(leased)
+            if not wait_ms:
+                break
+            leased = False
+            check_timeout(deadline, wait_ms / 1000)
+            await asyncio.sleep(backoff(wait_ms / 1000, self.jitter))
+        return self
+
+    async def try_acquire(self) -> float:
+        """
+        Reserves the budget if the request fits right now, without waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        return await self._admit_shielded(self.lease is not None) / 1000
 
     async def __aexit__(
         self,
@@ -67,18 +502,49 @@ class AsyncRedisLimiter:
         exc_value: Optional[BaseException],
         traceback: Optional[types.TracebackType],
     ) -> Optional[bool]:
-        pass
+        if self.used_tokens is not None:
+            if self.used_tokens < self.tokens:
+                await self.refund(self.tokens - self.used_tokens)
+        elif exc_type is not None:
+            # The request failed before a response was received.
+            await self.refund(self.tokens)
+        if self._in_flight:
+            self._in_flight = False
+            await self.redis.zrem(self._in_flight_key(), self._member)
 
-    async def clear_locks(self) -> bool:
+    async def release(self):
+        """
+        Releases a reservation taken with `acquire()` instead of the context manager,
+        giving back the tokens that were not used.
+        """
+        await self.__aexit__(None, None, None)
+
+    async def clear_locks(self, scan: bool = False) -> bool:
         """
         This method will clear all locks associated with the model.
         returns True if the locks were cleared successfully, otherwise returns False.
+
+        Args:
+            scan (bool): Also look for keys of the model with an incremental SCAN, such as
+                         keys left by earlier versions.
         """
-        keys_to_delete = await self.redis.keys(f"{self.model_name}_*")
-        if keys_to_delete:
-            await self.redis.delete(*keys_to_delete)
-            return True
-        return False
+        deleted = await self.redis.delete(
+            *model_keys(
+                self.model_name,
+                self.namespace,
+                self.shards,
+                [window.period for window in self.windows],
+                [tenant.name for tenant in self.tenants],
+            )
+        )
+        if scan:
+            for pattern in scan_patterns(self.model_name, self.namespace):
+                keys_to_delete = [
+                    key async for key in self.redis.scan_iter(match=pattern, count=1000)
+                ]
+                if keys_to_delete:
+                    deleted += await self.redis.delete(*keys_to_delete)
+        return deleted > 0
 
     async def is_locked(self, tokens: int) -> bool:
         """
@@ -90,20 +556,7 @@ class AsyncRedisLimiter:
         Returns:
             bool: True if the lock is held, False otherwise.
         """
-        api_calls_key_exists = await self.redis.exists(f"{self.model_name}_api_calls")
-        api_tokens_key_exists = await self.redis.exists(f"{self.model_name}_api_tokens")
-
-        # If both keys exist and their values exceed the allowed limits, return True
-        if api_calls_key_exists and api_tokens_key_exists:
-            current_calls = int((await self.redis.get(f"{self.model_name}_api_calls")))  # type: ignore
-            current_tokens = int((await self.redis.get(f"{self.model_name}_api_tokens")))  # type: ignore
-            if (
-                current_calls >= self.max_calls
-                or current_tokens + tokens > self.max_tokens
-            ):
-                return True
-
-        return False
+        return await self._admit(dry_run=True) > 0
 
     async def check_redis(
         self,
@@ -112,10 +565,138 @@ class AsyncRedisLimiter:
         return await self.redis.ping()
 
 
-class AsyncMemoryLimiter:
-    memory_store: Dict[str, int] = {}
-    locks: Dict[str, asyncio.Lock] = {}
+# A waiting request: its priority, its order among the requests of its priority
+# (see `AsyncMemoryLimiter._order()`), its arrival, its limiter and the future
+# resolved with its wait.
+_Waiter = Tuple[int, float, int, "AsyncMemoryLimiter", "asyncio.Future[float]"]
+_arrivals = itertools.count()
+
+
+class _ModelState:
+    """
+    The in-memory budget of one model: the state of its call and token counters,
+    those of its extra windows by period and of its tenants by name, the time after
+    which they no longer limit anything, its requests in flight and the heap of the
+    requests waiting for budget, by priority then in the order of their scheduler. Windows expire lazily
+    when the counters are read, a single timer wakes the waiting requests when the
+    next one should fit.
+    """
+
+    __slots__ = (
+        "calls",
+        "tokens",
+        "windows",
+        "tenants",
+        "deadline",
+        "in_flight",
+        "waiters",
+        "timer",
+    )
+
+    def __init__(self):
+        self.calls: Any = None
+        self.tokens: Any = None
+        self.windows: Dict[float, Tuple[Any, Any]] = {}
+        self.tenants: Dict[str, Tuple[Any, Any]] = {}
+        self.deadline = 0.0
+        self.in_flight = 0
+        self.waiters: List[_Waiter] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def idle(self, now: float) -> bool:
+        """Whether the state can be dropped without changing any decision."""
+        return now >= self.deadline and not self.waiters and not self.in_flight
+
+    def head(self) -> "AsyncMemoryLimiter":
+        """Returns the request admitted next, there must be one waiting."""
+        return self.waiters[0][3]
 
+    def ahead(self, priority: int) -> bool:
+        """Whether requests of the same or a higher priority are waiting."""
+        return bool(self.waiters) and self.waiters[0][0] <= priority
+
+    def enqueue(self, limiter: "AsyncMemoryLimiter", future: "asyncio.Future[float]"):
+        """Queues a request behind the requests of the same or a higher priority."""
+        heapq.heappush(
+            self.waiters,
+            (limiter.priority, limiter._order(), next(_arrivals), limiter, future),
+        )
+
+    def wake(self):
+        """
+        Admits the waiting requests in order until one does not fit, then schedules
+        the timer for the time it will. With the shortest-job-first scheduler, the
+        requests of the same priority behind one that does not fit are still
+        admitted when they fit, until a request that waited long enough for its size
+        holds them back. A request held back by the share of its tenant leaves the
+        queue with its wait instead, so that it does not hold back the other tenants.
+        The cancelled requests leave the queue when they reach its head.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        waits, passed, loop = [], [], None
+        while self.waiters:
+            priority, _, _, limiter, future = self.waiters[0]
+            if future.done():  # The waiting task was cancelled
+                heapq.heappop(self.waiters)
+                continue
+            if passed and priority != passed[0][0]:
+                break  # Only the requests of its priority pass a waiting request
+            loop = future.get_loop()
+            wait = limiter._admit()
+            if not wait or limiter._capped:
+                heapq.heappop(self.waiters)
+                future.set_result(wait)
+                continue
+            waits.append(backoff(wait, limiter.jitter))
+            if not limiter._packs(now):
+                break
+            passed.append(heapq.heappop(self.waiters))
+        for entry in passed:
+            heapq.heappush(self.waiters, entry)
+        if waits and loop is not None:
+            self.timer = loop.call_later(min(waits), self.wake)
+
+
+# The in-memory state of every model, by (model name, algorithm), and of every API
+# key of a pool, by (model name, algorithm, key name), per event loop.
+_ModelStates = Dict[Tuple[str, ...], _ModelState]
+_stores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _ModelStates]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _model_states() -> _ModelStates:
+    loop = asyncio.get_running_loop()
+    states = _stores.get(loop)
+    if states is None:
+        states = _stores[loop] = {}
+    return states
+
+
+def _model_state(key: Tuple[str, ...]) -> _ModelState:
+    """
+    Returns the in-memory state of the budget of the key in the running event loop,
+    created on first use.
+    """
+    states = _model_states()
+    state = states.get(key)
+    if state is None:
+        # Drop the budgets nobody used for a whole window before adding one, so
+        # that the store only holds the budgets in use. The other budgets of the
+        # model are kept, a pool takes the budgets of all its API keys at once.
+        now = time.monotonic()
+        for idle in [
+            k for k, state in states.items() if k[:2] != key[:2] and state.idle(now)
+        ]:
+            del states[idle]
+        state = states[key] = _ModelState()
+    return state
+
+
+class AsyncMemoryLimiter:
     def __init__(
         self,
         model_name: str,
@@ -123,49 +704,435 @@ class AsyncMemoryLimiter:
         max_tokens: int,
         period: int,
         tokens: int,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        priority: int = 0,
+        tenant: Optional[str] = None,
+        scheduler: str = "fifo",
     ):
         self.model_name = model_name
         self.max_calls = max_calls
         self.max_tokens = max_tokens
         self.period = period
         self.tokens = tokens
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.windows = windows
+        self.max_in_flight = max_in_flight
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        self.priorities = priorities
+        self.tenants = tenants
+        self.priority = priority
+        self.tenant = tenant
+        self._priority_share = priority_share(priorities, priority)
+        self._tenant = tenant_index(tenants, tenant)
+        self.used_tokens: Optional[int] = None
+        self._deadline = 0.0
+        self._in_flight = False
+        # Whether the last admission was held back by the share of the tenant.
+        self._capped = False
+        # The order the waiting requests are admitted in, and when this one was queued.
+        self.scheduler = scheduler
+        self._queued_at = 0.0
+        self._state: Optional[_ModelState] = None
 
-    async def __aenter__(self):
-        lock = self.locks.setdefault(self.model_name, asyncio.Lock())
+    @property
+    def state(self) -> _ModelState:
+        """The state of the model in the running event loop."""
+        if self._state is None:
+            self._state = _model_state((self.model_name, self.algorithm))
+        return self._state
 
-        async with lock:
-            while True:
-                self.current_calls = (
-                    self.memory_store.get(f"{self.model_name}_api_calls", 0) + 1
-                )
-                self.memory_store[f"{self.model_name}_api_calls"] = self.current_calls
-                if self.current_calls == 1:
-                    asyncio.create_task(
-                        self._expire_key(f"{self.model_name}_api_calls", self.period)
-                    )
-                if self.current_calls <= self.max_calls:
-                    break
-                else:
-                    lock.release()  # Release the lock before sleeping
-                    await asyncio.sleep(self.period)  # wait for the limit to reset
-                    await lock.acquire()
-
-            while True:
-                self.current_tokens = (
-                    self.memory_store.get(f"{self.model_name}_api_tokens", 0)
-                    + self.tokens
+    def _admit(self, dry_run: bool = False) -> float:
+        """
+        Checks and reserves the budget with the algorithm, nothing is reserved when
+        the request does not fit.
+
+        Args:
+            dry_run (bool): Only check the budget without reserving it.
+
+        Returns:
+            float: The seconds to wait before the request fits, 0 if it was admitted.
+        """
+        algorithm = ALGORITHM_FUNCTIONS[self.algorithm]
+        state = self.state
+        now = time.monotonic()
+        calls_wait, current_calls, calls_state = algorithm(
+            state.calls, now, self.period, self.max_calls, 1
+        )
+        tokens_wait, current_tokens, tokens_state = algorithm(
+            state.tokens, now, self.period, self.max_tokens, self.tokens
+        )
+        windows_wait, windows = reserve_windows(
+            self.algorithm,
+            self._window_states(),
+            now,
+            self._window_limits(),
+            1,
+            self.tokens,
+        )
+        shares_wait, tenant_wait, tenant = reserve_shares(
+            self.algorithm,
+            self._shares(),
+            (state.calls, state.tokens),
+            now,
+            self.period,
+            (self.max_calls, self.max_tokens),
+            1,
+            self.tokens,
+        )
+        self._capped = tenant_wait > 0
+        wait = max(
+            calls_wait,
+            tokens_wait,
+            windows_wait,
+            shares_wait,
+            tenant_wait,
+            self._in_flight_wait(1),
+        )
+        if wait > 0 or dry_run:
+            self.current_calls = round(current_calls)
+            self.current_tokens = round(current_tokens)
+            return wait
+        state.calls = calls_state
+        state.tokens = tokens_state
+        self._reserve(windows, 1, tenant)
+        self.current_calls = round(current_calls + 1)
+        self.current_tokens = round(current_tokens + self.tokens)
+        self._deadline = reservation_deadline(self.algorithm, tokens_state, self.period)
+        return 0
+
+    def _window_limits(self) -> List[WindowLimits]:
+        return [(window.calls, window.tokens, window.period) for window in self.windows]
+
+    def _window_states(self) -> List[Tuple[Any, Any]]:
+        windows = self.state.windows
+        return [windows.get(window.period, (None, None)) for window in self.windows]
+
+    def _shares(self) -> Shares:
+        tenants = self.state.tenants
+        return Shares(
+            self._priority_share,
+            self._tenant,
+            [
+                (tenant.weight, tenant.min_calls, tenant.min_tokens)
+                for tenant in self.tenants
+            ],
+            [tenants.get(tenant.name, (None, None)) for tenant in self.tenants],
+        )
+
+    def _in_flight_wait(self, count: int) -> float:
+        """Returns the seconds to wait for the in-flight slots of `count` requests."""
+        if self.max_in_flight is None:
+            return 0.0
+        if self.state.in_flight + count <= self.max_in_flight:
+            return 0.0
+        return in_flight_poll
+
+    def _reserve(
+        self,
+        windows: List[Tuple[Any, Any]],
+        count: int,
+        tenant: Optional[Tuple[Any, Any]] = None,
+    ):
+        """
+        Stores the states of the extra windows and of the tenant, takes the in-flight
+        slots and moves the deadline of the state after every window it holds.
+        """
+        state = self.state
+        for window, window_state in zip(self.windows, windows):
+            state.windows[window.period] = window_state
+        if self.tenant is not None and tenant is not None:
+            state.tenants[self.tenant] = tenant
+        if self.max_in_flight is not None:
+            state.in_flight += count
+            self._in_flight = True
+        state.deadline = max(
+            state_expiry(self.algorithm, state.calls, self.period),
+            state_expiry(self.algorithm, state.tokens, self.period),
+            *(
+                state_expiry(self.algorithm, window_state, period)
+                for period, window_states in state.windows.items()
+                for window_state in window_states
+                if window_state is not None
+            ),
+            *(
+                state_expiry(self.algorithm, tenant_state, self.period)
+                for tenant_states in state.tenants.values()
+                for tenant_state in tenant_states
+                if tenant_state is not None
+            ),
+        )
+
+    async def _admit_batch(
+        self, costs: List[int], whole: bool = False
+    ) -> Tuple[int, float]:
+        """
+        Admits the longest prefix of a batch of requests that fits in the budget.
+        Nothing is admitted while requests of the same or a higher priority are
+        waiting, the batch would take the budget they are queued for.
+
+        Args:
+            costs (List[int]): The tokens of each request, in order.
+            whole (bool): Admit all the requests or none of them.
+
+        Returns:
+            Tuple[int, float]: The number of admitted requests and the seconds to wait
+            before the next one fits, 0 if all were admitted.
+        """
+        state = self.state
+        if state.ahead(self.priority):
+            return 0, self._queued_wait()
+        free = None
+        if self.max_in_flight is not None:
+            free = max(self.max_in_flight - state.in_flight, 0)
+        admitted, wait, calls, tokens, windows, tenant = admit_batch(
+            self.algorithm,
+            state.calls,
+            state.tokens,
+            time.monotonic(),
+            self.period,
+            self.max_calls,
+            self.max_tokens,
+            costs[:free],
+            self._window_states(),
+            self._window_limits(),
+            self._shares(),
+        )
+        if admitted < len(costs) and not wait:
+            wait = in_flight_poll  # Out of in-flight slots
+        if whole and admitted < len(costs):
+            admitted = 0  # All or nothing
+        if admitted:
+            state.calls, state.tokens = calls, tokens
+            self._reserve(windows, admitted, tenant)
+            self._deadline = reservation_deadline(self.algorithm, tokens, self.period)
+        return admitted, wait
+
+    async def _usage(self) -> Usage:
+        state = self.state
+        return snapshot(
+            self.algorithm,
+            state.calls,
+            state.tokens,
+            time.monotonic(),
+            self.period,
+            self.max_calls,
+            self.max_tokens,
+        )
+
+    async def _utilization(self) -> List[Utilization]:
+        state = self.state
+        now = time.monotonic()
+        limits = [
+            (self.max_calls, self.max_tokens, self.period),
+            *self._window_limits(),
+        ]
+        states = [(state.calls, state.tokens), *self._window_states()]
+        result = []
+        for (max_calls, max_tokens, window_period), (calls, tokens) in zip(
+            limits, states
+        ):
+            usage = snapshot(
+                self.algorithm,
+                calls,
+                tokens,
+                now,
+                window_period,
+                max_calls or 1,
+                max_tokens or 1,
+            )
+            result.append(
+                utilization(
+                    window_period, max_calls, max_tokens, usage.calls, usage.tokens
                 )
-                self.memory_store[f"{self.model_name}_api_tokens"] = self.current_tokens
-                if self.current_tokens == self.tokens:
-                    asyncio.create_task(
-                        self._expire_key(f"{self.model_name}_api_tokens", self.period)
-                    )
-                if self.current_tokens <= self.max_tokens:
-                    break
-                else:
-                    lock.release()  # Release the lock before sleeping
-                    await asyncio.sleep(self.period)  # wait for the limit to reset
-                    await lock.acquire()
+            )
+        return result
+
+    async def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the window it was reserved in, and admits the
+        waiting requests that fit in it. Nothing is credited once that window is over.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        self._give_back(tokens, calls)
+        if self.state.waiters:
+            self.state.wake()
+
+    async def _observe(self, observation: Observation):
+        state = self.state
+        state.calls, state.tokens = observe_states(
+            self.algorithm,
+            state.calls,
+            state.tokens,
+            time.monotonic(),
+            self.period,
+            self.max_calls,
+            self.max_tokens,
+            observation,
+        )
+        state.deadline = max(
+            state.deadline,  # The extra windows are not observed
+            state_expiry(self.algorithm, state.calls, self.period),
+            state_expiry(self.algorithm, state.tokens, self.period),
+        )
+        # The budget may have grown, the queue is checked again.
+        if state.waiters:
+            state.wake()
+
+    def _give_back(self, tokens: int, calls: int):
+        now = time.monotonic()
+        state = self.state
+        if now >= self._deadline:
+            return
+        refund = REFUND_FUNCTIONS[self.algorithm]
+        if calls > 0 and state.calls is not None:
+            state.calls = refund(state.calls, now, self.period, self.max_calls, calls)
+        if tokens > 0 and state.tokens is not None:
+            state.tokens = refund(
+                state.tokens, now, self.period, self.max_tokens, tokens
+            )
+        windows = refund_windows(
+            self.algorithm,
+            self._window_states(),
+            now,
+            self._window_limits(),
+            calls,
+            tokens,
+        )
+        for window, window_state in zip(self.windows, windows):
+            state.windows[window.period] = window_state
+        if self.tenant is not None and self.tenant in state.tenants:
+            # The counters of the tenant are refunded as one more window.
+            [tenant] = refund_windows(
+                self.algorithm,
+                [state.tenants[self.tenant]],
+                now,
+                [(self.max_calls, self.max_tokens, self.period)],
+                calls,
+                tokens,
+            )
+            state.tenants[self.tenant] = tenant
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        self.used_tokens = usage_tokens(usage)
+
+    def _order(self) -> float:
+        """
+        Returns the order of the waiting request among the requests of its priority,
+        the lowest going first: the time it was queued at, pushed back by its part
+        of the token budget times `sjf_aging` with the shortest-job-first scheduler.
+        Every request ages at the same pace, so the order never changes while they
+        wait.
+        """
+        if self.scheduler != "sjf":
+            return self._queued_at
+        return self._queued_at + sjf_aging * self.tokens / self.max_tokens
+
+    def _packs(self, now: float) -> bool:
+        """
+        Whether the requests behind the waiting request may be admitted while it
+        does not fit, until it waited long enough for its size.
+        """
+        return self.scheduler == "sjf" and self._order() > now
+
+    def _queued_wait(self) -> float:
+        """Predicts the wait of a request queued behind the waiting requests."""
+        waits = [self._admit(dry_run=True)]
+        if self.state.waiters:
+            waits.append(self.state.head()._admit(dry_run=True))
+        # The requests ahead fit now when the wait is 0, this one is next.
+        return max(waits) or 0.001
+
+    async def try_acquire(self) -> float:
+        """
+        Reserves the budget if the request fits right now, without waiting or
+        taking the budget of the requests already waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        state = self.state
+        if state.waiters:
+            state.wake()  # Admits the waiting requests that fit
+        if state.ahead(self.priority):
+            return self._queued_wait()
+        return self._admit()
+
+    async def __aenter__(self):
+        deadline = timeout_deadline(self.timeout)
+        while True:
+            wait = await self._enter(deadline)
+            if not wait:
+                return self
+            # Held back by the share of its tenant, the request waits out of the
+            # queue so that the requests of the other tenants are not held back.
+            check_timeout(deadline, wait)
+            await asyncio.sleep(backoff(wait, self.jitter))
+
+    async def _enter(self, deadline: Optional[float]) -> float:
+        """
+        Admits the request in its turn.
+
+        Returns:
+            float: 0 once the request was admitted, or the seconds to wait of a request
+            held back by the share of its tenant, which leaves the queue.
+        """
+        state = self.state
+        # Requests only skip the queue when nobody of the same or a higher priority
+        # is waiting, so that a late arrival never takes the budget a waiting
+        # request is queued for.
+        if not state.ahead(self.priority):
+            wait = self._admit()
+            if not wait or self._capped:
+                return wait
+            check_timeout(deadline, wait)
+
+        future: "asyncio.Future[float]" = asyncio.get_running_loop().create_future()
+        self._queued_at = time.monotonic()
+        state.enqueue(self, future)
+        # A shortest-job-first request may fit in what the requests ahead leave,
+        # while queuing it changes nothing for the others.
+        if state.waiters[0][4] is future or (
+            self.scheduler == "sjf" and not self._admit(dry_run=True)
+        ):
+            state.wake()
+        try:
+            if deadline is None:
+                return await future
+            await asyncio.wait([future], timeout=max(deadline - time.monotonic(), 0))
+            if not future.done():
+                future.cancel()
+                state.wake()
+                raise RateLimitTimeout(self._queued_wait())
+            return future.result()
+        except asyncio.CancelledError:
+            future.cancel()
+            if future.done() and not future.cancelled() and not future.result():
+                # Admitted right before the cancellation.
+                self._give_back(self.tokens, 1)
+                if self._in_flight:
+                    self._in_flight = False
+                    state.in_flight -= 1
+            state.wake()
+            raise
 
     async def __aexit__(
         self,
@@ -173,21 +1140,50 @@ class AsyncMemoryLimiter:
         exc_value: Optional[BaseException],
         traceback: Optional[types.TracebackType],
     ) -> Optional[bool]:
-        pass
+        if self.used_tokens is not None:
+            if self.used_tokens < self.tokens:
+                await self.refund(self.tokens - self.used_tokens)
+        elif exc_type is not None:
+            # The request failed before a response was received.
+            await self.refund(self.tokens)
+        if self._in_flight:
+            self._in_flight = False
+            state = self.state
+            state.in_flight -= 1
+            if state.waiters:
+                state.wake()
+
+    async def release(self):
+        """
+        Releases a reservation taken with `acquire()` instead of the context manager,
+        giving back the tokens that were not used.
+        """
+        await self.__aexit__(None, None, None)
 
     async def clear_locks(self) -> bool:
         """
         This method will clear all locks associated with the model.
         returns True if the locks were cleared successfully, otherwise returns False.
         """
-        keys_to_delete = [
-            key for key in self.memory_store if key.startswith(f"{self.model_name}_")
-        ]
-        for key in keys_to_delete:
-            del self.memory_store[key]
-        return bool(keys_to_delete)
-
-    # this function does'nt need self
+        states = _model_states()
+        cleared = False
+        # The budgets of the API keys of a pool, keyed with the key name too, are
+        # left alone.
+        for key in [
+            key for key in states if len(key) == 2 and key[0] == self.model_name
+        ]:
+            state = states[key]
+            cleared = cleared or state.calls is not None or bool(state.windows)
+            state.calls = state.tokens = None
+            state.windows = {}
+            state.tenants = {}
+            state.deadline = 0.0
+            if state.waiters or state.in_flight:
+                state.wake()
+            else:
+                del states[key]
+        self._state = None
+        return cleared
 
     async def is_locked(self, tokens: int) -> bool:
         """
@@ -199,25 +1195,9 @@ class AsyncMemoryLimiter:
         Returns:
             bool: True if the lock is held, False otherwise.
         """
-        current_calls = self.memory_store.get(f"{self.model_name}_api_calls", 0)
-        current_tokens = self.memory_store.get(f"{self.model_name}_api_tokens", 0)
-
-        if current_calls >= self.max_calls or current_tokens + tokens > self.max_tokens:
+        if self.state.ahead(self.priority):
             return True
-
-        return False
-
-    async def _expire_key(self, key: str, period: int):
-        """
-        This method will expire a key from the memory store after a given period.
-
-        Args:
-            key (str): The key to be expired.
-            period (int): The expiration period in seconds.
-        """
-        await asyncio.sleep(period)
-        if key in self.memory_store:
-            del self.memory_store[key]
+        return self._admit(dry_run=True) > 0
 
 
 class AsyncBaseAPILimiterRedis:
@@ -227,6 +1207,16 @@ class AsyncBaseAPILimiterRedis:
         RPM: int,
         TPM: int,
         redis_instance: "redis.Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        lease: Union[bool, QuotaLease] = False,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        scheduler: str = "fifo",
     ):
         """
         Initializer for the BaseAPILimiterRedis class.
@@ -238,23 +1228,93 @@ class AsyncBaseAPILimiterRedis:
             TPM (int): The maximum number of tokens per minute allowed. You can find your rate limits in your
                        OpenAI account at https://platform.openai.com/account/rate-limits
             redis_instance (redis.Redis[bytes] | None): Optional: The redis instance. If not specified it will use in-memory caching.
+            algorithm (str): The rate limiting algorithm, "fixed" for a fixed window that starts
+                             with the first request, "sliding" for a sliding window counter or
+                             "gcra" for a token bucket (generic cell rate algorithm).
+            jitter (float): The maximum random delay in seconds added to the wait of a rejected
+                            request, so that waiting callers do not all retry at the same instant.
+            lease (bool | QuotaLease): Reserve blocks of calls and tokens from Redis and admit requests
+                                       from them locally, without a round trip per request. Pass a
+                                       QuotaLease to tune the size of the blocks. Call `close()` on
+                                       shutdown to give the unused part back. Ignored for in-memory caching.
+            namespace (str | None): The prefix of the Redis keys, "openai_ratelimiter" by default. The keys
+                                    of a model share a hash tag so that they live in one Redis Cluster slot.
+            shards (int): Split the budget of the model into this many parts kept in different slots, so
+                          that a very hot model spreads its load over the nodes of a Redis Cluster. A
+                          request that does not fit in its part tries the other parts, the parts are
+                          never rebalanced and a single request is capped at `max_calls` and
+                          `max_tokens` divided by `shards`. Cannot be used with `lease`.
+            windows (Sequence[Window]): Extra limits of the budget over other periods, such as
+                                        `Window(86400, calls=10000)` for 10,000 requests per day.
+                                        Every window is checked and reserved with the RPM and TPM
+                                        in one atomic step.
+            max_in_flight (int | None): The maximum number of requests in flight at once, a slot
+                                        being held from admission until the context manager exits.
+                                        Cannot be used with `lease`.
+            priorities (Sequence[float]): The part of the budget each priority may fill, from
+                                          priority 0 (the highest) down, such as `(1.0, 0.6)` for
+                                          batch requests of priority 1 leaving 40% of the budget to
+                                          the others. Cannot be used with `lease`.
+            tenants (Sequence[Tenant]): The tenants sharing the budget, in proportion to their
+                                        weights and each with its minimum kept free for it.
+                                        Cannot be used with `lease`.
+            scheduler (str): The order the waiting requests of a priority are admitted in, "fifo"
+                             for their arrival order or "sjf" for the smallest first, packing every
+                             request that fits in the budget left by a larger one. A request goes
+                             ahead of the requests larger than it by less than the part of the
+                             TPM it waited for per `sjf_aging` seconds, so that large requests
+                             are not starved. Ignored with Redis, where requests are not queued.
 
         Creates an instance of the BaseAPILimiterRedis with the specified parameters, and connects to a Redis server
-        at the specified host and port.
+        at the specified host and port. The encoder of the model is loaded on first use.
         """
         self.model_name = model_name
         self.max_calls = RPM
         self.max_tokens = TPM
         self.period = period
         self.redis = redis_instance
-        try:
-            self.encoder = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            self.encoder = None
+        self.algorithm = check_algorithm(algorithm)
+        self.jitter = jitter
+        self.lease = QuotaLease() if lease is True else lease or None
+        self.namespace = namespace
+        self.shards = check_shards(shards, self.lease is not None)
+        self.windows = check_limits(windows, max_in_flight, self.lease is not None)
+        self.max_in_flight = max_in_flight
+        self.priorities, self.tenants = check_shares(
+            priorities, tenants, RPM, TPM, self.lease is not None
+        )
+        self.scheduler = check_scheduler(scheduler)
+        self._encoder: "Optional[Encoding]" = None
+        self._snapshot: Optional[Tuple[float, Usage]] = None
+
+    @property
+    def encoder(self) -> "Optional[Encoding]":
+        """The encoder of the model, None if tiktoken does not know the model."""
+        if self._encoder is None:
+            self._encoder = get_encoder(self.model_name)
+        return self._encoder
+
+    @encoder.setter
+    def encoder(self, encoder: "Optional[Encoding]"):
+        self._encoder = encoder
 
-    def _limit(self, tokens: int) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+    def _check_shard_fit(self, tokens: int):
+        """Rejects a request that no shard of a sharded budget could ever admit."""
+        check_shard_fit(
+            tokens,
+            [self.max_tokens, *(window.tokens for window in self.windows)],
+            self.shards,
+        )
 
+    def _limit(
+        self,
+        tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
         if self.redis:
+            self._check_shard_fit(tokens)
             instance: Union[AsyncRedisLimiter, AsyncMemoryLimiter] = AsyncRedisLimiter(
                 self.model_name,
                 self.max_calls,
@@ -262,6 +1322,18 @@ class AsyncBaseAPILimiterRedis:
                 self.period,
                 tokens,
                 self.redis,
+                self.algorithm,
+                self.jitter,
+                self.lease,
+                self.namespace,
+                self.shards,
+                self.windows,
+                self.max_in_flight,
+                timeout,
+                self.priorities,
+                self.tenants,
+                priority,
+                tenant,
             )
         else:
             instance = AsyncMemoryLimiter(
@@ -270,50 +1342,173 @@ class AsyncBaseAPILimiterRedis:
                 self.max_tokens,
                 self.period,
                 tokens,
+                self.algorithm,
+                self.jitter,
+                self.windows,
+                self.max_in_flight,
+                timeout,
+                self.priorities,
+                self.tenants,
+                priority,
+                tenant,
+                self.scheduler,
             )
         return instance
 
-    async def _is_locked(self, tokens: int) -> bool:
-        if self.redis:
-            instance: Union[AsyncRedisLimiter, AsyncMemoryLimiter] = AsyncRedisLimiter(
-                self.model_name,
-                self.max_calls,
-                self.max_tokens,
-                self.period,
-                tokens,
-                self.redis,
+    async def _acquire_whole(
+        self,
+        costs: List[int],
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> List[Union[AsyncRedisLimiter, AsyncMemoryLimiter]]:
+        """
+        Waits until a batch of requests fits in the budget as a whole, then reserves
+        all of them in one admission, so that nothing is held while it waits.
+
+        Args:
+            costs (List[int]): The tokens of each request.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the requests, 0 being the highest.
+            tenant (str | None): The tenant whose share the requests are counted in.
+
+        Returns:
+            List[Limiter]: The reservations, to be released with `await limiter.release()`.
+        """
+        max_calls = shard_limit(self.max_calls, self.shards, 0)
+        if len(costs) > max_calls:
+            raise ValueError(
+                f"The {len(costs)} requests exceed the {max_calls} calls of the budget."
             )
-        else:
-            instance = AsyncMemoryLimiter(
-                self.model_name,
-                self.max_calls,
-                self.max_tokens,
-                self.period,
-                tokens,
+        deadline = timeout_deadline(timeout)
+        while True:
+            admitted, wait = await self._acquire_batch(
+                costs, priority, tenant, whole=True
             )
-        return await instance.is_locked(tokens)
+            if admitted:
+                return admitted
+            check_timeout(deadline, wait)
+            await asyncio.sleep(backoff(wait, self.jitter))
+
+    async def update_from_headers(self, headers: Mapping[str, Any]):
+        """
+        Corrects the state of the budget with the rate limit headers of an OpenAI
+        response: the `x-ratelimit-remaining-*` and `x-ratelimit-reset-*` headers
+        replace the usage with the one the API sees, including the requests of other
+        services sharing the organization, and the `retry-after` of a 429 holds the
+        budget until it passes.
+
+        Args:
+            headers (Mapping[str, str]): The headers of the response, `response.headers`
+                                         of the OpenAI client or of the raised `APIStatusError`.
+        """
+        observation = observe(headers, self.max_calls, self.max_tokens)
+        if observation is not None:
+            await self._limit(0)._observe(observation)
+            self._snapshot = None
+
+    async def close(self):
+        """
+        Gives the unused part of the local lease back to the shared budget.
+        """
+        if self.redis and self.lease is not None:
+            limiter = self._limit(0)
+            assert isinstance(limiter, AsyncRedisLimiter)
+            await limiter._give_back(*self.lease.drain())
+
+    async def _acquire(
+        self,
+        tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+        limiter = self._limit(tokens, timeout, priority, tenant)
+        await limiter.__aenter__()
+        return limiter
+
+    async def _acquire_batch(
+        self,
+        costs: List[int],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+        whole: bool = False,
+    ) -> BatchAdmission:
+        if not costs:
+            return BatchAdmission([], 0.0)
+        if self.redis:
+            for tokens in costs:
+                self._check_shard_fit(tokens)
+        first = self._limit(costs[0], None, priority, tenant)
+        admitted, wait = await first._admit_batch(costs, whole)
+        if not admitted:
+            return BatchAdmission([], wait)
+        limiters = [first] + [
+            self._limit(tokens, None, priority, tenant) for tokens in costs[1:admitted]
+        ]
+        prefix = getattr(first, "_member", None)
+        for i, limiter in enumerate(limiters):
+            limiter._deadline = first._deadline
+            limiter._in_flight = first._in_flight
+            if isinstance(limiter, AsyncRedisLimiter):
+                assert isinstance(first, AsyncRedisLimiter)
+                limiter.shard = first.shard
+                # The batch script names the in-flight requests after the first one.
+                limiter._member = f"{prefix}:{i + 1}"
+        return BatchAdmission(limiters, wait)
+
+    async def _is_locked(self, tokens: int) -> bool:
+        return await self._limit(tokens).is_locked(tokens)
+
+    async def usage(self, max_age: float = 0.0) -> Usage:
+        """
+        Returns the usage of the budget of the model, read in a single round trip.
+
+        Args:
+            max_age (float): Reuse the last snapshot if it was taken less than `max_age`
+                             seconds ago, for callers polling the usage frequently.
+
+        Returns:
+            Usage: The calls and tokens used, the calls and tokens remaining and the
+            seconds until the whole budget is available again.
+        """
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._snapshot[0] < max_age:
+            taken_at, usage = self._snapshot
+            return usage._replace(reset=max(usage.reset - (now - taken_at), 0.0))
+        usage = await self._limit(0)._usage()
+        self._snapshot = (now, usage)
+        return usage
+
+    async def utilization(self) -> List[Utilization]:
+        """
+        Returns the part of the budget in use in every window, the RPM and TPM window
+        first, then the extra windows.
+
+        Returns:
+            List[Utilization]: The period of each window and the parts of its calls and
+            tokens limits in use, None for no limit.
+        """
+        return await self._limit(0)._utilization()
 
     async def check_redis(self):
         if self.redis:
             return await self.redis.ping()
         return False
 
-    async def clear_locks(self) -> bool:
-        if self.redis:
-            instance: Union[AsyncRedisLimiter, AsyncMemoryLimiter] = AsyncRedisLimiter(
-                self.model_name,
-                self.max_calls,
-                self.max_tokens,
-                self.period,
-                0,
-                self.redis,
-            )
-        else:
-            instance = AsyncMemoryLimiter(
-                self.model_name,
-                self.max_calls,
-                self.max_tokens,
-                self.period,
-                0,
-            )
-        return await instance.clear_locks()
+    async def clear_locks(self, scan: bool = False) -> bool:
+        """
+        This method will clear all locks associated with the model.
+        returns True if the locks were cleared successfully, otherwise returns False.
+
+        Args:
+            scan (bool): Also look for keys of the model with an incremental SCAN, such as
+                         keys left by earlier versions. Ignored for in-memory caching.
+        """
+        if self.lease is not None:
+            self.lease.drain()
+        limiter = self._limit(0)
+        if isinstance(limiter, AsyncRedisLimiter):
+            return await limiter.clear_locks(scan)
+        return await limiter.clear_locks()
@@ -0,0 +1,313 @@
+import inspect
+import types
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+from ..client import (
+    StreamCounter,
+    completion_max_tokens,
+    default_max_tokens,
+    error_headers,
+    requested_max_tokens,
+    text_messages,
+)
+from .base import AsyncBaseAPILimiterRedis, AsyncMemoryLimiter, AsyncRedisLimiter
+from .tokens import (
+    anum_tokens_consumed_by_chat_request,
+    anum_tokens_consumed_by_completion_request,
+)
+
+if TYPE_CHECKING:
+    import openai
+
+Reservation = Union[AsyncRedisLimiter, AsyncMemoryLimiter]
+
+
+async def send(resource: Any, method: str, kwargs: Dict[str, Any]) -> Tuple[Any, Any]:
+    """
+    Sends a request through `with_raw_response` when the resource has it, to read
+    the rate limit headers of the response.
+
+    Args:
+        resource (Any): The resource of the OpenAI client, such as `client.chat.completions`.
+        method (str): The name of the method.
+        kwargs (Dict[str, Any]): The arguments of the method.
+
+    Returns:
+        Tuple[Any, Any]: The parsed response and its headers, None if they cannot be read.
+    """
+    raw = getattr(resource, "with_raw_response", None)
+    if raw is None:
+        return await getattr(resource, method)(**kwargs), None
+    response = await getattr(raw, method)(**kwargs)
+    parsed = response.parse()
+    if inspect.isawaitable(parsed):
+        parsed = await parsed
+    return parsed, response.headers
+
+
+async def update_from_error(limiter: AsyncBaseAPILimiterRedis, error: BaseException):
+    """Corrects the budget with the headers of a failed request, such as a 429."""
+    headers = error_headers(error)
+    if headers is not None:
+        await limiter.update_from_headers(headers)
+
+
+class AsyncLimitedStream:
+    """
+    A streamed response holding its reservation until it is consumed or closed.
+    Iterate it like the stream of the OpenAI client, the unused tokens are given
+    back at the end.
+    """
+
+    def __init__(self, stream: Any, reservation: Reservation, counter: StreamCounter):
+        self.stream = stream
+        self.reservation = reservation
+        self.counter = counter
+        self._released = False
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        try:
+            async for chunk in self.stream:
+                self.counter.add(chunk)
+                yield chunk
+        except BaseException as e:
+            await self._release(type(e), e, e.__traceback__)
+            raise
+        await self._release(None, None, None)
+
+    async def _release(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ):
+        if self._released:
+            return
+        self._released = True
+        self.reservation.record_usage(self.counter.tokens)
+        await self.reservation.__aexit__(exc_type, exc_value, traceback)
+
+    async def close(self):
+        """Closes the response and releases the reservation."""
+        try:
+            await self.stream.close()
+        finally:
+            await self._release(None, None, None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ):
+        await self.close()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
+
+
+class _AsyncChatCompletions:
+    def __init__(self, client: "AsyncRateLimitedOpenAI"):
+        self._client = client
+
+    async def create(self, **kwargs: Any) -> Any:
+        """
+        Creates a chat completion once it fits in the budget of its model.
+        Takes the arguments of `client.chat.completions.create()`.
+        """
+        limiter = self._client._limiter(kwargs["model"])
+        if not limiter.encoder:
+            raise ValueError("The encoder is not set.")
+        max_tokens = requested_max_tokens(kwargs, self._client.max_tokens)
+        n = kwargs.get("n") or 1
+        tokens = await anum_tokens_consumed_by_chat_request(
+            text_messages(kwargs["messages"]), limiter.encoder, max_tokens, n
+        )
+        return await self._client._call(
+            limiter,
+            limiter._limit(
+                tokens,
+                self._client.wait_timeout,
+                self._client.priority,
+                self._client.tenant,
+            ),
+            tokens - n * max_tokens,
+            self._client.client.chat.completions,
+            kwargs,
+        )
+
+
+class _AsyncChat:
+    def __init__(self, client: "AsyncRateLimitedOpenAI"):
+        self.completions = _AsyncChatCompletions(client)
+
+
+class _AsyncCompletions:
+    def __init__(self, client: "AsyncRateLimitedOpenAI"):
+        self._client = client
+
+    async def create(self, **kwargs: Any) -> Any:
+        """
+        Creates a completion once it fits in the budget of its model.
+        Takes the arguments of `client.completions.create()`.
+        """
+        limiter = self._client._limiter(kwargs["model"])
+        if not limiter.encoder:
+            raise ValueError("The encoder is not set.")
+        max_tokens = requested_max_tokens(kwargs, completion_max_tokens)
+        n = kwargs.get("n") or 1
+        tokens = await anum_tokens_consumed_by_completion_request(
+            kwargs["prompt"], limiter.encoder, max_tokens, n
+        )
+        prompts = len(kwargs["prompt"]) if isinstance(kwargs["prompt"], list) else 1
+        return await self._client._call(
+            limiter,
+            limiter._limit(
+                tokens,
+                self._client.wait_timeout,
+                self._client.priority,
+                self._client.tenant,
+            ),
+            tokens - prompts * n * max_tokens,
+            self._client.client.completions,
+            kwargs,
+        )
+
+
+class _AsyncImages:
+    def __init__(self, client: "AsyncRateLimitedOpenAI"):
+        self._client = client
+
+    async def generate(self, **kwargs: Any) -> Any:
+        """
+        Generates images once they fit in the budget of their model, one call of the
+        budget per image. Takes the arguments of `client.images.generate()`.
+        """
+        limiter = self._client._limiter(kwargs.get("model") or "dall-e-2")
+        # The images are reserved together, a request never holds some of them
+        # while it waits for the others.
+        entered = await limiter._acquire_whole(
+            [0] * (kwargs.get("n") or 1),
+            self._client.wait_timeout,
+            self._client.priority,
+            self._client.tenant,
+        )
+        try:
+            response, headers = await send(
+                self._client.client.images, "generate", kwargs
+            )
+        except BaseException as e:
+            for reservation in entered:
+                await reservation.__aexit__(type(e), e, e.__traceback__)
+            await update_from_error(limiter, e)
+            raise
+        for reservation in entered:
+            await reservation.release()
+        if headers is not None:
+            await limiter.update_from_headers(headers)
+        return response
+
+
+class AsyncRateLimitedOpenAI:
+    """
+    An `openai.AsyncOpenAI` client whose chat completions, completions and image
+    generations wait for the budget of their model.
+
+    The tokens of a request are counted and reserved before it is sent, then the
+    reservation is reconciled with the `usage` of the response, or with the tokens
+    of a streamed response counted as its chunks arrive, and the unused part is
+    given back right away. A request that fails gives its tokens back.
+    Every other attribute is the one of the wrapped client.
+    """
+
+    def __init__(
+        self,
+        limiters: List[AsyncBaseAPILimiterRedis],
+        client: "Optional[openai.AsyncOpenAI]" = None,
+        max_tokens: Optional[int] = None,
+        wait_timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
+        """
+        Args:
+            limiters (List[AsyncBaseAPILimiterRedis]): The limiters of the models, for instance an
+                                                       AsyncChatCompletionLimiter per chat model and
+                                                       an AsyncDalleLimiter per image model.
+            client (openai.AsyncOpenAI | None): The client sending the requests, by default
+                                                `openai.AsyncOpenAI()` configured from the environment.
+            max_tokens (int | None): The completion tokens reserved for a chat request without
+                                     `max_tokens`, defaults to `default_max_tokens`.
+            wait_timeout (float | None): The seconds a request waits for the budget before raising
+                                         RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the requests, 0 being the highest.
+            tenant (str | None): The tenant whose share the requests are counted in.
+        """
+        if client is None:
+            import openai
+
+            client = openai.AsyncOpenAI()
+        self.client = client
+        self.limiters = {limiter.model_name: limiter for limiter in limiters}
+        self.max_tokens = default_max_tokens if max_tokens is None else max_tokens
+        self.wait_timeout = wait_timeout
+        self.priority = priority
+        self.tenant = tenant
+        self.chat = _AsyncChat(self)
+        self.completions = _AsyncCompletions(self)
+        self.images = _AsyncImages(self)
+
+    def _limiter(self, model_name: str) -> AsyncBaseAPILimiterRedis:
+        try:
+            return self.limiters[model_name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown model {model_name!r}, pass a limiter for it to the client."
+            ) from None
+
+    async def _call(
+        self,
+        limiter: AsyncBaseAPILimiterRedis,
+        reservation: Reservation,
+        prompt_tokens: int,
+        resource: Any,
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        await reservation.__aenter__()
+        try:
+            response, headers = await send(resource, "create", kwargs)
+        except BaseException as e:
+            await reservation.__aexit__(type(e), e, e.__traceback__)
+            await update_from_error(limiter, e)
+            raise
+        if kwargs.get("stream"):
+            if headers is not None:
+                await limiter.update_from_headers(headers)
+            return AsyncLimitedStream(
+                response, reservation, StreamCounter(prompt_tokens, limiter.encoder)
+            )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            reservation.record_usage(usage)
+        await reservation.release()
+        # The headers count the tokens of the response, the unused part of the
+        # reservation is given back first.
+        if headers is not None:
+            await limiter.update_from_headers(headers)
+        return response
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
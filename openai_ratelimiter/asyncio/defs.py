@@ -1,89 +1,202 @@
-from typing import Any, Dict, List, Union
-
-from redis.asyncio import Redis
-from tiktoken.core import Encoding
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Union
 
+from ..base import BatchAdmission
+from ..limits import Tenant, Window
+from ..tokens import (
+    num_tokens_consumed_by_chat_request,
+    num_tokens_consumed_by_completion_request,
+)
 from .base import AsyncBaseAPILimiterRedis, AsyncMemoryLimiter, AsyncRedisLimiter
+from .tokens import (
+    anum_tokens_consumed_by_chat_request,
+    anum_tokens_consumed_by_chat_requests,
+    anum_tokens_consumed_by_completion_request,
+    anum_tokens_consumed_by_completion_requests,
+)
 
-
-def num_tokens_consumed_by_chat_request(
-    messages: List[Dict[str, str]], encoder: Encoding, max_tokens: int = 15, n: int = 1
-):
-    num_tokens = n * max_tokens
-    for message in messages:
-        num_tokens += (
-            4  # Every message follows <im_start>{role/name}\n{content}<im_end>\n
-        )
-        for key, value in message.items():
-            num_tokens += len(encoder.encode(value))
-
-            if key == "name":  # If there's a name, the role is omitted
-                num_tokens -= 1
-
-    num_tokens += 2  # Every reply is primed with <im_start>assistant
-
-    return num_tokens
-
-
-def num_tokens_consumed_by_completion_request(
-    prompt: Union[str, list[str], Any],
-    encoder: Encoding,
-    max_tokens: int = 15,
-    n: int = 1,
-):
-    num_tokens = n * max_tokens
-    if isinstance(prompt, str):  # Single prompt
-        num_tokens += len(encoder.encode(prompt))
-    elif isinstance(prompt, list):  # Multiple prompts
-        num_tokens *= len(prompt)
-        num_tokens += sum([len([encoder.encode(p) for p in prompt])])
-    else:
-        raise TypeError(
-            "Either a string or list of strings expected for 'prompt' field in completion request."
-        )
-
-    return num_tokens
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
 
 
 class AsyncChatCompletionLimiter(AsyncBaseAPILimiterRedis):
     def limit(
-        self, messages: List[Dict[str, str]], max_tokens: int
-    ) -> AsyncRedisLimiter | AsyncMemoryLimiter:
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
         if not self.encoder:
             raise ValueError("The encoder is not set.")
         tokens = num_tokens_consumed_by_chat_request(messages, self.encoder, max_tokens)
-        return self._limit(tokens)
+        return self._limit(tokens, timeout, priority, tenant)
 
-    async def is_locked(self, messages: List[Dict[str, str]], max_tokens: int) -> bool:
+    async def count_tokens(
+        self, messages: List[Dict[str, str]], max_tokens: int
+    ) -> int:
+        """
+        Counts the tokens of the chat request, large requests are tokenized outside
+        of the event loop.
+        """
         if not self.encoder:
             raise ValueError("The encoder is not set.")
-        tokens = num_tokens_consumed_by_chat_request(messages, self.encoder, max_tokens)
-        return await self._is_locked(tokens)
+        return await anum_tokens_consumed_by_chat_request(
+            messages, self.encoder, max_tokens
+        )
+
+    async def acquire(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+        """
+        Waits until the chat request fits in the budget without blocking the event
+        loop on tokenization.
+
+        Args:
+            messages (List[Dict[str, str]]): The list of messages in the chat request.
+            max_tokens (int): The maximum number of tokens allowed.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            Limiter: The reservation, to be released with `await limiter.release()`.
+        """
+        return await self._acquire(
+            await self.count_tokens(messages, max_tokens), timeout, priority, tenant
+        )
+
+    async def acquire_batch(
+        self,
+        requests: List[Dict[str, Any]],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> BatchAdmission:
+        """
+        Reserves the budget of as many chat requests as fit right now, in order, with
+        a single admission. Large batches are tokenized outside of the event loop.
+
+        Args:
+            requests (List[Dict[str, Any]]): The requests, each with its `messages` and
+                                             optionally its `max_tokens` and `n`.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests, to be released with
+            `await limiter.release()`, and the seconds to wait before the next one fits.
+        """
+        if not self.encoder:
+            raise ValueError("The encoder is not set.")
+        tokens = await anum_tokens_consumed_by_chat_requests(requests, self.encoder)
+        return await self._acquire_batch(tokens, priority, tenant)
+
+    async def is_locked(self, messages: List[Dict[str, str]], max_tokens: int) -> bool:
+        return await self._is_locked(await self.count_tokens(messages, max_tokens))
 
 
 class AsyncTextCompletionLimiter(AsyncBaseAPILimiterRedis):
     def limit(
-        self, prompt: str, max_tokens: int
-    ) -> AsyncRedisLimiter | AsyncMemoryLimiter:
+        self,
+        prompt: str,
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
         if not self.encoder:
             raise ValueError("The encoder is not set.")
         tokens = num_tokens_consumed_by_completion_request(
             prompt, self.encoder, max_tokens
         )
-        return self._limit(tokens)
+        return self._limit(tokens, timeout, priority, tenant)
 
-    async def is_locked(self, prompt: str, max_tokens: int) -> bool:
+    async def count_tokens(self, prompt: str, max_tokens: int) -> int:
+        """
+        Counts the tokens of the completion request, large prompts are tokenized
+        outside of the event loop.
+        """
         if not self.encoder:
             raise ValueError("The encoder is not set.")
-        tokens = num_tokens_consumed_by_completion_request(
+        return await anum_tokens_consumed_by_completion_request(
             prompt, self.encoder, max_tokens
         )
-        return await self._is_locked(tokens)
+
+    async def acquire(
+        self,
+        prompt: str,
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+        """
+        Waits until the completion request fits in the budget without blocking the
+        event loop on tokenization.
+
+        Args:
+            prompt (str): The prompt of the completion request.
+            max_tokens (int): The maximum number of tokens allowed.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            Limiter: The reservation, to be released with `await limiter.release()`.
+        """
+        return await self._acquire(
+            await self.count_tokens(prompt, max_tokens), timeout, priority, tenant
+        )
+
+    async def acquire_batch(
+        self,
+        requests: List[Dict[str, Any]],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> BatchAdmission:
+        """
+        Reserves the budget of as many completion requests as fit right now, in
+        order, with a single admission. Large batches are tokenized outside of the
+        event loop.
+
+        Args:
+            requests (List[Dict[str, Any]]): The requests, each with its `prompt` and
+                                             optionally its `max_tokens` and `n`.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests, to be released with
+            `await limiter.release()`, and the seconds to wait before the next one fits.
+        """
+        if not self.encoder:
+            raise ValueError("The encoder is not set.")
+        tokens = await anum_tokens_consumed_by_completion_requests(
+            requests, self.encoder
+        )
+        return await self._acquire_batch(tokens, priority, tenant)
+
+    async def is_locked(self, prompt: str, max_tokens: int) -> bool:
+        return await self._is_locked(await self.count_tokens(prompt, max_tokens))
 
 
 class AsyncDalleLimiter(AsyncBaseAPILimiterRedis):
     def __init__(
-        self, model_name: str, IPM: int, redis_instance: "Redis[bytes] | None" = None
+        self,
+        model_name: str,
+        IPM: int,
+        redis_instance: "Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
     ):
         """
         Initializes an instance of the class.
@@ -92,20 +205,86 @@ class AsyncDalleLimiter(AsyncBaseAPILimiterRedis):
             model_name (str): The name of the model (dall-e-2 or dall-e-3).
             IPM (int): The maximum number of images per minute.
             Optional: redis_instance (Redis[bytes]): An instance of the Redis client. If not specified it will use in-memory caching.
+            algorithm (str): The rate limiting algorithm ("fixed", "sliding" or "gcra").
+            jitter (float): The maximum random delay in seconds added to the wait of a rejected request.
+            namespace (str | None): The prefix of the Redis keys.
+            shards (int): The number of parts the budget is split into across Redis Cluster slots. The
+                          parts are not rebalanced, a single request is capped at the limits divided by `shards`.
+            windows (Sequence[Window]): Extra limits over other periods, such as images per day.
+            max_in_flight (int | None): The maximum number of requests in flight at once.
+            priorities (Sequence[float]): The part of the budget each priority may fill, 0 being the highest.
+            tenants (Sequence[Tenant]): The tenants sharing the budget.
 
 
         """
         """"""
-        super().__init__(model_name, IPM, 1, redis_instance)
+        super().__init__(
+            model_name,
+            IPM,
+            1,
+            redis_instance,
+            algorithm,
+            jitter,
+            namespace=namespace,
+            shards=shards,
+            windows=windows,
+            max_in_flight=max_in_flight,
+            priorities=priorities,
+            tenants=tenants,
+        )
 
-    def limit(self):
+    def limit(
+        self,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
         """
         Limits the rate of API requests.
+        Args:
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
         Returns:
             Limiter: Limiter class to be used in the context manager.
         """
 
-        return self._limit(0)
+        return self._limit(0, timeout, priority, tenant)
+
+    async def acquire(
+        self,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+        """
+        Waits until the image request fits in the budget.
+        Args:
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            Limiter: The reservation, to be released with `await limiter.release()`.
+        """
+        return await self._acquire(0, timeout, priority, tenant)
+
+    async def acquire_batch(
+        self, count: int, priority: int = 0, tenant: Optional[str] = None
+    ) -> BatchAdmission:
+        """
+        Reserves as many of `count` image requests as fit right now with a single
+        admission.
+        Args:
+            count (int): The number of image requests to reserve.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests and the seconds
+            to wait before the next one fits.
+        """
+        return await self._acquire_batch([0] * count, priority, tenant)
 
     async def is_locked(self) -> bool:
         """Returns True if the request would be locked, False otherwise."""
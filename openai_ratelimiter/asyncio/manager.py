@@ -0,0 +1,217 @@
+import asyncio
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from ..algorithms import backoff
+from ..limits import Tenant, Window, check_timeout, timeout_deadline
+from ..scripts import ADMIT_SCRIPTS, get_script
+from .base import AsyncBaseAPILimiterRedis, AsyncMemoryLimiter, AsyncRedisLimiter
+
+if TYPE_CHECKING:
+    import redis.asyncio as redis
+
+
+class LimiterManager:
+    """
+    Owns the budgets of many models on a single Redis client.
+
+    Admissions for any model that arrive within `batch_window` of each other are
+    sent together in one pipeline, so a gateway limiting many models pays one
+    round trip per batch instead of one per request.
+    """
+
+    def __init__(
+        self,
+        redis_instance: "redis.Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        batch_window: float = 0.0,
+        namespace: Optional[str] = None,
+    ):
+        """
+        Args:
+            redis_instance (redis.Redis[bytes] | None): Optional: The redis instance shared by every
+                                                        model. If not specified it will use in-memory caching.
+            algorithm (str): The default rate limiting algorithm of the models ("fixed", "sliding" or "gcra").
+            jitter (float): The default maximum random delay in seconds added to the wait of a rejected request.
+            batch_window (float): The seconds admissions are collected before being sent, 0 to send
+                                  the admissions of one event loop iteration together.
+            namespace (str | None): The prefix of the Redis keys of every model.
+        """
+        self.redis = redis_instance
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.batch_window = batch_window
+        self.namespace = namespace
+        self.limiters: Dict[str, AsyncBaseAPILimiterRedis] = {}
+        self._pending: List[Tuple[AsyncRedisLimiter, "asyncio.Future[int]"]] = []
+        self._flushes: Set["asyncio.Task[None]"] = set()
+        self._scheduled = False
+
+    def register(
+        self,
+        model_name: str,
+        RPM: int,
+        TPM: int,
+        algorithm: Optional[str] = None,
+        jitter: Optional[float] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        scheduler: str = "fifo",
+    ) -> AsyncBaseAPILimiterRedis:
+        """
+        Adds the budget of a model.
+
+        Args:
+            model_name (str): The name of the model.
+            RPM (int): The maximum number of requests per minute allowed.
+            TPM (int): The maximum number of tokens per minute allowed.
+            algorithm (str | None): The rate limiting algorithm, defaults to the manager's.
+            jitter (float | None): The maximum random delay of a rejected request, defaults to the manager's.
+            shards (int): The number of parts the budget is split into across Redis Cluster slots. The
+                          parts are not rebalanced, a single request is capped at the limits divided by `shards`.
+            windows (Sequence[Window]): Extra limits over other periods, such as requests per day.
+            max_in_flight (int | None): The maximum number of requests in flight at once.
+            priorities (Sequence[float]): The part of the budget each priority may fill, 0 being the highest.
+            tenants (Sequence[Tenant]): The tenants sharing the budget.
+            scheduler (str): The order the waiting requests are admitted in in memory, "fifo" or "sjf".
+
+        Returns:
+            AsyncBaseAPILimiterRedis: The limiter of the model.
+        """
+        limiter = AsyncBaseAPILimiterRedis(
+            model_name,
+            RPM,
+            TPM,
+            self.redis,
+            self.algorithm if algorithm is None else algorithm,
+            self.jitter if jitter is None else jitter,
+            namespace=self.namespace,
+            shards=shards,
+            windows=windows,
+            max_in_flight=max_in_flight,
+            priorities=priorities,
+            tenants=tenants,
+            scheduler=scheduler,
+        )
+        self.limiters[model_name] = limiter
+        return limiter
+
+    def _limiter(self, model_name: str) -> AsyncBaseAPILimiterRedis:
+        try:
+            return self.limiters[model_name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown model {model_name!r}, register it with `register()` first."
+            ) from None
+
+    async def acquire(
+        self,
+        model_name: str,
+        tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[AsyncRedisLimiter, AsyncMemoryLimiter]:
+        """
+        Waits until the request fits in the budget of the model.
+
+        Args:
+            model_name (str): The name of the model.
+            tokens (int): The tokens of the request.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+
+        Returns:
+            Limiter: The reservation, to be released with `await limiter.release()`.
+        """
+        limiter = self._limiter(model_name)._limit(tokens, timeout, priority, tenant)
+        if isinstance(limiter, AsyncMemoryLimiter):
+            await limiter.__aenter__()
+            return limiter
+        deadline = timeout_deadline(timeout)
+        waits: List[int] = []
+        while True:
+            wait_ms = await self._admit(limiter)
+            if not wait_ms:
+                return limiter
+            # A pipeline tries a single shard, the other shards are tried in the
+            # next batches before waiting.
+            waits.append(wait_ms)
+            limiter.shard = (limiter.shard + 1) % limiter.shards
+            if len(waits) < limiter.shards:
+                continue
+            check_timeout(deadline, min(waits) / 1000)
+            await asyncio.sleep(backoff(min(waits) / 1000, limiter.jitter))
+            waits = []
+
+    async def is_locked(self, model_name: str, tokens: int) -> bool:
+        """
+        Returns True if the request would be locked, False otherwise.
+
+        Args:
+            model_name (str): The name of the model.
+            tokens (int): The tokens of the request.
+        """
+        return await self._limiter(model_name)._is_locked(tokens)
+
+    def _admit(self, limiter: AsyncRedisLimiter) -> "asyncio.Future[int]":
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((limiter, future))
+        if not self._scheduled:
+            self._scheduled = True
+            if self.batch_window > 0:
+                loop.call_later(self.batch_window, self._flush)
+            else:
+                loop.call_soon(self._flush)
+        return future
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        self._scheduled = False
+        task = asyncio.ensure_future(self._send(pending))
+        # Keep a reference until the batch is sent.
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send(
+        self, pending: List[Tuple[AsyncRedisLimiter, "asyncio.Future[int]"]]
+    ):
+        assert self.redis is not None
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for limiter, _ in pending:
+                    admit = get_script(self.redis, ADMIT_SCRIPTS[limiter.algorithm])
+                    await admit(
+                        keys=limiter._admit_keys(),
+                        args=limiter._admit_args(),
+                        client=pipe,
+                    )
+                results = await pipe.execute(raise_on_error=False)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (limiter, future), result in zip(pending, results):
+            if isinstance(result, Exception):
+                if not future.done():
+                    future.set_exception(result)
+                continue
+            wait_ms = limiter._admitted(result)
+            limiter._in_flight = not wait_ms and limiter.max_in_flight is not None
+            if not future.done():
+                future.set_result(wait_ms)
+            elif not wait_ms:
+                # The waiting task was cancelled, its reservation is given back.
+                limiter._undo_later()
+
+    async def close(self):
+        """Waits for the admissions being sent."""
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
@@ -0,0 +1,95 @@
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, TypeVar, Union
+
+from ..tokens import (
+    num_tokens_consumed_by_chat_request,
+    num_tokens_consumed_by_chat_requests,
+    num_tokens_consumed_by_completion_request,
+    num_tokens_consumed_by_completion_requests,
+)
+
+if TYPE_CHECKING:
+    from tiktoken.core import Encoding
+
+T = TypeVar("T")
+
+# Inputs with at least this many characters are tokenized outside of the event
+# loop, smaller ones are cheaper to tokenize inline than to hand over.
+offload_threshold = 16_384
+# The executor running the offloaded tokenization, None for the default executor
+# of the running loop. tiktoken releases the GIL while encoding, threads are enough.
+executor: Optional[Executor] = None
+
+
+async def offload(size: int, func: Callable[..., T], *args: Any) -> T:
+    """
+    Runs the tokenization function inline for small inputs, in the executor otherwise.
+
+    Args:
+        size (int): The number of characters to tokenize.
+        func (Callable[..., T]): The function to run.
+        *args: The arguments of the function.
+
+    Returns:
+        T: The result of the function.
+    """
+    if size < offload_threshold:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+
+async def anum_tokens_consumed_by_chat_request(
+    messages: List[Dict[str, str]],
+    encoder: "Encoding",
+    max_tokens: int = 15,
+    n: int = 1,
+) -> int:
+    size = sum(len(value) for message in messages for value in message.values())
+    return await offload(
+        size, num_tokens_consumed_by_chat_request, messages, encoder, max_tokens, n
+    )
+
+
+async def anum_tokens_consumed_by_completion_request(
+    prompt: Union[str, list[str], Any],
+    encoder: "Encoding",
+    max_tokens: int = 15,
+    n: int = 1,
+) -> int:
+    if isinstance(prompt, list):
+        size = sum(len(p) for p in prompt)
+    else:
+        size = len(prompt) if isinstance(prompt, str) else 0
+    return await offload(
+        size, num_tokens_consumed_by_completion_request, prompt, encoder, max_tokens, n
+    )
+
+
+async def anum_tokens_consumed_by_chat_requests(
+    requests: List[Dict[str, Any]], encoder: "Encoding"
+) -> List[int]:
+    size = sum(
+        len(value)
+        for request in requests
+        for message in request["messages"]
+        for value in message.values()
+    )
+    return await offload(size, num_tokens_consumed_by_chat_requests, requests, encoder)
+
+
+async def anum_tokens_consumed_by_completion_requests(
+    requests: List[Dict[str, Any]], encoder: "Encoding"
+) -> List[int]:
+    size = 0
+    for request in requests:
+        prompt = request["prompt"]
+        if isinstance(prompt, list):
+            size += sum(len(p) for p in prompt)
+        elif isinstance(prompt, str):
+            size += len(prompt)
+    return await offload(
+        size, num_tokens_consumed_by_completion_requests, requests, encoder
+    )
@@ -1,14 +1,92 @@
+import random
+import threading
 import time
 import types
-from typing import Optional, Type
+import uuid
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Deque,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
 
-import redis
-import tiktoken
-from redis.lock import Lock
+from .algorithms import (
+    ALGORITHM_FUNCTIONS,
+    REFUND_FUNCTIONS,
+    Shares,
+    WindowLimits,
+    admit_batch,
+    backoff,
+    check_algorithm,
+    observe_states,
+    refund_windows,
+    reservation_deadline,
+    reserve_shares,
+    reserve_windows,
+    snapshot,
+)
+from .headers import Observation, observe
+from .keys import (
+    check_shard_fit,
+    check_shards,
+    in_flight_key,
+    limiter_keys,
+    model_keys,
+    scan_patterns,
+    shard_limit,
+)
+from .lease import QuotaLease
+from .limits import (
+    RateLimitTimeout,
+    Tenant,
+    Window,
+    check_limits,
+    check_shares,
+    check_timeout,
+    in_flight_poll,
+    in_flight_timeout,
+    priority_share,
+    tenant_index,
+    timeout_deadline,
+    window_args,
+)
+from .scripts import (
+    ADMIT_BATCH_SCRIPTS,
+    ADMIT_SCRIPTS,
+    OBSERVE_SCRIPTS,
+    REFUND_SCRIPTS,
+    USAGE_SCRIPTS,
+    get_script,
+)
+from .shm import SharedMemoryLimiter, SharedMemoryStore
+from .tokens import get_encoder
+from .usage import Usage, usage_tokens
+
+if TYPE_CHECKING:
+    import redis
+    from tiktoken.core import Encoding
 
 period = 60
 
 
+class BatchAdmission(NamedTuple):
+    """The outcome of admitting a batch of requests at once."""
+
+    # The reservations of the admitted requests, the first ones of the batch.
+    admitted: List[Any]
+    # The seconds to wait before the next request fits, 0 if all were admitted.
+    wait: float
+
+
 class Limiter:
     def __init__(
         self,
@@ -18,6 +96,18 @@ class Limiter:
         period: int,
         tokens: int,
         redis: "redis.Redis[bytes]",
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        lease: Optional[QuotaLease] = None,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        priority: int = 0,
+        tenant: Optional[str] = None,
     ):
         self.model_name = model_name
         self.max_calls = max_calls
@@ -25,36 +115,768 @@ class Limiter:
         self.period = period
         self.tokens = tokens
         self.redis = redis
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.lease = lease
+        self.namespace = namespace
+        self.shards = shards
+        # Requests start on a random shard to spread the load over the shards.
+        self.shard = random.randrange(shards)
+        self.windows = windows
+        self.max_in_flight = max_in_flight
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        self.priorities = priorities
+        self.tenants = tenants
+        self.priority = priority
+        self.tenant = tenant
+        self._priority_share = priority_share(priorities, priority)
+        self._tenant = tenant_index(tenants, tenant)
+        self.used_tokens: Optional[int] = None
+        self._deadline = 0.0
+        self._leased = False
+        # The member of the request in the set of in-flight requests, and whether
+        # it holds a slot there.
+        self._member = uuid.uuid4().hex
+        self._in_flight = False
+
+    def _keys(self) -> List[str]:
+        shard = self.shard if self.shards > 1 else None
+        return limiter_keys(self.model_name, self.algorithm, self.namespace, shard)
+
+    def _window_keys(self) -> List[str]:
+        """Returns the calls and tokens keys of every window, the main one first."""
+        shard = self.shard if self.shards > 1 else None
+        keys = self._keys()
+        for window in self.windows:
+            keys += limiter_keys(
+                self.model_name, self.algorithm, self.namespace, shard, window.period
+            )
+        return keys
+
+    def _tenant_keys(self, tenants: Sequence[Tenant]) -> List[str]:
+        """Returns the calls and tokens keys of the tenants."""
+        shard = self.shard if self.shards > 1 else None
+        keys = []
+        for tenant in tenants:
+            keys += limiter_keys(
+                self.model_name,
+                self.algorithm,
+                self.namespace,
+                shard,
+                tenant=tenant.name,
+            )
+        return keys
+
+    def _in_flight_key(self) -> str:
+        shard = self.shard if self.shards > 1 else None
+        return in_flight_key(self.model_name, self.namespace, shard)
+
+    def _admit_keys(self) -> List[str]:
+        keys = self._window_keys() + self._tenant_keys(self.tenants)
+        if self.max_in_flight is not None:
+            keys.append(self._in_flight_key())
+        return keys
+
+    def _share(self, limit: Optional[int]) -> Optional[int]:
+        """Returns the part of a limit held by the current shard."""
+        if limit is None or self.shards == 1:
+            return limit
+        return shard_limit(limit, self.shards, self.shard)
+
+    def _limits(self) -> Tuple[int, int]:
+        """Returns the calls and tokens budget of the current shard."""
+        if self.shards == 1:
+            return self.max_calls, self.max_tokens
+        return (
+            shard_limit(self.max_calls, self.shards, self.shard),
+            shard_limit(self.max_tokens, self.shards, self.shard),
+        )
+
+    def _window_args(self) -> List[float]:
+        """Returns the windows of the current shard for the scripts, the main one first."""
+        args = window_args(*self._limits(), self.period)
+        for window in self.windows:
+            args += window_args(
+                self._share(window.calls), self._share(window.tokens), window.period
+            )
+        return args
+
+    def _share_args(self) -> List[float]:
+        """Returns the shares of the budget of the current shard for the scripts."""
+        args = [
+            self._priority_share,
+            0 if self._tenant is None else self._tenant + 1,
+            len(self.tenants),
+        ]
+        for tenant in self.tenants:
+            args += [
+                tenant.weight,
+                self._share(tenant.min_calls),
+                self._share(tenant.min_tokens),
+            ]
+        return args
+
+    def _in_flight_args(self, member: str) -> List[Any]:
+        limit = self._share(self.max_in_flight)
+        return [
+            -1 if limit is None else limit,
+            member,
+            int(in_flight_timeout * 1000),
+            int(in_flight_poll * 1000),
+        ]
+
+    def _shard_order(self) -> List[int]:
+        """Returns the shards to try, starting with the current one."""
+        return [(self.shard + i) % self.shards for i in range(self.shards)]
+
+    def _admit(
+        self, dry_run: bool = False, calls: int = 1, tokens: Optional[int] = None
+    ) -> int:
+        """
+        Runs the admission script of the algorithm once, or once per shard of a
+        sharded budget until a shard admits the request.
+
+        Args:
+            dry_run (bool): Only check the budget without reserving it.
+            calls (int): The number of calls to reserve.
+            tokens (int | None): The number of tokens to reserve, defaults to the request's.
+
+        Returns:
+            int: The milliseconds to wait before the request fits, 0 if it was admitted.
+        """
+        admit = get_script(self.redis, ADMIT_SCRIPTS[self.algorithm])
+        waits = []
+        for self.shard in self._shard_order():
+            wait_ms = self._admitted(
+                admit(
+                    keys=self._admit_keys(),
+                    args=self._admit_args(dry_run, calls, tokens),
+                )
+            )
+            if not wait_ms:
+                self._in_flight = not dry_run and self.max_in_flight is not None
+                return 0
+            waits.append(wait_ms)
+        return min(waits)
+
+    def _admit_args(
+        self, dry_run: bool = False, calls: int = 1, tokens: Optional[int] = None
+    ) -> List[Any]:
+        return [
+            self.tokens if tokens is None else tokens,
+            int(dry_run),
+            calls,
+            *self._in_flight_args(self._member),
+            *self._share_args(),
+            *self._window_args(),
+        ]
+
+    def _admitted(self, result: List[int]) -> int:
+        _, wait_ms, self.current_calls, self.current_tokens, window_ms = result
+        if window_ms:
+            self._deadline = time.monotonic() + window_ms / 1000
+        return wait_ms
+
+    def _admit_batch(self, costs: List[int], whole: bool = False) -> Tuple[int, float]:
+        """
+        Runs the batch admission script of the algorithm once.
+
+        Args:
+            costs (List[int]): The tokens of each request, in order.
+            whole (bool): Admit all the requests or none of them.
+
+        Returns:
+            Tuple[int, float]: The number of admitted requests and the seconds to wait
+            before the next one fits, 0 if all were admitted.
+        """
+        admit = get_script(self.redis, ADMIT_BATCH_SCRIPTS[self.algorithm])
+        waits = []
+        for self.shard in self._shard_order():
+            admitted, wait_ms, window_ms = admit(
+                keys=self._admit_keys(),
+                args=[
+                    *self._in_flight_args(self._member),
+                    int(whole),
+                    len(costs),
+                    *costs,
+                    *self._share_args(),
+                    *self._window_args(),
+                ],
+            )
+            if admitted:
+                self._deadline = time.monotonic() + window_ms / 1000
+                self._in_flight = self.max_in_flight is not None
+                return admitted, wait_ms / 1000
+            waits.append(wait_ms)
+        return 0, min(waits) / 1000
+
+    def _usage(self) -> Usage:
+        """Runs the usage script of the algorithm once per shard."""
+        usage = get_script(self.redis, USAGE_SCRIPTS[self.algorithm])
+        calls = tokens = remaining_calls = remaining_tokens = reset_ms = 0
+        for self.shard in range(self.shards):
+            max_calls, max_tokens = self._limits()
+            shard_calls, shard_tokens, shard_reset_ms = usage(
+                keys=self._keys(), args=[max_calls, max_tokens, self.period]
+            )
+            calls += shard_calls
+            tokens += shard_tokens
+            remaining_calls += max(max_calls - shard_calls, 0)
+            remaining_tokens += max(max_tokens - shard_tokens, 0)
+            reset_ms = max(reset_ms, shard_reset_ms)
+        return Usage(calls, tokens, remaining_calls, remaining_tokens, reset_ms / 1000)
+
+    def _observe(self, observation: Observation):
+        """
+        Runs the observe script of the algorithm once per shard, each shard taking
+        its part of the reported usage.
+        """
+        observe = get_script(self.redis, OBSERVE_SCRIPTS[self.algorithm])
+        for self.shard in range(self.shards):
+            max_calls, max_tokens = self._limits()
+            share = observation.share(
+                self.max_calls, self.max_tokens, max_calls, max_tokens
+            )
+            observe(
+                keys=self._keys(),
+                args=[
+                    -1 if share.calls is None else share.calls,
+                    -1 if share.tokens is None else share.tokens,
+                    int(share.calls_reset * 1000),
+                    int(share.tokens_reset * 1000),
+                    max_calls,
+                    max_tokens,
+                    self.period,
+                ],
+            )
+
+    def _admit_leased(self) -> bool:
+        """
+        Admits the request from the local lease, renewing the lease from Redis when
+        it runs out.
+
+        Returns:
+            bool: True if the request was admitted, False if the shared budget cannot
+            cover a new lease.
+        """
+        assert self.lease is not None
+        self._leased, self._deadline = self.lease.take(self.tokens)
+        if self._leased:
+            return True
+        self._give_back(*self.lease.drain())
+        calls, tokens = self.lease.size(self.tokens, self.max_calls, self.max_tokens)
+        if self._admit(calls=calls, tokens=tokens):
+            return False
+        self._give_back(*self.lease.grant(calls, tokens, self._deadline, self.tokens))
+        self._leased = True
+        return True
+
+    def _give_back(self, calls: int, tokens: int, deadline: float):
+        if (calls > 0 or tokens > 0) and time.monotonic() < deadline:
+            refund = get_script(self.redis, REFUND_SCRIPTS[self.algorithm])
+            keys, args = self._window_keys(), self._window_args()
+            if self._tenant is not None:
+                # The counters of the tenant are refunded as one more window.
+                keys += self._tenant_keys([self.tenants[self._tenant]])
+                args += window_args(*self._limits(), self.period)
+            refund(keys=keys, args=[calls, tokens, *args])
+
+    def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the window it was reserved in. Nothing is
+        credited once that window is over.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        if self._leased:
+            assert self.lease is not None
+            self.lease.give_back(tokens, calls, self._deadline)
+        else:
+            self._give_back(calls, tokens, self._deadline)
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        self.used_tokens = usage_tokens(usage)
 
     def __enter__(self):
-        lock = Lock(self.redis, f"{self.model_name}_lock", timeout=self.period)
+        if self.lease is not None and self._admit_leased():
+            return self
+        deadline = timeout_deadline(self.timeout)
+        while True:
+            wait_ms = self._admit()
+            if not wait_ms:
+                break
+            check_timeout(deadline, wait_ms / 1000)
+            time.sleep(backoff(wait_ms / 1000, self.jitter))
+        return self
 
-        with lock:
-            while True:
-                self.current_calls = self.redis.incr(
-                    f"{self.model_name}_api_calls", amount=1
+    def try_acquire(self) -> float:
+        """
+        Reserves the budget if the request fits right now, without waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        if self.lease is not None and self._admit_leased():
+            return 0.0
+        return self._admit() / 1000
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ) -> Optional[bool]:
+        if self.used_tokens is not None:
+            if self.used_tokens < self.tokens:
+                self.refund(self.tokens - self.used_tokens)
+        elif exc_type is not None:
+            # The request failed before a response was received.
+            self.refund(self.tokens)
+        if self._in_flight:
+            self._in_flight = False
+            self.redis.zrem(self._in_flight_key(), self._member)
+
+    def release(self):
+        """
+        Releases a reservation taken with `limit_many()` instead of the context
+        manager, giving back the tokens that were not used.
+        """
+        self.__exit__(None, None, None)
+
+
+class _ModelState:
+    """
+    The in-memory budget of one model: the state of its call and token counters,
+    those of its extra windows by period and of its tenants by name, its requests in
+    flight and the threads waiting for budget, by priority then in arrival order.
+    Each model has its own lock, and each waiting thread its own condition so that
+    only the thread at the head of the queue is woken.
+    """
+
+    __slots__ = (
+        "calls",
+        "tokens",
+        "windows",
+        "tenants",
+        "in_flight",
+        "lock",
+        "waiters",
+    )
+
+    def __init__(self):
+        self.calls: Any = None
+        self.tokens: Any = None
+        self.windows: Dict[float, Tuple[Any, Any]] = {}
+        self.tenants: Dict[str, Tuple[Any, Any]] = {}
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.waiters: "Deque[Tuple[MemoryLimiter, threading.Condition]]" = deque()
+
+    def ahead(self, priority: int) -> bool:
+        """Whether threads of the same or a higher priority are waiting."""
+        return bool(self.waiters) and self.waiters[0][0].priority <= priority
+
+    def enqueue(self, entry: "Tuple[MemoryLimiter, threading.Condition]"):
+        """Queues a thread behind the threads of the same or a higher priority."""
+        index = len(self.waiters)
+        while index and self.waiters[index - 1][0].priority > entry[0].priority:
+            index -= 1
+        self.waiters.insert(index, entry)
+
+    def wake(self):
+        """Wakes the thread at the head of the queue, the lock must be held."""
+        if self.waiters:
+            self.waiters[0][1].notify()
+
+
+# The in-memory state of every model, by (model name, algorithm), and of every API
+# key of a pool, by (model name, algorithm, key name).
+_states: Dict[Tuple[str, ...], _ModelState] = {}
+_states_lock = threading.Lock()
+
+
+def _model_state(key: Tuple[str, ...]) -> _ModelState:
+    """Returns the in-memory state of the budget of the key, created on first use."""
+    with _states_lock:
+        state = _states.get(key)
+        if state is None:
+            state = _states[key] = _ModelState()
+        return state
+
+
+class MemoryLimiter:
+    def __init__(
+        self,
+        model_name: str,
+        max_calls: int,
+        max_tokens: int,
+        period: int,
+        tokens: int,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.period = period
+        self.tokens = tokens
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.windows = windows
+        self.max_in_flight = max_in_flight
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        self.priorities = priorities
+        self.tenants = tenants
+        self.priority = priority
+        self.tenant = tenant
+        self._priority_share = priority_share(priorities, priority)
+        self._tenant = tenant_index(tenants, tenant)
+        self.used_tokens: Optional[int] = None
+        self._deadline = 0.0
+        self._in_flight = False
+        # Whether the last admission was held back by the share of the tenant.
+        self._capped = False
+        self._state: Optional[_ModelState] = None
+
+    @property
+    def state(self) -> _ModelState:
+        """The state of the model."""
+        if self._state is None:
+            self._state = _model_state((self.model_name, self.algorithm))
+        return self._state
+
+    def _admit(self, dry_run: bool = False) -> float:
+        """
+        Checks and reserves the budget with the algorithm, nothing is reserved when
+        the request does not fit. The lock of the state must be held.
+
+        Args:
+            dry_run (bool): Only check the budget without reserving it.
+
+        Returns:
+            float: The seconds to wait before the request fits, 0 if it was admitted.
+        """
+        algorithm = ALGORITHM_FUNCTIONS[self.algorithm]
+        state = self.state
+        now = time.monotonic()
+        calls_wait, current_calls, calls_state = algorithm(
+            state.calls, now, self.period, self.max_calls, 1
+        )
+        tokens_wait, current_tokens, tokens_state = algorithm(
+            state.tokens, now, self.period, self.max_tokens, self.tokens
+        )
+        windows_wait, windows = reserve_windows(
+            self.algorithm,
+            self._window_states(),
+            now,
+            self._window_limits(),
+            1,
+            self.tokens,
+        )
+        shares_wait, tenant_wait, tenant = reserve_shares(
+            self.algorithm,
+            self._shares(),
+            (state.calls, state.tokens),
+            now,
+            self.period,
+            (self.max_calls, self.max_tokens),
+            1,
+            self.tokens,
+        )
+        self._capped = tenant_wait > 0
+        wait = max(
+            calls_wait,
+            tokens_wait,
+            windows_wait,
+            shares_wait,
+            tenant_wait,
+            self._in_flight_wait(1),
+        )
+        if wait > 0 or dry_run:
+            self.current_calls = round(current_calls)
+            self.current_tokens = round(current_tokens)
+            return wait
+        state.calls = calls_state
+        state.tokens = tokens_state
+        self._reserve(windows, 1, tenant)
+        self.current_calls = round(current_calls + 1)
+        self.current_tokens = round(current_tokens + self.tokens)
+        self._deadline = reservation_deadline(self.algorithm, tokens_state, self.period)
+        return 0
+
+    def _window_limits(self) -> List[WindowLimits]:
+        return [(window.calls, window.tokens, window.period) for window in self.windows]
+
+    def _window_states(self) -> List[Tuple[Any, Any]]:
+        windows = self.state.windows
+        return [windows.get(window.period, (None, None)) for window in self.windows]
+
+    def _shares(self) -> Shares:
+        tenants = self.state.tenants
+        return Shares(
+            self._priority_share,
+            self._tenant,
+            [
+                (tenant.weight, tenant.min_calls, tenant.min_tokens)
+                for tenant in self.tenants
+            ],
+            [tenants.get(tenant.name, (None, None)) for tenant in self.tenants],
+        )
+
+    def _in_flight_wait(self, count: int) -> float:
+        """Returns the seconds to wait for the in-flight slots of `count` requests."""
+        if self.max_in_flight is None:
+            return 0.0
+        if self.state.in_flight + count <= self.max_in_flight:
+            return 0.0
+        return in_flight_poll
+
+    def _reserve(
+        self,
+        windows: List[Tuple[Any, Any]],
+        count: int,
+        tenant: Optional[Tuple[Any, Any]] = None,
+    ):
+        """
+        Stores the states of the extra windows and of the tenant, and takes the
+        in-flight slots.
+        """
+        state = self.state
+        for window, window_state in zip(self.windows, windows):
+            state.windows[window.period] = window_state
+        if self.tenant is not None and tenant is not None:
+            state.tenants[self.tenant] = tenant
+        if self.max_in_flight is not None:
+            state.in_flight += count
+            self._in_flight = True
+
+    def _admit_batch(self, costs: List[int], whole: bool = False) -> Tuple[int, float]:
+        """
+        Admits the longest prefix of a batch of requests that fits in the budget.
+        Nothing is admitted while threads of the same or a higher priority are
+        waiting, the batch would take the budget they are queued for.
+
+        Args:
+            costs (List[int]): The tokens of each request, in order.
+            whole (bool): Admit all the requests or none of them.
+
+        Returns:
+            Tuple[int, float]: The number of admitted requests and the seconds to wait
+            before the next one fits, 0 if all were admitted.
+        """
+        state = self.state
+        with state.lock:
+            if state.ahead(self.priority):
+                return 0, self._queued_wait()
+            now = time.monotonic()
+            free = None
+            if self.max_in_flight is not None:
+                free = max(self.max_in_flight - state.in_flight, 0)
+            admitted, wait, calls, tokens, windows, tenant = admit_batch(
+                self.algorithm,
+                state.calls,
+                state.tokens,
+                now,
+                self.period,
+                self.max_calls,
+                self.max_tokens,
+                costs[:free],
+                self._window_states(),
+                self._window_limits(),
+                self._shares(),
+            )
+            if admitted < len(costs) and not wait:
+                wait = in_flight_poll  # Out of in-flight slots
+            if whole and admitted < len(costs):
+                admitted = 0  # All or nothing
+            if admitted:
+                state.calls, state.tokens = calls, tokens
+                self._reserve(windows, admitted, tenant)
+                self._deadline = reservation_deadline(
+                    self.algorithm, tokens, self.period
                 )
-                if self.current_calls == 1:
-                    self.redis.expire(f"{self.model_name}_api_calls", self.period)
-                if self.current_calls <= self.max_calls:
-                    break
-                else:
-                    lock.release()  # Release the lock before sleeping
-                    time.sleep(self.period)  # wait for the limit to reset
-                    lock.acquire()
+            return admitted, wait
+
+    def _usage(self) -> Usage:
+        state = self.state
+        with state.lock:
+            return snapshot(
+                self.algorithm,
+                state.calls,
+                state.tokens,
+                time.monotonic(),
+                self.period,
+                self.max_calls,
+                self.max_tokens,
+            )
+
+    def _observe(self, observation: Observation):
+        state = self.state
+        with state.lock:
+            state.calls, state.tokens = observe_states(
+                self.algorithm,
+                state.calls,
+                state.tokens,
+                time.monotonic(),
+                self.period,
+                self.max_calls,
+                self.max_tokens,
+                observation,
+            )
+            # The budget may have grown, the head of the queue checks it again.
+            state.wake()
+
+    def _give_back(self, tokens: int, calls: int):
+        now = time.monotonic()
+        state = self.state
+        if now >= self._deadline:
+            return
+        refund = REFUND_FUNCTIONS[self.algorithm]
+        if calls > 0 and state.calls is not None:
+            state.calls = refund(state.calls, now, self.period, self.max_calls, calls)
+        if tokens > 0 and state.tokens is not None:
+            state.tokens = refund(
+                state.tokens, now, self.period, self.max_tokens, tokens
+            )
+        windows = refund_windows(
+            self.algorithm,
+            self._window_states(),
+            now,
+            self._window_limits(),
+            calls,
+            tokens,
+        )
+        for window, window_state in zip(self.windows, windows):
+            state.windows[window.period] = window_state
+        if self.tenant is not None and self.tenant in state.tenants:
+            # The counters of the tenant are refunded as one more window.
+            [tenant] = refund_windows(
+                self.algorithm,
+                [state.tenants[self.tenant]],
+                now,
+                [(self.max_calls, self.max_tokens, self.period)],
+                calls,
+                tokens,
+            )
+            state.tenants[self.tenant] = tenant
+
+    def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the window it was reserved in, and wakes the
+        waiting threads that fit in it. Nothing is credited once that window is over.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        state = self.state
+        with state.lock:
+            self._give_back(tokens, calls)
+            state.wake()
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        self.used_tokens = usage_tokens(usage)
 
+    def __enter__(self):
+        state = self.state
+        deadline = timeout_deadline(self.timeout)
+        with state.lock:
             while True:
-                self.current_tokens = self.redis.incrby(
-                    f"{self.model_name}_api_tokens", self.tokens
-                )
-                if self.current_tokens == self.tokens:
-                    self.redis.expire(f"{self.model_name}_api_tokens", self.period)
-                if self.current_tokens <= self.max_tokens:
-                    break
-                else:
-                    lock.release()  # Release the lock before sleeping
-                    time.sleep(self.period)  # wait for the limit to reset
-                    lock.acquire()
+                wait = self._enter(deadline)
+                if not wait:
+                    return self
+                # Held back by the share of its tenant, the request waits out of the
+                # queue so that the requests of the other tenants are not held back.
+                check_timeout(deadline, wait)
+                threading.Condition(state.lock).wait(backoff(wait, self.jitter))
+
+    def _enter(self, deadline: Optional[float]) -> float:
+        """
+        Admits the request in its turn, the lock of the state must be held.
+
+        Returns:
+            float: 0 once the request was admitted, or the seconds to wait of a request
+            held back by the share of its tenant, which leaves the queue.
+        """
+        state = self.state
+        # Requests only skip the queue when nobody of the same or a higher priority
+        # is waiting, so that a late arrival never takes the budget a waiting thread
+        # is queued for.
+        if not state.ahead(self.priority):
+            wait = self._admit()
+            if not wait or self._capped:
+                return wait
+            check_timeout(deadline, wait)
+        waiter = threading.Condition(state.lock)
+        entry = (self, waiter)
+        state.enqueue(entry)
+        try:
+            while True:
+                if state.waiters[0][1] is not waiter:
+                    if deadline is None:
+                        waiter.wait()
+                    elif not waiter.wait(max(deadline - time.monotonic(), 0)):
+                        raise RateLimitTimeout(self._queued_wait())
+                    continue
+                wait = self._admit()
+                if not wait or self._capped:
+                    return wait
+                check_timeout(deadline, wait)
+                waiter.wait(backoff(wait, self.jitter))
+        finally:
+            state.waiters.remove(entry)
+            # The next thread may fit in what is left.
+            state.wake()
+
+    def _queued_wait(self) -> float:
+        """
+        Predicts the wait of a request queued behind other threads, the lock of the
+        state must be held.
+        """
+        head = self.state.waiters[0][0]
+        # The requests ahead fit now when the wait is 0, this one is next.
+        return max(head._admit(dry_run=True), self._admit(dry_run=True)) or 0.001
+
+    def try_acquire(self) -> float:
+        """
+        Reserves the budget if the request fits right now, without waiting or
+        taking the budget of the threads already waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        state = self.state
+        with state.lock:
+            if state.ahead(self.priority):
+                return self._queued_wait()
+            return self._admit()
 
     def __exit__(
         self,
@@ -62,12 +884,85 @@ class Limiter:
         exc_value: Optional[BaseException],
         traceback: Optional[types.TracebackType],
     ) -> Optional[bool]:
-        pass
+        if self.used_tokens is not None:
+            if self.used_tokens < self.tokens:
+                self.refund(self.tokens - self.used_tokens)
+        elif exc_type is not None:
+            # The request failed before a response was received.
+            self.refund(self.tokens)
+        if self._in_flight:
+            self._in_flight = False
+            state = self.state
+            with state.lock:
+                state.in_flight -= 1
+                state.wake()
+
+    def release(self):
+        """
+        Releases a reservation taken with `limit_many()` instead of the context
+        manager, giving back the tokens that were not used.
+        """
+        self.__exit__(None, None, None)
+
+    def clear_locks(self) -> bool:
+        """
+        This method will clear all locks associated with the model.
+        returns True if the locks were cleared successfully, otherwise returns False.
+        """
+        # The budgets of the API keys of a pool, keyed with the key name too, are
+        # left alone.
+        with _states_lock:
+            states = [
+                (key, _states[key])
+                for key in _states
+                if len(key) == 2 and key[0] == self.model_name
+            ]
+        cleared = False
+        for key, state in states:
+            with state.lock:
+                cleared = cleared or state.calls is not None or bool(state.windows)
+                state.calls = state.tokens = None
+                state.windows = {}
+                state.tenants = {}
+                state.wake()
+        self._state = None
+        return cleared
+
+    def is_locked(self, tokens: int) -> bool:
+        """
+        This method will check if there are any locks associated with the model.
+
+        Args:
+            tokens (int): The number of tokens to be used for the check.
+
+        Returns:
+            bool: True if the lock is held, False otherwise.
+        """
+        state = self.state
+        with state.lock:
+            if state.ahead(self.priority):
+                return True
+            return self._admit(dry_run=True) > 0
 
 
 class BaseAPILimiterRedis:
     def __init__(
-        self, model_name: str, RPM: int, TPM: int, redis_instance: "redis.Redis[bytes]"
+        self,
+        model_name: str,
+        RPM: int,
+        TPM: int,
+        redis_instance: "redis.Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        check_connection: bool = True,
+        lease: Union[bool, QuotaLease] = False,
+        shared_memory: Union[bool, SharedMemoryStore] = False,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
     ):
         """
         Initializer for the BaseAPILimiterRedis class.
@@ -78,26 +973,151 @@ class BaseAPILimiterRedis:
                        OpenAI account at https://platform.openai.com/account/rate-limits
             TPM (int): The maximum number of tokens per minute allowed. You can find your rate limits in your
                        OpenAI account at https://platform.openai.com/account/rate-limits
-            redis_instance (redis.Redis[bytes]): The redis instance.
+            redis_instance (redis.Redis[bytes] | None): Optional: The redis instance. If not specified it will use in-memory caching,
+                                                        shared by the threads of the process.
+            algorithm (str): The rate limiting algorithm, "fixed" for a fixed window that starts
+                             with the first request, "sliding" for a sliding window counter or
+                             "gcra" for a token bucket (generic cell rate algorithm).
+            jitter (float): The maximum random delay in seconds added to the wait of a rejected
+                            request, so that waiting callers do not all retry at the same instant.
+            check_connection (bool): Ping the Redis server right away. Pass False to skip the round trip at
+                                     startup, `check_redis()` can be called later instead. Ignored for
+                                     in-memory caching.
+            lease (bool | QuotaLease): Reserve blocks of calls and tokens from Redis and admit requests
+                                       from them locally, without a round trip per request. Pass a
+                                       QuotaLease to tune the size of the blocks. Call `close()` on
+                                       shutdown to give the unused part back. Ignored for in-memory caching.
+            shared_memory (bool | SharedMemoryStore): Without a redis instance, keep the budget in a memory
+                                                      mapped file shared by every process of the host instead
+                                                      of the memory of this process. Pass a SharedMemoryStore
+                                                      to choose the file.
+            namespace (str | None): The prefix of the Redis keys, "openai_ratelimiter" by default. The keys
+                                    of a model share a hash tag so that they live in one Redis Cluster slot.
+            shards (int): Split the budget of the model into this many parts kept in different slots, so
+                          that a very hot model spreads its load over the nodes of a Redis Cluster. A
+                          request that does not fit in its part tries the other parts, the parts are
+                          never rebalanced and a single request is capped at `max_calls` and
+                          `max_tokens` divided by `shards`. Cannot be used with `lease`.
+            windows (Sequence[Window]): Extra limits of the budget over other periods, such as
+                                        `Window(86400, calls=10000)` for 10,000 requests per day.
+                                        Every window is checked and reserved with the RPM and TPM
+                                        in one atomic step.
+            max_in_flight (int | None): The maximum number of requests in flight at once, a slot
+                                        being held from admission until the context manager exits.
+                                        Cannot be used with `lease`.
+            priorities (Sequence[float]): The part of the budget each priority may fill, from
+                                          priority 0 (the highest) down, such as `(1.0, 0.6)` for
+                                          batch requests of priority 1 leaving 40% of the budget to
+                                          the others. Cannot be used with `lease`.
+            tenants (Sequence[Tenant]): The tenants sharing the budget, in proportion to their
+                                        weights and each with its minimum kept free for it.
+                                        Cannot be used with `lease`.
 
         Creates an instance of the BaseAPILimiterRedis with the specified parameters, and connects to a Redis server
-        at the specified host and port.
+        at the specified host and port. The encoder of the model is loaded on first use.
         """
         self.model_name = model_name
         self.max_calls = RPM
         self.max_tokens = TPM
         self.period = period
         self.redis = redis_instance
+        self.algorithm = check_algorithm(algorithm)
+        self.jitter = jitter
+        self.lease = QuotaLease() if lease is True else lease or None
+        self.shared_memory = (
+            SharedMemoryStore() if shared_memory is True else shared_memory or None
+        )
+        self.namespace = namespace
+        self.shards = check_shards(shards, self.lease is not None)
+        self.windows = check_limits(windows, max_in_flight, self.lease is not None)
+        self.max_in_flight = max_in_flight
+        self.priorities, self.tenants = check_shares(
+            priorities, tenants, RPM, TPM, self.lease is not None
+        )
+        self._encoder: "Optional[Encoding]" = None
+        self._snapshot: Optional[Tuple[float, Usage]] = None
+        if check_connection and self.redis:
+            self.check_redis()
+
+    @property
+    def encoder(self) -> "Optional[Encoding]":
+        """The encoder of the model, None if tiktoken does not know the model."""
+        if self._encoder is None:
+            self._encoder = get_encoder(self.model_name)
+        return self._encoder
+
+    @encoder.setter
+    def encoder(self, encoder: "Optional[Encoding]"):
+        self._encoder = encoder
+
+    def check_redis(self) -> bool:
+        """
+        Pings the Redis server.
+        returns True if the server answered, raises ConnectionError otherwise.
+        Returns False when using in-memory caching.
+        """
+        if not self.redis:
+            return False
+        from redis import ConnectionError as RedisConnectionError
+
         try:
             assert self.redis.ping() == True
-        except (redis.ConnectionError, AssertionError) as e:
+        except (RedisConnectionError, AssertionError) as e:
             raise ConnectionError(f"Redis server is not running.", e)
-        try:
-            self.encoder = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            self.encoder = None
+        return True
 
-    def _limit(self, tokens: int):
+    def _check_shard_fit(self, tokens: int):
+        """Rejects a request that no shard of a sharded budget could ever admit."""
+        check_shard_fit(
+            tokens,
+            [self.max_tokens, *(window.tokens for window in self.windows)],
+            self.shards,
+        )
+
+    def _limit(
+        self,
+        tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> Union[Limiter, MemoryLimiter, SharedMemoryLimiter]:
+        if self.redis:
+            self._check_shard_fit(tokens)
+        if not self.redis and self.shared_memory is not None:
+            return SharedMemoryLimiter(
+                self.model_name,
+                self.max_calls,
+                self.max_tokens,
+                self.period,
+                tokens,
+                self.shared_memory,
+                self.algorithm,
+                self.jitter,
+                self.windows,
+                self.max_in_flight,
+                timeout,
+                self.priorities,
+                self.tenants,
+                priority,
+                tenant,
+            )
+        if not self.redis:
+            return MemoryLimiter(
+                self.model_name,
+                self.max_calls,
+                self.max_tokens,
+                self.period,
+                tokens,
+                self.algorithm,
+                self.jitter,
+                self.windows,
+                self.max_in_flight,
+                timeout,
+                self.priorities,
+                self.tenants,
+                priority,
+                tenant,
+            )
         return Limiter(
             self.model_name,
             self.max_calls,
@@ -105,18 +1125,141 @@ class BaseAPILimiterRedis:
             self.period,
             tokens,
             self.redis,
+            self.algorithm,
+            self.jitter,
+            self.lease,
+            self.namespace,
+            self.shards,
+            self.windows,
+            self.max_in_flight,
+            timeout,
+            self.priorities,
+            self.tenants,
+            priority,
+            tenant,
         )
 
-    def clear_locks(self) -> bool:
+    def _limit_many(
+        self,
+        costs: List[int],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+        whole: bool = False,
+    ) -> BatchAdmission:
+        if not costs:
+            return BatchAdmission([], 0.0)
+        if self.redis:
+            for tokens in costs:
+                self._check_shard_fit(tokens)
+        first = self._limit(costs[0], None, priority, tenant)
+        admitted, wait = first._admit_batch(costs, whole)
+        if not admitted:
+            return BatchAdmission([], wait)
+        limiters = [first] + [
+            self._limit(tokens, None, priority, tenant) for tokens in costs[1:admitted]
+        ]
+        prefix = getattr(first, "_member", None)
+        for i, limiter in enumerate(limiters):
+            limiter._deadline = first._deadline
+            limiter._in_flight = first._in_flight
+            if isinstance(limiter, Limiter):
+                assert isinstance(first, Limiter)
+                limiter.shard = first.shard
+                # The batch script names the in-flight requests after the first one.
+                limiter._member = f"{prefix}:{i + 1}"
+        return BatchAdmission(limiters, wait)
+
+    def _acquire_whole(
+        self,
+        costs: List[int],
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> List[Union[Limiter, MemoryLimiter, SharedMemoryLimiter]]:
+        """
+        Waits until a batch of requests fits in the budget as a whole, then reserves
+        all of them in one admission, so that nothing is held while it waits.
+
+        Args:
+            costs (List[int]): The tokens of each request.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the requests, 0 being the highest.
+            tenant (str | None): The tenant whose share the requests are counted in.
+
+        Returns:
+            List[Limiter]: The reservations, to be released with `release()`.
+        """
+        max_calls = shard_limit(self.max_calls, self.shards, 0)
+        if len(costs) > max_calls:
+            raise ValueError(
+                f"The {len(costs)} requests exceed the {max_calls} calls of the budget."
+            )
+        deadline = timeout_deadline(timeout)
+        while True:
+            admitted, wait = self._limit_many(costs, priority, tenant, whole=True)
+            if admitted:
+                return admitted
+            check_timeout(deadline, wait)
+            time.sleep(backoff(wait, self.jitter))
+
+    def update_from_headers(self, headers: Mapping[str, Any]):
+        """
+        Corrects the state of the budget with the rate limit headers of an OpenAI
+        response: the `x-ratelimit-remaining-*` and `x-ratelimit-reset-*` headers
+        replace the usage with the one the API sees, including the requests of other
+        services sharing the organization, and the `retry-after` of a 429 holds the
+        budget until it passes.
+
+        Args:
+            headers (Mapping[str, str]): The headers of the response, `response.headers`
+                                         of the OpenAI client or of the raised `APIStatusError`.
+        """
+        observation = observe(headers, self.max_calls, self.max_tokens)
+        if observation is not None:
+            self._limit(0)._observe(observation)
+            self._snapshot = None
+
+    def close(self):
+        """
+        Gives the unused part of the local lease back to the shared budget.
+        """
+        if self.redis and self.lease is not None:
+            limiter = self._limit(0)
+            assert isinstance(limiter, Limiter)
+            limiter._give_back(*self.lease.drain())
+
+    def clear_locks(self, scan: bool = False) -> bool:
         """
         This method will clear all locks associated with the model.
         returns True if the locks were cleared successfully, otherwise returns False.
+
+        Args:
+            scan (bool): Also look for keys of the model with an incremental SCAN, such as
+                         keys left by earlier versions. The known keys of the model are
+                         deleted in a single call either way.
         """
-        keys_to_delete = self.redis.keys(f"{self.model_name}_*")
-        if keys_to_delete:
-            self.redis.delete(*keys_to_delete)
-            return True
-        return False
+        if not self.redis:
+            limiter = self._limit(0)
+            assert not isinstance(limiter, Limiter)
+            return limiter.clear_locks()
+        if self.lease is not None:
+            self.lease.drain()
+        deleted = self.redis.delete(
+            *model_keys(
+                self.model_name,
+                self.namespace,
+                self.shards,
+                [window.period for window in self.windows],
+                [tenant.name for tenant in self.tenants],
+            )
+        )
+        if scan:
+            for pattern in scan_patterns(self.model_name, self.namespace):
+                keys_to_delete = list(self.redis.scan_iter(match=pattern, count=1000))
+                if keys_to_delete:
+                    deleted += self.redis.delete(*keys_to_delete)
+        return deleted > 0
 
     def _is_locked(self, tokens: int) -> bool:
         """
@@ -128,17 +1271,27 @@ class BaseAPILimiterRedis:
         Returns:
             bool: True if the lock is held, False otherwise.
         """
-        api_calls_key_exists = self.redis.exists(f"{self.model_name}_api_calls")
-        api_tokens_key_exists = self.redis.exists(f"{self.model_name}_api_tokens")
-
-        # If both keys exist and their values exceed the allowed limits, return True
-        if api_calls_key_exists and api_tokens_key_exists:
-            current_calls = int((self.redis.get(f"{self.model_name}_api_calls")))  # type: ignore
-            current_tokens = int((self.redis.get(f"{self.model_name}_api_tokens")))  # type: ignore
-            if (
-                current_calls >= self.max_calls
-                or current_tokens + tokens > self.max_tokens
-            ):
-                return True
+        limiter = self._limit(tokens)
+        if not isinstance(limiter, Limiter):
+            return limiter.is_locked(tokens)
+        return limiter._admit(dry_run=True) > 0
+
+    def usage(self, max_age: float = 0.0) -> Usage:
+        """
+        Returns the usage of the budget of the model, read in a single round trip.
 
-        return False
+        Args:
+            max_age (float): Reuse the last snapshot if it was taken less than `max_age`
+                             seconds ago, for callers polling the usage frequently.
+
+        Returns:
+            Usage: The calls and tokens used, the calls and tokens remaining and the
+            seconds until the whole budget is available again.
+        """
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._snapshot[0] < max_age:
+            taken_at, usage = self._snapshot
+            return usage._replace(reset=max(usage.reset - (now - taken_at), 0.0))
+        usage = self._limit(0)._usage()
+        self._snapshot = (now, usage)
+        return usage
@@ -0,0 +1,402 @@
+import types
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
+
+from .base import BaseAPILimiterRedis, Limiter, MemoryLimiter
+from .shm import SharedMemoryLimiter
+from .tokens import (
+    count_tokens,
+    num_tokens_consumed_by_chat_request,
+    num_tokens_consumed_by_completion_request,
+)
+from .usage import usage_tokens
+
+if TYPE_CHECKING:
+    import openai
+    from tiktoken.core import Encoding
+
+Reservation = Union[Limiter, MemoryLimiter, SharedMemoryLimiter]
+
+# The completion tokens reserved for a chat request without `max_tokens`, the chat
+# API has no default limit. Legacy completions default to 16 tokens.
+default_max_tokens = 1024
+completion_max_tokens = 16
+
+
+def text_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """
+    Returns the messages with only their text fields, the ones the token count
+    knows how to count.
+
+    Args:
+        messages (List[Dict[str, Any]]): The messages of a chat request.
+
+    Returns:
+        List[Dict[str, str]]: The messages.
+    """
+    return [
+        {key: value for key, value in message.items() if isinstance(value, str)}
+        for message in messages
+    ]
+
+
+def requested_max_tokens(kwargs: Dict[str, Any], default: int) -> int:
+    """
+    Returns the completion tokens a request may use.
+
+    Args:
+        kwargs (Dict[str, Any]): The arguments of the `create()` call.
+        default (int): The tokens to reserve when the request does not set a limit.
+
+    Returns:
+        int: The maximum number of completion tokens.
+    """
+    for key in ("max_completion_tokens", "max_tokens"):
+        if kwargs.get(key) is not None:
+            return kwargs[key]
+    return default
+
+
+def chunk_text(chunk: Any) -> str:
+    """
+    Returns the generated text of a streamed chunk, from a chat completion or a
+    legacy completion.
+
+    Args:
+        chunk (Any): The chunk.
+
+    Returns:
+        str: The text, empty if the chunk holds none.
+    """
+    texts = []
+    for choice in getattr(chunk, "choices", None) or []:
+        delta = getattr(choice, "delta", None)
+        if delta is None:
+            texts.append(getattr(choice, "text", None) or "")
+            continue
+        texts.append(getattr(delta, "content", None) or "")
+        for tool_call in getattr(delta, "tool_calls", None) or []:
+            function = getattr(tool_call, "function", None)
+            texts.append(getattr(function, "arguments", None) or "")
+    return "".join(texts)
+
+
+def send(resource: Any, method: str, kwargs: Dict[str, Any]) -> Tuple[Any, Any]:
+    """
+    Sends a request through `with_raw_response` when the resource has it, to read
+    the rate limit headers of the response.
+
+    Args:
+        resource (Any): The resource of the OpenAI client, such as `client.chat.completions`.
+        method (str): The name of the method.
+        kwargs (Dict[str, Any]): The arguments of the method.
+
+    Returns:
+        Tuple[Any, Any]: The parsed response and its headers, None if they cannot be read.
+    """
+    raw = getattr(resource, "with_raw_response", None)
+    if raw is None:
+        return getattr(resource, method)(**kwargs), None
+    response = getattr(raw, method)(**kwargs)
+    return response.parse(), response.headers
+
+
+def error_headers(error: BaseException) -> Any:
+    """Returns the headers of the response of an `APIStatusError`, None for other errors."""
+    return getattr(getattr(error, "response", None), "headers", None)
+
+
+def update_from_error(limiter: BaseAPILimiterRedis, error: BaseException):
+    """Corrects the budget with the headers of a failed request, such as a 429."""
+    headers = error_headers(error)
+    if headers is not None:
+        limiter.update_from_headers(headers)
+
+
+class StreamCounter:
+    """
+    Counts the tokens of a streamed response as its chunks arrive. The `usage` of
+    the last chunk, sent when the request sets `stream_options={"include_usage": True}`,
+    replaces the count.
+    """
+
+    def __init__(self, prompt_tokens: int, encoder: "Optional[Encoding]"):
+        self.prompt_tokens = prompt_tokens
+        self.encoder = encoder
+        self.completion_tokens = 0
+        self.usage: Optional[int] = None
+
+    def add(self, chunk: Any):
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            self.usage = usage_tokens(usage)
+        text = chunk_text(chunk)
+        if text:
+            self.completion_tokens += (
+                count_tokens(text, self.encoder, cache=None) if self.encoder else 1
+            )
+
+    @property
+    def tokens(self) -> int:
+        """The tokens used by the response so far."""
+        if self.usage is not None:
+            return self.usage
+        return self.prompt_tokens + self.completion_tokens
+
+
+class LimitedStream:
+    """
+    A streamed response holding its reservation until it is consumed or closed.
+    Iterate it like the stream of the OpenAI client, the unused tokens are given
+    back at the end.
+    """
+
+    def __init__(self, stream: Any, reservation: Reservation, counter: StreamCounter):
+        self.stream = stream
+        self.reservation = reservation
+        self.counter = counter
+        self._released = False
+
+    def __iter__(self) -> Iterator[Any]:
+        try:
+            for chunk in self.stream:
+                self.counter.add(chunk)
+                yield chunk
+        except BaseException as e:
+            self._release(type(e), e, e.__traceback__)
+            raise
+        self._release(None, None, None)
+
+    def _release(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ):
+        if self._released:
+            return
+        self._released = True
+        self.reservation.record_usage(self.counter.tokens)
+        self.reservation.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        """Closes the response and releases the reservation."""
+        try:
+            self.stream.close()
+        finally:
+            self._release(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ):
+        self.close()
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.stream, name)
+
+
+class _ChatCompletions:
+    def __init__(self, client: "RateLimitedOpenAI"):
+        self._client = client
+
+    def create(self, **kwargs: Any) -> Any:
+        """
+        Creates a chat completion once it fits in the budget of its model.
+        Takes the arguments of `client.chat.completions.create()`.
+        """
+        limiter = self._client._limiter(kwargs["model"])
+        if not limiter.encoder:
+            raise ValueError("The encoder is not set.")
+        max_tokens = requested_max_tokens(kwargs, self._client.max_tokens)
+        n = kwargs.get("n") or 1
+        tokens = num_tokens_consumed_by_chat_request(
+            text_messages(kwargs["messages"]), limiter.encoder, max_tokens, n
+        )
+        return self._client._call(
+            limiter,
+            limiter._limit(
+                tokens,
+                self._client.wait_timeout,
+                self._client.priority,
+                self._client.tenant,
+            ),
+            tokens - n * max_tokens,
+            self._client.client.chat.completions,
+            kwargs,
+        )
+
+
+class _Chat:
+    def __init__(self, client: "RateLimitedOpenAI"):
+        self.completions = _ChatCompletions(client)
+
+
+class _Completions:
+    def __init__(self, client: "RateLimitedOpenAI"):
+        self._client = client
+
+    def create(self, **kwargs: Any) -> Any:
+        """
+        Creates a completion once it fits in the budget of its model.
+        Takes the arguments of `client.completions.create()`.
+        """
+        limiter = self._client._limiter(kwargs["model"])
+        if not limiter.encoder:
+            raise ValueError("The encoder is not set.")
+        max_tokens = requested_max_tokens(kwargs, completion_max_tokens)
+        n = kwargs.get("n") or 1
+        tokens = num_tokens_consumed_by_completion_request(
+            kwargs["prompt"], limiter.encoder, max_tokens, n
+        )
+        prompts = len(kwargs["prompt"]) if isinstance(kwargs["prompt"], list) else 1
+        return self._client._call(
+            limiter,
+            limiter._limit(
+                tokens,
+                self._client.wait_timeout,
+                self._client.priority,
+                self._client.tenant,
+            ),
+            tokens - prompts * n * max_tokens,
+            self._client.client.completions,
+            kwargs,
+        )
+
+
+class _Images:
+    def __init__(self, client: "RateLimitedOpenAI"):
+        self._client = client
+
+    def generate(self, **kwargs: Any) -> Any:
+        """
+        Generates images once they fit in the budget of their model, one call of the
+        budget per image. Takes the arguments of `client.images.generate()`.
+        """
+        limiter = self._client._limiter(kwargs.get("model") or "dall-e-2")
+        # The images are reserved together, a request never holds some of them
+        # while it waits for the others.
+        entered = limiter._acquire_whole(
+            [0] * (kwargs.get("n") or 1),
+            self._client.wait_timeout,
+            self._client.priority,
+            self._client.tenant,
+        )
+        try:
+            response, headers = send(self._client.client.images, "generate", kwargs)
+        except BaseException as e:
+            for reservation in entered:
+                reservation.__exit__(type(e), e, e.__traceback__)
+            update_from_error(limiter, e)
+            raise
+        for reservation in entered:
+            reservation.release()
+        if headers is not None:
+            limiter.update_from_headers(headers)
+        return response
+
+
+class RateLimitedOpenAI:
+    """
+    An `openai.OpenAI` client whose chat completions, completions and image
+    generations wait for the budget of their model.
+
+    The tokens of a request are counted and reserved before it is sent, then the
+    reservation is reconciled with the `usage` of the response, or with the tokens
+    of a streamed response counted as its chunks arrive, and the unused part is
+    given back right away. A request that fails gives its tokens back.
+    Every other attribute is the one of the wrapped client.
+    """
+
+    def __init__(
+        self,
+        limiters: List[BaseAPILimiterRedis],
+        client: "Optional[openai.OpenAI]" = None,
+        max_tokens: Optional[int] = None,
+        wait_timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
+        """
+        Args:
+            limiters (List[BaseAPILimiterRedis]): The limiters of the models, for instance a
+                                                  ChatCompletionLimiter per chat model and a
+                                                  DalleLimiter per image model.
+            client (openai.OpenAI | None): The client sending the requests, by default
+                                           `openai.OpenAI()` configured from the environment.
+            max_tokens (int | None): The completion tokens reserved for a chat request without
+                                     `max_tokens`, defaults to `default_max_tokens`.
+            wait_timeout (float | None): The seconds a request waits for the budget before raising
+                                         RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the requests, 0 being the highest.
+            tenant (str | None): The tenant whose share the requests are counted in.
+        """
+        if client is None:
+            import openai
+
+            client = openai.OpenAI()
+        self.client = client
+        self.limiters = {limiter.model_name: limiter for limiter in limiters}
+        self.max_tokens = default_max_tokens if max_tokens is None else max_tokens
+        self.wait_timeout = wait_timeout
+        self.priority = priority
+        self.tenant = tenant
+        self.chat = _Chat(self)
+        self.completions = _Completions(self)
+        self.images = _Images(self)
+
+    def _limiter(self, model_name: str) -> BaseAPILimiterRedis:
+        try:
+            return self.limiters[model_name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown model {model_name!r}, pass a limiter for it to the client."
+            ) from None
+
+    def _call(
+        self,
+        limiter: BaseAPILimiterRedis,
+        reservation: Reservation,
+        prompt_tokens: int,
+        resource: Any,
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        reservation.__enter__()
+        try:
+            response, headers = send(resource, "create", kwargs)
+        except BaseException as e:
+            reservation.__exit__(type(e), e, e.__traceback__)
+            update_from_error(limiter, e)
+            raise
+        if kwargs.get("stream"):
+            if headers is not None:
+                limiter.update_from_headers(headers)
+            return LimitedStream(
+                response, reservation, StreamCounter(prompt_tokens, limiter.encoder)
+            )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            reservation.record_usage(usage)
+        reservation.release()
+        # The headers count the tokens of the response, the unused part of the
+        # reservation is given back first.
+        if headers is not None:
+            limiter.update_from_headers(headers)
+        return response
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
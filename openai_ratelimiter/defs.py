@@ -1,67 +1,67 @@
-from typing import Any, Dict, List, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Union
 
-from redis import Redis
-from tiktoken.core import Encoding
+from .base import BaseAPILimiterRedis, BatchAdmission
+from .limits import Tenant, Window
+from .shm import SharedMemoryStore
+from .tokens import (
+    num_tokens_consumed_by_chat_request,
+    num_tokens_consumed_by_chat_requests,
+    num_tokens_consumed_by_completion_request,
+    num_tokens_consumed_by_completion_requests,
+)
 
-from .base import BaseAPILimiterRedis
-
-
-def num_tokens_consumed_by_chat_request(
-    messages: List[Dict[str, str]],
-    encoder: Encoding,
-    max_tokens: int = 15,
-    n: int = 1,
-):
-    num_tokens = n * max_tokens
-    for message in messages:
-        num_tokens += (
-            4  # Every message follows <im_start>{role/name}\n{content}<im_end>\n
-        )
-        for key, value in message.items():
-            num_tokens += len(encoder.encode(value))
-
-            if key == "name":  # If there's a name, the role is omitted
-                num_tokens -= 1
-
-    num_tokens += 2  # Every reply is primed with <im_start>assistant
-
-    return num_tokens
-
-
-def num_tokens_consumed_by_completion_request(
-    prompt: Union[str, list[str], Any],
-    encoder: Encoding,
-    max_tokens: int = 15,
-    n: int = 1,
-):
-    num_tokens = n * max_tokens
-    if isinstance(prompt, str):  # Single prompt
-        num_tokens += len(encoder.encode(prompt))
-    elif isinstance(prompt, list):  # Multiple prompts
-        num_tokens *= len(prompt)
-        num_tokens += sum([len([encoder.encode(p) for p in prompt])])
-    else:
-        raise TypeError(
-            "Either a string or list of strings expected for 'prompt' field in completion request."
-        )
-
-    return num_tokens
+if TYPE_CHECKING:
+    from redis import Redis
 
 
 class ChatCompletionLimiter(BaseAPILimiterRedis):
-    def limit(self, messages: List[Dict[str, str]], max_tokens: int):
+    def limit(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
         """
         Limits the number of tokens consumed by the chat request.
         Args:
             messages (List[Dict[str, str]]): The list of messages in the chat request.
             max_tokens (int): The maximum number of tokens allowed.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
         Returns:
             Limiter: Limiter class to be used in the context manager.
         """
         if not self.encoder:
             raise ValueError("The encoder is not set.")
         tokens = num_tokens_consumed_by_chat_request(messages, self.encoder, max_tokens)
-        return self._limit(tokens)
+        return self._limit(tokens, timeout, priority, tenant)
+
+    def limit_many(
+        self,
+        requests: List[Dict[str, Any]],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> BatchAdmission:
+        """
+        Reserves the budget of as many chat requests as fit right now, in order, with
+        a single admission.
+        Args:
+            requests (List[Dict[str, Any]]): The requests, each with its `messages` and
+                                             optionally its `max_tokens` and `n`.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests, to be released with
+            `limiter.release()`, and the seconds to wait before the next one fits.
+        """
+        if not self.encoder:
+            raise ValueError("The encoder is not set.")
+        tokens = num_tokens_consumed_by_chat_requests(requests, self.encoder)
+        return self._limit_many(tokens, priority, tenant)
 
     def is_locked(self, messages: List[Dict[str, str]], max_tokens: int) -> bool:
         """Returns True if the request would be locked, False otherwise."""
@@ -72,13 +72,43 @@ class ChatCompletionLimiter(BaseAPILimiterRedis):
 
 
 class TextCompletionLimiter(BaseAPILimiterRedis):
-    def limit(self, prompt: str, max_tokens: int):
+    def limit(
+        self,
+        prompt: str,
+        max_tokens: int,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
         if not self.encoder:
             raise ValueError("The encoder is not set.")
         tokens = num_tokens_consumed_by_completion_request(
             prompt, self.encoder, max_tokens
         )
-        return self._limit(tokens)
+        return self._limit(tokens, timeout, priority, tenant)
+
+    def limit_many(
+        self,
+        requests: List[Dict[str, Any]],
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ) -> BatchAdmission:
+        """
+        Reserves the budget of as many completion requests as fit right now, in
+        order, with a single admission.
+        Args:
+            requests (List[Dict[str, Any]]): The requests, each with its `prompt` and
+                                             optionally its `max_tokens` and `n`.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests, to be released with
+            `limiter.release()`, and the seconds to wait before the next one fits.
+        """
+        if not self.encoder:
+            raise ValueError("The encoder is not set.")
+        tokens = num_tokens_consumed_by_completion_requests(requests, self.encoder)
+        return self._limit_many(tokens, priority, tenant)
 
     def is_locked(self, prompt: str, max_tokens: int) -> bool:
         if not self.encoder:
@@ -90,28 +120,96 @@ class TextCompletionLimiter(BaseAPILimiterRedis):
 
 
 class DalleLimiter(BaseAPILimiterRedis):
-    def __init__(self, model_name: str, IPM: int, redis_instance: "Redis[bytes]"):
+    def __init__(
+        self,
+        model_name: str,
+        IPM: int,
+        redis_instance: "Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        check_connection: bool = True,
+        shared_memory: Union[bool, SharedMemoryStore] = False,
+        namespace: Optional[str] = None,
+        shards: int = 1,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+    ):
         """
         Initializes an instance of the class.
 
         Args:
             model_name (str): The name of the model (dall-e-2 or dall-e-3).
             IPM (int): The maximum number of images per minute.
-            redis_instance (Redis[bytes]): An instance of the Redis client.
+            redis_instance (Redis[bytes] | None): An instance of the Redis client, None for in-memory caching.
+            algorithm (str): The rate limiting algorithm ("fixed", "sliding" or "gcra").
+            jitter (float): The maximum random delay in seconds added to the wait of a rejected request.
+            check_connection (bool): Ping the Redis server right away.
+            shared_memory (bool | SharedMemoryStore): Without a redis instance, share the budget with
+                                                      every process of the host through a memory mapped file.
+            namespace (str | None): The prefix of the Redis keys.
+            shards (int): The number of parts the budget is split into across Redis Cluster slots. The
+                          parts are not rebalanced, a single request is capped at the limits divided by `shards`.
+            windows (Sequence[Window]): Extra limits over other periods, such as images per day.
+            max_in_flight (int | None): The maximum number of requests in flight at once.
+            priorities (Sequence[float]): The part of the budget each priority may fill, 0 being the highest.
+            tenants (Sequence[Tenant]): The tenants sharing the budget.
 
 
         """
         """"""
-        super().__init__(model_name, IPM, 1, redis_instance)
+        super().__init__(
+            model_name,
+            IPM,
+            1,
+            redis_instance,
+            algorithm,
+            jitter,
+            check_connection=check_connection,
+            shared_memory=shared_memory,
+            namespace=namespace,
+            shards=shards,
+            windows=windows,
+            max_in_flight=max_in_flight,
+            priorities=priorities,
+            tenants=tenants,
+        )
 
-    def limit(self):
+    def limit(
+        self,
+        timeout: Optional[float] = None,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
         """
         Limits the rate of API requests.
+        Args:
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
         Returns:
             Limiter: Limiter class to be used in the context manager.
         """
 
-        return self._limit(0)
+        return self._limit(0, timeout, priority, tenant)
+
+    def limit_many(
+        self, count: int, priority: int = 0, tenant: Optional[str] = None
+    ) -> BatchAdmission:
+        """
+        Reserves as many of `count` image requests as fit right now with a single
+        admission.
+        Args:
+            count (int): The number of image requests to reserve.
+            priority (int): The priority of the request, 0 being the highest.
+            tenant (str | None): The tenant whose share the request is counted in.
+        Returns:
+            BatchAdmission: The reservations of the admitted requests and the seconds
+            to wait before the next one fits.
+        """
+        return self._limit_many([0] * count, priority, tenant)
 
     def is_locked(self) -> bool:
         """Returns True if the request would be locked, False otherwise."""
@@ -0,0 +1,144 @@
+import re
+from typing import Any, Mapping, NamedTuple, Optional
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a duration of the rate limit headers, such as "6m0s", "1.5s" or "20ms".
+    A bare number is a number of seconds, as in `retry-after`.
+
+    Args:
+        value (str | None): The header value.
+
+    Returns:
+        float | None: The duration in seconds, None if the value is missing or invalid.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None  # Such as the HTTP-date form of `retry-after`
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimitHeaders(NamedTuple):
+    """The rate limit headers of an OpenAI response, None for the missing ones."""
+
+    remaining_requests: Optional[int]
+    remaining_tokens: Optional[int]
+    # The seconds until each budget is whole again.
+    reset_requests: Optional[float]
+    reset_tokens: Optional[float]
+    # The seconds to wait before retrying a rejected request.
+    retry_after: Optional[float]
+
+
+def parse_headers(headers: Mapping[str, Any]) -> RateLimitHeaders:
+    """
+    Reads the `x-ratelimit-remaining-*`, `x-ratelimit-reset-*` and `retry-after`
+    headers of an OpenAI response.
+
+    Args:
+        headers (Mapping[str, str]): The headers, `response.headers` of the OpenAI client.
+
+    Returns:
+        RateLimitHeaders: The parsed values.
+    """
+    get = {str(key).lower(): str(value) for key, value in headers.items()}.get
+    retry_after_ms = parse_duration(get("retry-after-ms"))
+    return RateLimitHeaders(
+        _parse_int(get("x-ratelimit-remaining-requests")),
+        _parse_int(get("x-ratelimit-remaining-tokens")),
+        parse_duration(get("x-ratelimit-reset-requests")),
+        parse_duration(get("x-ratelimit-reset-tokens")),
+        (
+            retry_after_ms / 1000
+            if retry_after_ms is not None
+            else parse_duration(get("retry-after"))
+        ),
+    )
+
+
+class Observation(NamedTuple):
+    """The usage of a budget reported by the API."""
+
+    # The calls and tokens used, None if unknown.
+    calls: Optional[int]
+    tokens: Optional[int]
+    # The seconds until each budget is whole again, -1 if unknown.
+    calls_reset: float
+    tokens_reset: float
+
+    def share(
+        self, max_calls: int, max_tokens: int, shard_calls: int, shard_tokens: int
+    ) -> "Observation":
+        """
+        Returns the part of the usage falling to a shard of the budget.
+
+        Args:
+            max_calls (int): The call budget of the whole budget.
+            max_tokens (int): The token budget of the whole budget.
+            shard_calls (int): The call budget of the shard.
+            shard_tokens (int): The token budget of the shard.
+
+        Returns:
+            Observation: The usage of the shard.
+        """
+        calls, tokens = self.calls, self.tokens
+        if calls is not None and max_calls > 0:
+            calls = round(calls * shard_calls / max_calls)
+        if tokens is not None and max_tokens > 0:
+            tokens = round(tokens * shard_tokens / max_tokens)
+        return self._replace(calls=calls, tokens=tokens)
+
+
+def observe(
+    headers: Mapping[str, Any], max_calls: int, max_tokens: int
+) -> Optional[Observation]:
+    """
+    Turns the rate limit headers of a response into the usage of a budget. The API
+    reports the budget left to the whole organization, which other services may
+    share, so the usage is what the budget lacks to reach it. A `retry-after`
+    exhausts the budget until it passes.
+
+    Args:
+        headers (Mapping[str, str]): The headers of the response.
+        max_calls (int): The call budget of the limiter.
+        max_tokens (int): The token budget of the limiter.
+
+    Returns:
+        Observation | None: The usage, None if the headers hold no rate limit information.
+    """
+    parsed = parse_headers(headers)
+    if parsed.retry_after is not None:
+        return Observation(
+            max_calls, max_tokens, parsed.retry_after, parsed.retry_after
+        )
+    calls = tokens = None
+    if parsed.remaining_requests is not None:
+        calls = max(max_calls - parsed.remaining_requests, 0)
+    if parsed.remaining_tokens is not None:
+        tokens = max(max_tokens - parsed.remaining_tokens, 0)
+    if calls is None and tokens is None:
+        return None
+    return Observation(
+        calls,
+        tokens,
+        -1.0 if parsed.reset_requests is None else parsed.reset_requests,
+        -1.0 if parsed.reset_tokens is None else parsed.reset_tokens,
+    )
@@ -0,0 +1,210 @@
+import re
+from typing import List, Optional, Sequence
+
+from .algorithms import ALGORITHMS
+
+# The prefix of every Redis key written by the limiters, unless a limiter is given
+# its own namespace.
+default_namespace = "openai_ratelimiter"
+
+
+def model_key(
+    model_name: str,
+    name: str,
+    namespace: Optional[str] = None,
+    shard: Optional[int] = None,
+) -> str:
+    """
+    Returns the Redis key of a counter of the model. The model name, and the shard
+    of a sharded budget, is a hash tag: every key of a model (or of one of its
+    shards) lands in the same Redis Cluster slot.
+
+    Args:
+        model_name (str): The name of the model.
+        name (str): The name of the counter.
+        namespace (str | None): The prefix of the key, defaults to `default_namespace`.
+        shard (int | None): The shard of a sharded budget, None if it is not sharded.
+
+    Returns:
+        str: The key, `{namespace}:{{model_name}}:{name}` or
+        `{namespace}:{{model_name}:{shard}}:{name}`.
+    """
+    tag = model_name if shard is None else f"{model_name}:{shard}"
+    return f"{namespace or default_namespace}:{{{tag}}}:{name}"
+
+
+def limiter_keys(
+    model_name: str,
+    algorithm: str,
+    namespace: Optional[str] = None,
+    shard: Optional[int] = None,
+    period: Optional[float] = None,
+    tenant: Optional[str] = None,
+) -> List[str]:
+    """
+    Returns the calls and tokens keys of the model for the algorithm.
+
+    Args:
+        model_name (str): The name of the model.
+        algorithm (str): The rate limiting algorithm.
+        namespace (str | None): The prefix of the keys, defaults to `default_namespace`.
+        shard (int | None): The shard of a sharded budget, None if it is not sharded.
+        period (float | None): The period of an extra window of the budget, such as a
+                               daily limit, None for the main window.
+        tenant (str | None): The tenant whose part of the budget the keys count, None
+                             for the whole budget.
+
+    Returns:
+        List[str]: The api calls key and the api tokens key.
+    """
+    suffix = ALGORITHMS[algorithm]
+    if period is not None:
+        suffix = f":{period:g}{suffix}"
+    if tenant is not None:
+        suffix = f"@{tenant}{suffix}"
+    return [
+        model_key(model_name, f"api_calls{suffix}", namespace, shard),
+        model_key(model_name, f"api_tokens{suffix}", namespace, shard),
+    ]
+
+
+def key_namespace(namespace: Optional[str], key_name: str) -> str:
+    """
+    Returns the namespace of the budget of an API key of a pool. The keys of every
+    API key keep the model name as their hash tag, so that the budgets of a pool
+    live in one Redis Cluster slot and are admitted by a single script.
+
+    Args:
+        namespace (str | None): The namespace of the pool, defaults to `default_namespace`.
+        key_name (str): The name of the API key.
+
+    Returns:
+        str: The namespace, `{namespace}:{key_name}`.
+    """
+    return f"{namespace or default_namespace}:{key_name}"
+
+
+def in_flight_key(
+    model_name: str, namespace: Optional[str] = None, shard: Optional[int] = None
+) -> str:
+    """
+    Returns the key of the set of in-flight requests of the model.
+
+    Args:
+        model_name (str): The name of the model.
+        namespace (str | None): The prefix of the key, defaults to `default_namespace`.
+        shard (int | None): The shard of a sharded budget, None if it is not sharded.
+
+    Returns:
+        str: The key.
+    """
+    return model_key(model_name, "in_flight", namespace, shard)
+
+
+def model_keys(
+    model_name: str,
+    namespace: Optional[str] = None,
+    shards: int = 1,
+    periods: Sequence[float] = (),
+    tenants: Sequence[str] = (),
+) -> List[str]:
+    """
+    Returns every key the limiters may write for the model, whatever the algorithm.
+
+    Args:
+        model_name (str): The name of the model.
+        namespace (str | None): The prefix of the keys, defaults to `default_namespace`.
+        shards (int): The number of shards of the budget.
+        periods (Sequence[float]): The periods of the extra windows of the budget.
+        tenants (Sequence[str]): The names of the tenants of the budget.
+
+    Returns:
+        List[str]: The keys.
+    """
+    keys = []
+    for shard in range(shards) if shards > 1 else [None]:
+        for algorithm in ALGORITHMS:
+            for period in [None, *periods]:
+                keys += limiter_keys(model_name, algorithm, namespace, shard, period)
+            for tenant in tenants:
+                keys += limiter_keys(
+                    model_name, algorithm, namespace, shard, tenant=tenant
+                )
+        keys.append(in_flight_key(model_name, namespace, shard))
+    return keys
+
+
+def scan_patterns(model_name: str, namespace: Optional[str] = None) -> List[str]:
+    """
+    Returns the SCAN patterns matching the keys of the model, in this layout with
+    or without shards and in the `{model_name}_*` layout of earlier versions.
+
+    Args:
+        model_name (str): The name of the model.
+        namespace (str | None): The prefix of the keys, defaults to `default_namespace`.
+
+    Returns:
+        List[str]: The patterns.
+    """
+    escaped = re.sub(r"([*?\[\]\\])", r"\\\1", model_name)
+    namespace = re.sub(r"([*?\[\]\\])", r"\\\1", namespace or default_namespace)
+    return [
+        model_key(escaped, "*", namespace),
+        f"{namespace}:{{{escaped}:*}}:*",
+        f"{escaped}_api_*",
+    ]
+
+
+def shard_limit(limit: int, shards: int, shard: int) -> int:
+    """
+    Returns the share of a limit held by a shard, the remainder of the division
+    going to the first shards.
+
+    Args:
+        limit (int): The limit of the whole budget.
+        shards (int): The number of shards of the budget.
+        shard (int): The shard.
+
+    Returns:
+        int: The limit of the shard.
+    """
+    return limit // shards + (1 if shard < limit % shards else 0)
+
+
+def check_shard_fit(tokens: int, limits: Sequence[Optional[int]], shards: int):
+    """
+    Rejects a request larger than the largest shard of a token limit of a sharded
+    budget. The shards live in different Redis Cluster slots and do not lend budget
+    to each other, so no shard could ever admit it.
+
+    Args:
+        tokens (int): The tokens of the request.
+        limits (Sequence[int | None]): The token limits of the budget, None for no limit.
+        shards (int): The number of shards of the budget.
+    """
+    if shards == 1:
+        return
+    for limit in limits:
+        if limit is not None and tokens > shard_limit(limit, shards, 0):
+            raise ValueError(
+                f"The request of {tokens} tokens exceeds the {shard_limit(limit, shards, 0)} "
+                f"tokens of a shard of the budget, use fewer shards."
+            )
+
+
+def check_shards(shards: int, leased: bool = False) -> int:
+    """
+    Validates the number of shards of a budget.
+
+    Args:
+        shards (int): The number of shards, at least 1.
+        leased (bool): Whether the budget is admitted from a local lease.
+
+    Returns:
+        int: The number of shards.
+    """
+    if shards < 1:
+        raise ValueError(f"The number of shards must be at least 1, got {shards}.")
+    if shards > 1 and leased:
+        raise ValueError("A sharded budget cannot be leased.")
+    return shards
@@ -0,0 +1,136 @@
+import math
+import threading
+import time
+from typing import Tuple
+
+
+class QuotaLease:
+    """
+    A block of calls and tokens reserved from the shared Redis budget and spent
+    locally without any network round trip.
+
+    The size of the next block follows the local consumption rate: a lease covers
+    about `horizon` seconds of traffic, capped to `max_fraction` of the budget so
+    that one process cannot starve the others.
+    """
+
+    def __init__(
+        self, horizon: float = 1.0, max_fraction: float = 0.05, smoothing: float = 0.3
+    ):
+        """
+        Args:
+            horizon (float): The seconds of local traffic a lease should cover.
+            max_fraction (float): The largest share of the budget a single lease may take.
+            smoothing (float): The weight of the latest lease in the consumption rate average.
+        """
+        self.horizon = horizon
+        self.max_fraction = max_fraction
+        self.smoothing = smoothing
+        self.calls = 0
+        self.tokens = 0
+        self.deadline = 0.0
+        self.calls_rate = 0.0
+        self.tokens_rate = 0.0
+        self._granted = (0, 0)
+        self._granted_at = 0.0
+        self._lock = threading.Lock()
+
+    def take(self, tokens: int) -> Tuple[bool, float]:
+        """
+        Spends one call and the tokens from the lease.
+
+        Args:
+            tokens (int): The tokens of the request.
+
+        Returns:
+            Tuple[bool, float]: Whether the lease covered the request and the deadline
+            of the lease that covered it.
+        """
+        with self._lock:
+            if (
+                time.monotonic() < self.deadline
+                and self.calls >= 1
+                and self.tokens >= tokens
+            ):
+                self.calls -= 1
+                self.tokens -= tokens
+                return True, self.deadline
+            return False, 0.0
+
+    def give_back(self, tokens: int, calls: int, deadline: float):
+        """
+        Credits a refund to the lease, if the lease it was taken from is still the
+        current one.
+        """
+        with self._lock:
+            if deadline == self.deadline and time.monotonic() < deadline:
+                self.calls += calls
+                self.tokens += tokens
+
+    def drain(self) -> Tuple[int, int, float]:
+        """
+        Empties the lease and updates the consumption rate with what it served.
+
+        Returns:
+            Tuple[int, int, float]: The unused calls, the unused tokens and the deadline
+            of the lease.
+        """
+        with self._lock:
+            calls, tokens, deadline = self.calls, self.tokens, self.deadline
+            elapsed = time.monotonic() - self._granted_at
+            if self._granted_at and elapsed > 0:
+                granted_calls, granted_tokens = self._granted
+                self.calls_rate += self.smoothing * (
+                    (granted_calls - calls) / elapsed - self.calls_rate
+                )
+                self.tokens_rate += self.smoothing * (
+                    (granted_tokens - tokens) / elapsed - self.tokens_rate
+                )
+            self.calls = self.tokens = 0
+            self.deadline = 0.0
+            self._granted_at = 0.0
+            return calls, tokens, deadline
+
+    def size(self, tokens: int, max_calls: int, max_tokens: int) -> Tuple[int, int]:
+        """
+        Returns the size of the next lease, which always covers the current request.
+
+        Args:
+            tokens (int): The tokens of the current request.
+            max_calls (int): The call budget of the window.
+            max_tokens (int): The token budget of the window.
+
+        Returns:
+            Tuple[int, int]: The calls and tokens to reserve.
+        """
+        calls = min(
+            math.ceil(self.calls_rate * self.horizon), max_calls * self.max_fraction
+        )
+        leased_tokens = min(
+            math.ceil(self.tokens_rate * self.horizon), max_tokens * self.max_fraction
+        )
+        return max(int(calls), 1), max(int(leased_tokens), tokens)
+
+    def grant(
+        self, calls: int, tokens: int, deadline: float, spent_tokens: int
+    ) -> Tuple[int, int, float]:
+        """
+        Stores a freshly reserved block and spends the request it was reserved for.
+
+        Args:
+            calls (int): The reserved calls.
+            tokens (int): The reserved tokens.
+            deadline (float): The end of the window holding the reservation.
+            spent_tokens (int): The tokens of the request that triggered the reservation.
+
+        Returns:
+            Tuple[int, int, float]: The unused calls, tokens and deadline of a lease
+            granted concurrently and replaced by this one, to be given back.
+        """
+        with self._lock:
+            replaced = (self.calls, self.tokens, self.deadline)
+            self.calls, self.tokens = calls - 1, tokens - spent_tokens
+            self.deadline = deadline
+            self._granted = (calls, tokens)
+            self._granted_at = time.monotonic()
+            return replaced
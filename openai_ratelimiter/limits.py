@@ -0,0 +1,242 @@
+import time
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+# The seconds after which the in-flight slot of a request that was never
+# released, such as one of a process that died, is freed.
+in_flight_timeout = 600
+# The seconds between two checks of a request waiting for an in-flight slot held
+# by another process.
+in_flight_poll = 0.05
+# The seconds of waiting that make up for a request as large as the whole token
+# budget with the shortest-job-first scheduler: a waiting request goes ahead of
+# the requests larger than it by less than the part of the budget it waited for.
+sjf_aging = 60.0
+
+# The orders the waiting requests of an in-memory queue are admitted in.
+SCHEDULERS = ("fifo", "sjf")
+
+
+class Window(NamedTuple):
+    """
+    A limit of the budget of a model over a period, in addition to its RPM and TPM,
+    such as its requests and tokens per day.
+    """
+
+    # The length of the window in seconds.
+    period: float
+    # The calls and tokens allowed in the window, None for no limit.
+    calls: Optional[int] = None
+    tokens: Optional[int] = None
+
+
+def check_limits(
+    windows: Sequence[Window], max_in_flight: Optional[int], leased: bool = False
+) -> List[Window]:
+    """
+    Validates the extra windows and the in-flight limit of a budget.
+
+    Args:
+        windows (Sequence[Window]): The extra windows.
+        max_in_flight (int | None): The maximum number of requests in flight, None for no limit.
+        leased (bool): Whether the budget is admitted from a local lease.
+
+    Returns:
+        List[Window]: The windows.
+    """
+    periods = [window.period for window in windows]
+    if len(set(periods)) != len(periods):
+        raise ValueError("Two windows of a budget cannot have the same period.")
+    for window in windows:
+        if window.period <= 0:
+            raise ValueError(f"The period of a window must be positive, got {window}.")
+    if max_in_flight is not None and max_in_flight < 1:
+        raise ValueError(
+            f"The in-flight limit must be at least 1, got {max_in_flight}."
+        )
+    if leased and max_in_flight is not None:
+        raise ValueError("A leased budget cannot limit the requests in flight.")
+    return list(windows)
+
+
+def window_args(
+    max_calls: Optional[int], max_tokens: Optional[int], period: float
+) -> List[float]:
+    """
+    Returns the arguments of a window for the Redis scripts: its calls and tokens
+    limits, -1 for no limit, and its period.
+    """
+    return [
+        -1 if max_calls is None else max_calls,
+        -1 if max_tokens is None else max_tokens,
+        period,
+    ]
+
+
+class Tenant(NamedTuple):
+    """
+    A caller sharing the budget of a model with other tenants, such as a team or a
+    workload. The tenants using the budget split it in proportion to their weights,
+    and the minimum of a tenant is kept free for it whatever the others do.
+    """
+
+    # The name given to `limit(..., tenant=...)`.
+    name: str
+    # The part of the budget of the tenant relative to the other tenants using it.
+    weight: float = 1.0
+    # The calls and tokens of every period kept for the tenant.
+    min_calls: int = 0
+    min_tokens: int = 0
+
+
+def check_shares(
+    priorities: Sequence[float],
+    tenants: Sequence[Tenant],
+    max_calls: int,
+    max_tokens: int,
+    leased: bool = False,
+) -> Tuple[List[float], List[Tenant]]:
+    """
+    Validates the priority tiers and the tenants of a budget.
+
+    Args:
+        priorities (Sequence[float]): The part of the budget each priority may fill.
+        tenants (Sequence[Tenant]): The tenants.
+        max_calls (int): The call budget of the period.
+        max_tokens (int): The token budget of the period.
+        leased (bool): Whether the budget is admitted from a local lease.
+
+    Returns:
+        Tuple[List[float], List[Tenant]]: The priorities and the tenants.
+    """
+    for share in priorities:
+        if not 0 < share <= 1:
+            raise ValueError(
+                f"The share of the budget of a priority must be in (0, 1], got {share}."
+            )
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("Two tenants of a budget cannot have the same name.")
+    for tenant in tenants:
+        if tenant.weight <= 0 or tenant.min_calls < 0 or tenant.min_tokens < 0:
+            raise ValueError(
+                f"A tenant needs a positive weight and minimums of at least 0, got {tenant}."
+            )
+    if (
+        sum(tenant.min_calls for tenant in tenants) > max_calls
+        or sum(tenant.min_tokens for tenant in tenants) > max_tokens
+    ):
+        raise ValueError("The minimums of the tenants exceed the budget.")
+    if leased and (priorities or tenants):
+        raise ValueError("A leased budget cannot be shared by priorities or tenants.")
+    return list(priorities), list(tenants)
+
+
+def priority_share(priorities: Sequence[float], priority: int) -> float:
+    """
+    Returns the part of the budget a request of the priority may fill, 0 being the
+    highest priority. The priorities past the last tier share its limit.
+    """
+    if priority < 0:
+        raise ValueError(f"The priority must be at least 0, got {priority}.")
+    if not priorities:
+        return 1.0
+    return priorities[min(priority, len(priorities) - 1)]
+
+
+def tenant_index(tenants: Sequence[Tenant], name: Optional[str]) -> Optional[int]:
+    """Returns the index of the tenant of the name, None for no tenant."""
+    if name is None:
+        return None
+    for index, tenant in enumerate(tenants):
+        if tenant.name == name:
+            return index
+    raise ValueError(f"Unknown tenant {name!r}.")
+
+
+def check_scheduler(scheduler: str) -> str:
+    """
+    Validates the name of a scheduler.
+
+    Args:
+        scheduler (str): One of "fifo" or "sjf".
+
+    Returns:
+        str: The scheduler name.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(
+            f"Unknown scheduler {scheduler!r}, expected one of {', '.join(SCHEDULERS)}."
+        )
+    return scheduler
+
+
+class APIKey(NamedTuple):
+    """
+    An API key (or organization) of a pool, with its own budget for the model of the
+    pool. Only the name is stored, the secret itself never leaves the caller.
+    """
+
+    # The name the pool returns for the requests to send with this key.
+    name: str
+    # The maximum number of requests and tokens per minute of the key.
+    RPM: int
+    TPM: int
+
+
+def check_keys(keys: Sequence[APIKey]) -> List[APIKey]:
+    """
+    Validates the API keys of a pool.
+
+    Args:
+        keys (Sequence[APIKey]): The API keys.
+
+    Returns:
+        List[APIKey]: The API keys.
+    """
+    if not keys:
+        raise ValueError("A pool needs at least one API key.")
+    names = [key.name for key in keys]
+    if len(set(names)) != len(names):
+        raise ValueError("Two API keys of a pool cannot have the same name.")
+    for key in keys:
+        if key.RPM < 1 or key.TPM < 1:
+            raise ValueError(
+                f"The RPM and TPM of an API key must be at least 1, got {key}."
+            )
+    return list(keys)
+
+
+def key_index(keys: Sequence[APIKey], name: str) -> int:
+    """Returns the index of the API key of the name."""
+    for index, key in enumerate(keys):
+        if key.name == name:
+            return index
+    raise ValueError(f"Unknown API key {name!r}.")
+
+
+class RateLimitTimeout(TimeoutError):
+    """
+    Raised when a request does not fit in the budget before its timeout. Nothing
+    is reserved for it.
+    """
+
+    def __init__(self, wait: float):
+        super().__init__(
+            f"The request does not fit in the budget, retry in {wait:.3f} seconds."
+        )
+        # The predicted seconds until the request fits.
+        self.wait = wait
+
+
+def timeout_deadline(timeout: Optional[float]) -> Optional[float]:
+    """Returns the time a request waiting at most `timeout` seconds gives up."""
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def check_timeout(deadline: Optional[float], wait: float):
+    """
+    Raises RateLimitTimeout when waiting `wait` more seconds would pass the
+    deadline of the request, None for no deadline.
+    """
+    if deadline is not None and time.monotonic() + wait > deadline:
+        raise RateLimitTimeout(wait)
@@ -0,0 +1,292 @@
+import contextlib
+import time
+import types
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
+
+from .algorithms import backoff, check_algorithm, headroom
+from .base import BaseAPILimiterRedis, Limiter, MemoryLimiter, _model_state
+from .headers import observe
+from .keys import key_namespace
+from .limits import (
+    APIKey,
+    check_keys,
+    check_timeout,
+    key_index,
+    timeout_deadline,
+)
+from .scripts import ROUTE_SCRIPTS, get_script
+from .usage import Usage
+
+if TYPE_CHECKING:
+    import redis
+
+
+class KeyPool:
+    """
+    Spreads the requests for a model over several API keys (or organizations), each
+    with its own RPM and TPM. Every request is admitted against the key with the most
+    headroom left, checked and reserved in one atomic step, and is told which key to
+    send it with. When no key has room for it, the request waits for the key that
+    frees up first.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        keys: Sequence[APIKey],
+        redis_instance: "redis.Redis[bytes] | None" = None,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        check_connection: bool = True,
+        namespace: Optional[str] = None,
+    ):
+        """
+        Args:
+            model_name (str): The name of the model.
+            keys (Sequence[APIKey]): The API keys of the pool, each with its name and budget.
+            redis_instance (redis.Redis[bytes] | None): Optional: The redis instance. If not specified it will use
+                                                        in-memory caching, shared by the threads of the process.
+            algorithm (str): The rate limiting algorithm ("fixed", "sliding" or "gcra").
+            jitter (float): The maximum random delay in seconds added to the wait of a rejected request.
+            check_connection (bool): Ping the Redis server right away.
+            namespace (str | None): The prefix of the Redis keys, the budget of each API key is kept
+                                    under `{namespace}:{key name}`.
+        """
+        self.model_name = model_name
+        self.keys = check_keys(keys)
+        self.redis = redis_instance
+        self.algorithm = check_algorithm(algorithm)
+        self.jitter = jitter
+        self.namespace = namespace
+        # The budget of each API key, in the order of the keys.
+        self.limiters = [
+            BaseAPILimiterRedis(
+                model_name,
+                key.RPM,
+                key.TPM,
+                redis_instance,
+                algorithm,
+                jitter,
+                check_connection=False,
+                namespace=key_namespace(namespace, key.name),
+            )
+            for key in self.keys
+        ]
+        self.period = self.limiters[0].period
+        if check_connection and self.redis:
+            self.limiters[0].check_redis()
+
+    def _reservation(self, index: int, tokens: int) -> Union[Limiter, MemoryLimiter]:
+        """Returns a reservation of `tokens` against the budget of the API key."""
+        limiter = self.limiters[index]._limit(tokens)
+        assert isinstance(limiter, (Limiter, MemoryLimiter))
+        limiter.period = self.period
+        if isinstance(limiter, MemoryLimiter):
+            limiter._state = _model_state(
+                (self.model_name, self.algorithm, self.keys[index].name)
+            )
+        return limiter
+
+    def _route(
+        self, tokens: int, dry_run: bool = False
+    ) -> Tuple[int, float, Union[Limiter, MemoryLimiter]]:
+        """
+        Admits the request against the API key with the most headroom left after it.
+
+        Args:
+            tokens (int): The tokens of the request.
+            dry_run (bool): Only check the budgets without reserving them.
+
+        Returns:
+            Tuple[int, float, Limiter]: The index of the API key, the seconds to wait
+            before the request fits, 0 if it was admitted, and the reservation. When no
+            key has room for the request, the key is the one that frees up first.
+        """
+        limiters = [self._reservation(i, tokens) for i in range(len(self.keys))]
+        if not self.redis:
+            return self._route_memory(limiters, dry_run)
+        route = get_script(self.redis, ROUTE_SCRIPTS[self.algorithm])
+        keys, args = [], [tokens, int(dry_run), self.period]
+        for limiter in limiters:
+            assert isinstance(limiter, Limiter)
+            keys += limiter._keys()
+            args += limiter._limits()
+        result = route(keys=keys, args=args)
+        index = result[0] - 1
+        wait_ms = limiters[index]._admitted(result)
+        return index, wait_ms / 1000, limiters[index]
+
+    def _route_memory(
+        self, limiters: List[Any], dry_run: bool
+    ) -> Tuple[int, float, MemoryLimiter]:
+        best, room, soonest, soonest_wait = None, 0.0, 0, float("inf")
+        with contextlib.ExitStack() as stack:
+            # The locks are taken in the order of the names, so that pools sharing
+            # API keys in another order cannot deadlock.
+            for i in sorted(range(len(limiters)), key=lambda i: self.keys[i].name):
+                stack.enter_context(limiters[i].state.lock)
+            for i, limiter in enumerate(limiters):
+                wait = limiter._admit(dry_run=True)
+                if wait:
+                    if wait < soonest_wait:
+                        soonest, soonest_wait = i, wait
+                    continue
+                left = headroom(
+                    limiter.max_calls,
+                    limiter.max_tokens,
+                    limiter.current_calls + 1,
+                    limiter.current_tokens + limiter.tokens,
+                )
+                if best is None or left > room:
+                    best, room = i, left
+            if best is None:
+                return soonest, soonest_wait, limiters[soonest]
+            if not dry_run:
+                limiters[best]._admit()
+            return best, 0.0, limiters[best]
+
+    def limit(self, tokens: int, timeout: Optional[float] = None) -> "PooledLimiter":
+        """
+        Limits a request to be sent with one of the API keys of the pool.
+
+        Args:
+            tokens (int): The tokens of the request, see `num_tokens_consumed_by_chat_request`.
+            timeout (float | None): The seconds to wait for the budget before raising
+                                    RateLimitTimeout, None to wait as long as needed.
+        Returns:
+            PooledLimiter: Limiter class to be used in the context manager, its `key` is
+            the name of the API key to send the request with.
+        """
+        return PooledLimiter(self, tokens, timeout)
+
+    def is_locked(self, tokens: int) -> bool:
+        """Returns True if no API key of the pool has room for the request."""
+        return self._route(tokens, dry_run=True)[1] > 0
+
+    def update_from_headers(self, key: str, headers: Mapping[str, Any]):
+        """
+        Corrects the budget of an API key with the rate limit headers of a response
+        to a request sent with it, as `BaseAPILimiterRedis.update_from_headers()`.
+
+        Args:
+            key (str): The name of the API key.
+            headers (Mapping[str, str]): The headers of the response.
+        """
+        index = key_index(self.keys, key)
+        limiter = self.limiters[index]
+        observation = observe(headers, limiter.max_calls, limiter.max_tokens)
+        if observation is not None:
+            self._reservation(index, 0)._observe(observation)
+
+    def usage(self, key: str) -> Usage:
+        """
+        Returns the usage of the budget of an API key.
+
+        Args:
+            key (str): The name of the API key.
+        """
+        return self._reservation(key_index(self.keys, key), 0)._usage()
+
+    def clear_locks(self) -> bool:
+        """
+        Clears the budgets of every API key of the pool.
+        returns True if the locks were cleared successfully, otherwise returns False.
+        """
+        if self.redis:
+            cleared = [limiter.clear_locks() for limiter in self.limiters]
+            return any(cleared)
+        cleared = False
+        for i in range(len(self.keys)):
+            state = self._reservation(i, 0).state
+            with state.lock:
+                cleared = cleared or state.calls is not None
+                state.calls = state.tokens = None
+        return cleared
+
+
+class PooledLimiter:
+    """A request admitted against the budget of one of the API keys of a pool."""
+
+    def __init__(self, pool: KeyPool, tokens: int, timeout: Optional[float] = None):
+        self.pool = pool
+        self.tokens = tokens
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        # The name of the API key to send the request with once it is admitted, the
+        # one that frees up first while it waits.
+        self.key: Optional[str] = None
+        # The reservation against the budget of the key.
+        self.limiter: Optional[Union[Limiter, MemoryLimiter]] = None
+
+    def __enter__(self):
+        deadline = timeout_deadline(self.timeout)
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return self
+            check_timeout(deadline, wait)
+            time.sleep(backoff(wait, self.pool.jitter))
+
+    def try_acquire(self) -> float:
+        """
+        Reserves the budget of the API key with the most headroom if the request
+        fits in one right now, without waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        index, wait, limiter = self.pool._route(self.tokens)
+        self.key = self.pool.keys[index].name
+        if not wait:
+            self.limiter = limiter
+        return wait
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        assert self.limiter is not None, "The request was not admitted."
+        self.limiter.record_usage(usage)
+
+    def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the API key it was reserved from.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        assert self.limiter is not None, "The request was not admitted."
+        self.limiter.refund(tokens, calls)
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ) -> Optional[bool]:
+        if self.limiter is not None:
+            limiter, self.limiter = self.limiter, None
+            limiter.__exit__(exc_type, exc_value, traceback)
+
+    def release(self):
+        """
+        Releases a reservation taken with `try_acquire()` instead of the context
+        manager, giving back the tokens that were not used.
+        """
+        self.__exit__(None, None, None)
@@ -0,0 +1,599 @@
+import weakref
+from typing import Any, Dict
+
+# The scripts run the functions of an algorithm on the call and token counters
+# of every window of the budget, a window being a period with its own limits.
+_PRELUDE = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + tonumber(time[2]) / 1000
+"""
+
+# Checks the calls and tokens against the counters of every window. The windows
+# are described from ARGV[first] by their max calls, max tokens (-1 for no
+# limit) and period (s), and their calls and tokens keys are KEYS[1], KEYS[2],
+# then KEYS[3], KEYS[4] and so on. The algorithm reads the period of the window
+# from period_ms, which is set before every check and every commit.
+_WINDOWS = """
+local function check_windows(first, calls, tokens)
+    local results, wait = {}, 0
+    local costs = {calls, tokens}
+    for w = 0, (#ARGV - first + 1) / 3 - 1 do
+        local arg = first + 3 * w
+        period_ms = tonumber(ARGV[arg + 2]) * 1000
+        for j = 1, 2 do
+            local limit = tonumber(ARGV[arg + j - 1])
+            if limit >= 0 then
+                local result = check(KEYS[2 * w + j], limit, costs[j])
+                result.period_ms = period_ms
+                wait = math.max(wait, result.wait)
+                results[2 * w + j] = result
+            end
+        end
+    end
+    return results, wait
+end
+
+-- Commits every check, returns the time the first window holds the tokens.
+local function commit_windows(results)
+    local window = 0
+    for i, result in pairs(results) do
+        period_ms = result.period_ms
+        local ttl = result.commit()
+        if i == 2 then
+            window = ttl
+        end
+    end
+    return window
+end
+
+-- The in-flight requests are the members of a sorted set scored by the time
+-- their slot expires, the last key of the script.
+local function in_flight_wait(limit, poll, count)
+    if limit < 0 then
+        return 0
+    end
+    local key = KEYS[#KEYS]
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+    if redis.call('ZCARD', key) + count <= limit then
+        return 0
+    end
+    local first = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    if first[2] then
+        poll = math.min(poll, tonumber(first[2]) - now)
+    end
+    return math.max(poll, 1)
+end
+
+local function take_in_flight(limit, timeout, members)
+    if limit < 0 then
+        return
+    end
+    local key = KEYS[#KEYS]
+    for _, member in ipairs(members) do
+        redis.call('ZADD', key, now + timeout, member)
+    end
+    redis.call('PEXPIRE', key, math.ceil(timeout))
+end
+"""
+
+# Checks the calls and tokens against the shares of the budget, described from
+# ARGV[first] by the part of the budget the priority of the request may fill, the
+# tenant of the request (0 for none) and the number of tenants, then the weight,
+# min calls and min tokens of each tenant. The windows follow, the calls and
+# tokens keys of the n-th tenant follow the keys of the windows. The request must
+# leave free the part of the budget above the share of its priority and the
+# unused minimums of the other tenants, its tenant may use its minimum or its
+# weighted part of the budget among the tenants using it, whichever is larger.
+# Returns the wait and the checks of the counters of the tenant.
+_SHARES = """
+local function check_shares(first, windows, calls, tokens)
+    local share = tonumber(ARGV[first])
+    local tenant = tonumber(ARGV[first + 1])
+    local count = tonumber(ARGV[first + 2])
+    if share >= 1 and count == 0 then
+        return 0, {}
+    end
+    local main = first + 3 + 3 * count
+    period_ms = tonumber(ARGV[main + 2]) * 1000
+    local limits = {tonumber(ARGV[main]), tonumber(ARGV[main + 1])}
+    local costs = {calls, tokens}
+    local paddings = {limits[1] * (1 - share), limits[2] * (1 - share)}
+    local weight, used = 0, {}
+    for i = 1, count do
+        local arg = first + 3 * i
+        used[i] = {}
+        for j = 1, 2 do
+            used[i][j] = check(KEYS[2 * (windows + i - 1) + j], limits[j], 0).before
+            if i ~= tenant then
+                local unused = tonumber(ARGV[arg + j]) - used[i][j]
+                paddings[j] = paddings[j] + math.max(unused, 0)
+            end
+        end
+        if i == tenant or used[i][1] > 0 or used[i][2] > 0 then
+            weight = weight + tonumber(ARGV[arg])
+        end
+    end
+    local wait, results = 0, {}
+    for j = 1, 2 do
+        if paddings[j] > 0 then
+            local padded = check(KEYS[j], limits[j], costs[j] + paddings[j])
+            wait = math.max(wait, padded.wait)
+        end
+        if tenant > 0 then
+            local arg = first + 3 * tenant
+            local key = KEYS[2 * (windows + tenant - 1) + j]
+            local cap = math.max(
+                tonumber(ARGV[arg + j]), limits[j] * tonumber(ARGV[arg]) / weight
+            )
+            if cap < limits[j] then
+                local capped = check(key, limits[j], costs[j] + limits[j] - cap)
+                wait = math.max(wait, capped.wait)
+            end
+            results[j] = check(key, limits[j], costs[j])
+            results[j].period_ms = period_ms
+        end
+    end
+    return wait, results
+end
+"""
+
+# Every admission script checks and reserves the budget of every window, and an
+# in-flight slot, in a single atomic step, within the shares of the budget.
+# Nothing is written when the request does not fit in any of them.
+#
+# KEYS: the api calls and api tokens keys of each window, then those of each
+# tenant, then the in-flight key when in-flight requests are limited
+# ARGV[1]: tokens, ARGV[2]: 1 to only check the budget without reserving it,
+# ARGV[3]: calls, ARGV[4]: max in-flight requests (-1 for no limit),
+# ARGV[5]: in-flight member, ARGV[6]: in-flight timeout (ms),
+# ARGV[7]: in-flight poll (ms), ARGV[8..]: the shares, then the windows, the
+# first one being the one reported
+#
+# Returns {allowed, wait_ms, current_calls, current_tokens, window_ms}, where
+# wait_ms is the time until the request would be allowed and window_ms the time
+# during which the reservation can still be refunded.
+_ADMIT = (
+    _PRELUDE
+    + """
+local period_ms = 0
+%s
+"""
+    + _WINDOWS
+    + _SHARES
+    + """
+local calls = tonumber(ARGV[3])
+local tokens = tonumber(ARGV[1])
+local max_in_flight = tonumber(ARGV[4])
+local first = 11 + 3 * tonumber(ARGV[10])
+local windows = (#ARGV - first + 1) / 3
+local results, wait = check_windows(first, calls, tokens)
+local shares_wait, tenant = check_shares(8, windows, calls, tokens)
+wait = math.max(wait, shares_wait)
+wait = math.max(wait, in_flight_wait(max_in_flight, tonumber(ARGV[7]), 1))
+if wait > 0 then
+    return {0, math.ceil(wait), results[1].before, results[2].before, 0}
+end
+if ARGV[2] == '1' then
+    return {1, 0, results[1].before, results[2].before, 0}
+end
+take_in_flight(max_in_flight, tonumber(ARGV[6]), {ARGV[5]})
+commit_windows(tenant)
+local window = commit_windows(results)
+return {1, 0, results[1].after, results[2].after, math.floor(window)}
+"""
+)
+
+# Admits the longest prefix of a batch of requests that fits, or the whole batch
+# or nothing, reserving all of them at once.
+#
+# KEYS: as for the admission scripts
+# ARGV[1]: max in-flight requests (-1 for no limit), ARGV[2]: in-flight member
+# prefix, the member of the n-th request being prefix:n, ARGV[3]: in-flight
+# timeout (ms), ARGV[4]: in-flight poll (ms), ARGV[5]: 1 to admit the whole
+# batch or nothing, ARGV[6]: the number of requests, then the tokens of each
+# request in order, then the shares, then the windows
+#
+# Returns {admitted, wait_ms, window_ms}, where wait_ms is the time until the
+# first request left out would be allowed.
+_ADMIT_BATCH = (
+    _PRELUDE
+    + """
+local period_ms = 0
+%s
+"""
+    + _WINDOWS
+    + _SHARES
+    + """
+local max_in_flight = tonumber(ARGV[1])
+local count = tonumber(ARGV[6])
+local first = 10 + count + 3 * tonumber(ARGV[9 + count])
+local windows = (#ARGV - first + 1) / 3
+local admitted, reserved, wait = 0, 0, 0
+local results, tenant
+for i = 7, 6 + count do
+    local cost = reserved + tonumber(ARGV[i])
+    local next_results, next_tenant, shares_wait
+    next_results, wait = check_windows(first, admitted + 1, cost)
+    shares_wait, next_tenant = check_shares(7 + count, windows, admitted + 1, cost)
+    wait = math.max(wait, shares_wait)
+    wait = math.max(
+        wait, in_flight_wait(max_in_flight, tonumber(ARGV[4]), admitted + 1)
+    )
+    if wait > 0 then
+        break
+    end
+    admitted, reserved = admitted + 1, cost
+    results, tenant = next_results, next_tenant
+end
+if admitted < count and ARGV[5] == '1' then
+    admitted = 0
+end
+if admitted == 0 then
+    return {0, math.ceil(wait), 0}
+end
+local members = {}
+for i = 1, admitted do
+    members[i] = ARGV[2] .. ':' .. i
+end
+take_in_flight(max_in_flight, tonumber(ARGV[3]), members)
+commit_windows(tenant)
+local window = commit_windows(results)
+return {admitted, math.ceil(wait), math.floor(window)}
+"""
+)
+
+# Admits a request against the budget of the API key of a pool with the most
+# headroom left after it, in a single atomic step. The headroom of a key is the
+# smaller of the parts of its calls and tokens budgets left unused.
+#
+# KEYS: the api calls and api tokens keys of each API key
+# ARGV[1]: tokens, ARGV[2]: 1 to only check the budgets without reserving them,
+# ARGV[3]: period (s), then the max calls and max tokens of each API key
+#
+# Returns {key, wait_ms, current_calls, current_tokens, window_ms}, where key is
+# the index (from 1) of the API key that admitted the request or, when none has
+# room for it, of the one that frees up first, and wait_ms the time until then.
+_ROUTE = _PRELUDE + """
+local period_ms = tonumber(ARGV[3]) * 1000
+%s
+local tokens = tonumber(ARGV[1])
+local best, room, results = 0, -math.huge, nil
+local soonest, soonest_wait = 1, math.huge
+for i = 1, (#ARGV - 3) / 2 do
+    local max_calls = tonumber(ARGV[2 + 2 * i])
+    local max_tokens = tonumber(ARGV[3 + 2 * i])
+    local calls = check(KEYS[2 * i - 1], max_calls, 1)
+    local used = check(KEYS[2 * i], max_tokens, tokens)
+    local wait = math.max(calls.wait, used.wait)
+    if wait > 0 then
+        if wait < soonest_wait then
+            soonest, soonest_wait = i, wait
+        end
+    else
+        local left = math.min(
+            (max_calls - calls.after) / max_calls,
+            (max_tokens - used.after) / max_tokens
+        )
+        if left > room then
+            best, room, results = i, left, {calls, used}
+        end
+    end
+end
+if best == 0 then
+    return {soonest, math.ceil(soonest_wait), 0, 0, 0}
+end
+if ARGV[2] == '1' then
+    return {best, 0, results[1].before, results[2].before, 0}
+end
+results[1].commit()
+local window = results[2].commit()
+return {best, 0, results[1].after, results[2].after, math.floor(window)}
+"""
+
+# Reads the usage of the budget without changing it.
+#
+# KEYS[1]: api calls key, KEYS[2]: api tokens key
+# ARGV[1]: max calls, ARGV[2]: max tokens, ARGV[3]: period (s)
+#
+# Returns {current_calls, current_tokens, reset_ms}, where reset_ms is the time
+# until the whole budget is available again: the wait before a request costing
+# the whole budget would fit.
+_USAGE = _PRELUDE + """
+local period_ms = tonumber(ARGV[3]) * 1000
+%s
+local calls = check(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[1]))
+local tokens = check(KEYS[2], tonumber(ARGV[2]), tonumber(ARGV[2]))
+return {calls.before, tokens.before, math.ceil(math.max(calls.wait, tokens.wait))}
+"""
+
+# Credits reserved budget back to every window it was reserved in.
+#
+# KEYS: the api calls and api tokens keys of each window
+# ARGV[1]: calls, ARGV[2]: tokens, ARGV[3..]: the windows
+_REFUND = _PRELUDE + """
+local period_ms = 0
+%s
+local amounts = {tonumber(ARGV[1]), tonumber(ARGV[2])}
+for w = 0, (#ARGV - 2) / 3 - 1 do
+    local arg = 3 + 3 * w
+    period_ms = tonumber(ARGV[arg + 2]) * 1000
+    for j = 1, 2 do
+        local limit = tonumber(ARGV[arg + j - 1])
+        if limit >= 0 then
+            refund(KEYS[2 * w + j], limit, amounts[j])
+        end
+    end
+end
+return 1
+"""
+
+# Replaces the state of the budget with the usage reported by the API, the
+# `x-ratelimit-*` headers of a response or the `retry-after` of a 429.
+#
+# KEYS[1]: api calls key, KEYS[2]: api tokens key
+# ARGV[1]: used calls, ARGV[2]: used tokens, -1 to keep the current state,
+# ARGV[3]: calls reset (ms), ARGV[4]: tokens reset (ms), -1 if unknown, ARGV[5]: max calls,
+# ARGV[6]: max tokens, ARGV[7]: period (s)
+_OBSERVE = _PRELUDE + """
+local period_ms = tonumber(ARGV[7]) * 1000
+%s
+if tonumber(ARGV[1]) >= 0 and tonumber(ARGV[5]) > 0 then
+    observe(KEYS[1], tonumber(ARGV[5]), tonumber(ARGV[1]), tonumber(ARGV[3]))
+end
+if tonumber(ARGV[2]) >= 0 and tonumber(ARGV[6]) > 0 then
+    observe(KEYS[2], tonumber(ARGV[6]), tonumber(ARGV[2]), tonumber(ARGV[4]))
+end
+return 1
+"""
+
+# The window starts with the first reservation and the counters expire with it,
+# so a rejected request waits for the remaining TTL of the counter.
+_FIXED_WINDOW = """
+local function check(key, limit, cost)
+    local used = tonumber(redis.call('GET', key) or '0')
+    local wait = 0
+    if used + cost > limit then
+        wait = redis.call('PTTL', key)
+        if used == 0 or wait < 0 then
+            wait = period_ms
+        end
+    end
+    local function commit()
+        redis.call('INCRBY', key, cost)
+        local ttl = redis.call('PTTL', key)
+        if ttl < 0 then
+            redis.call('PEXPIRE', key, period_ms)
+            ttl = period_ms
+        end
+        return ttl
+    end
+    return {wait = wait, before = used, after = used + cost, commit = commit}
+end
+"""
+
+_FIXED_WINDOW_REFUND = """
+local function refund(key, limit, amount)
+    local used = tonumber(redis.call('GET', key))
+    if used and amount > 0 then
+        redis.call('SET', key, math.max(used - amount, 0), 'KEEPTTL')
+    end
+end
+"""
+
+# The reported usage fills a window ending when the API resets it, or the current
+# window when the reset is unknown.
+_FIXED_WINDOW_OBSERVE = """
+local function observe(key, limit, used, reset)
+    if used <= 0 or reset == 0 then
+        redis.call('DEL', key)
+    elseif reset < 0 then
+        redis.call('SET', key, used, 'KEEPTTL')
+        if redis.call('PTTL', key) < 0 then
+            redis.call('PEXPIRE', key, period_ms)
+        end
+    else
+        redis.call('SET', key, used, 'PX', math.ceil(reset))
+    end
+end
+"""
+
+# Sliding window counter: the usage of the previous window is weighted by how
+# much of it still overlaps the sliding window. The key is a hash holding the
+# start of the current window and the counters of both windows.
+_SLIDING_WINDOW = """
+local function check(key, limit, cost)
+    local state = redis.call('HMGET', key, 'start', 'current', 'previous')
+    local start = tonumber(state[1]) or now
+    local current = tonumber(state[2]) or 0
+    local previous = tonumber(state[3]) or 0
+    local elapsed = math.floor((now - start) / period_ms)
+    if elapsed == 1 then
+        previous, current = current, 0
+    elseif elapsed > 1 then
+        previous, current = 0, 0
+    end
+    start = start + elapsed * period_ms
+    local remaining = period_ms - (now - start)
+    local used = previous * remaining / period_ms + current
+    local wait = 0
+    local excess = used + cost - limit
+    if excess > 0 then
+        if cost > limit then
+            wait = period_ms
+        elseif previous > 0 and excess <= previous * remaining / period_ms then
+            wait = excess * period_ms / previous
+        elseif current + cost <= limit then
+            wait = remaining
+        else
+            wait = remaining + (current + cost - limit) * period_ms / current
+        end
+    end
+    local function commit()
+        redis.call(
+            'HSET', key, 'start', string.format('%.3f', start),
+            'current', current + cost, 'previous', previous
+        )
+        redis.call('PEXPIRE', key, math.ceil(remaining + period_ms))
+        return remaining
+    end
+    return {
+        wait = wait, before = math.floor(used + 0.5),
+        after = math.floor(used + cost + 0.5), commit = commit
+    }
+end
+"""
+
+_SLIDING_WINDOW_REFUND = """
+local function refund(key, limit, amount)
+    local current = tonumber(redis.call('HGET', key, 'current'))
+    if current and amount > 0 then
+        redis.call('HSET', key, 'current', math.max(current - amount, 0))
+    end
+end
+"""
+
+# The reported usage fills a current window ending when the API resets it, or
+# the current window when the reset is unknown.
+_SLIDING_WINDOW_OBSERVE = """
+local function observe(key, limit, used, reset)
+    if used <= 0 then
+        redis.call('DEL', key)
+        return
+    end
+    if reset < 0 then
+        local start = tonumber(redis.call('HGET', key, 'start'))
+        reset = period_ms
+        if start and start + period_ms > now then
+            reset = start + period_ms - now
+        end
+    end
+    reset = math.min(reset, period_ms)
+    redis.call(
+        'HSET', key, 'start', string.format('%.3f', now + reset - period_ms),
+        'current', used, 'previous', 0
+    )
+    redis.call('PEXPIRE', key, math.max(math.ceil(reset + period_ms), 1))
+end
+"""
+
+# GCRA: the key holds the theoretical arrival time (TAT) of the budget, every
+# reservation pushes it forward by its share of the period and a request is
+# allowed as long as the TAT stays within one period of now.
+_GCRA = """
+local function check(key, limit, cost)
+    local tat = math.max(tonumber(redis.call('GET', key) or '0'), now)
+    local new_tat = tat + cost * period_ms / limit
+    local wait = math.max(new_tat - period_ms - now, 0)
+    local function commit()
+        redis.call(
+            'SET', key, string.format('%.3f', new_tat),
+            'PX', math.max(math.ceil(new_tat - now), 1)
+        )
+        return new_tat - now
+    end
+    return {
+        wait = wait, before = math.floor((tat - now) * limit / period_ms + 0.5),
+        after = math.floor((new_tat - now) * limit / period_ms + 0.5), commit = commit
+    }
+end
+"""
+
+_GCRA_REFUND = """
+local function refund(key, limit, amount)
+    local tat = tonumber(redis.call('GET', key))
+    if tat and amount > 0 then
+        tat = math.max(tat - amount * period_ms / limit, now)
+        redis.call(
+            'SET', key, string.format('%.3f', tat),
+            'PX', math.max(math.ceil(tat - now), 1)
+        )
+    end
+end
+"""
+
+# The reported usage sets the TAT, an exhausted budget also waits for the reset
+# when it is known.
+_GCRA_OBSERVE = """
+local function observe(key, limit, used, reset)
+    local tat = now + used * period_ms / limit
+    if used >= limit then
+        tat = tat + math.max(reset, 0)
+    end
+    if tat <= now then
+        redis.call('DEL', key)
+    else
+        redis.call(
+            'SET', key, string.format('%.3f', tat),
+            'PX', math.max(math.ceil(tat - now), 1)
+        )
+    end
+end
+"""
+
+ADMIT_FIXED_WINDOW = _ADMIT % _FIXED_WINDOW
+ADMIT_SLIDING_WINDOW = _ADMIT % _SLIDING_WINDOW
+ADMIT_GCRA = _ADMIT % _GCRA
+
+ADMIT_SCRIPTS = {
+    "fixed": ADMIT_FIXED_WINDOW,
+    "sliding": ADMIT_SLIDING_WINDOW,
+    "gcra": ADMIT_GCRA,
+}
+
+ADMIT_BATCH_SCRIPTS = {
+    "fixed": _ADMIT_BATCH % _FIXED_WINDOW,
+    "sliding": _ADMIT_BATCH % _SLIDING_WINDOW,
+    "gcra": _ADMIT_BATCH % _GCRA,
+}
+
+ROUTE_SCRIPTS = {
+    "fixed": _ROUTE % _FIXED_WINDOW,
+    "sliding": _ROUTE % _SLIDING_WINDOW,
+    "gcra": _ROUTE % _GCRA,
+}
+
+USAGE_SCRIPTS = {
+    "fixed": _USAGE % _FIXED_WINDOW,
+    "sliding": _USAGE % _SLIDING_WINDOW,
+    "gcra": _USAGE % _GCRA,
+}
+
+REFUND_SCRIPTS = {
+    "fixed": _REFUND % _FIXED_WINDOW_REFUND,
+    "sliding": _REFUND % _SLIDING_WINDOW_REFUND,
+    "gcra": _REFUND % _GCRA_REFUND,
+}
+
+OBSERVE_SCRIPTS = {
+    "fixed": _OBSERVE % _FIXED_WINDOW_OBSERVE,
+    "sliding": _OBSERVE % _SLIDING_WINDOW_OBSERVE,
+    "gcra": _OBSERVE % _GCRA_OBSERVE,
+}
+
+_registered: "weakref.WeakKeyDictionary[Any, Dict[str, Any]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_script(client: Any, source: str) -> Any:
+    """
+    Returns the script object registered for the source on the given client.
+
+    Scripts are registered once per client and run with EVALSHA, redis-py only
+    falls back to loading the source when the server answers with NOSCRIPT.
+
+    Args:
+        client (redis.Redis | redis.asyncio.Redis): The redis instance.
+        source (str): The Lua source of the script.
+
+    Returns:
+        Script | AsyncScript: The registered script.
+    """
+    scripts = _registered.setdefault(client, {})
+    script = scripts.get(source)
+    if script is None:
+        script = scripts[source] = client.register_script(source)
+    return script
@@ -0,0 +1,752 @@
+import hashlib
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import types
+import zlib
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Sequence, Tuple, Type
+
+from .algorithms import (
+    ALGORITHM_FUNCTIONS,
+    REFUND_FUNCTIONS,
+    Shares,
+    WindowLimits,
+    admit_batch,
+    backoff,
+    observe_states,
+    refund_windows,
+    reservation_deadline,
+    reserve_shares,
+    reserve_windows,
+    snapshot,
+    state_expiry,
+)
+from .headers import Observation
+from .limits import (
+    Tenant,
+    Window,
+    check_timeout,
+    in_flight_poll,
+    in_flight_timeout,
+    priority_share,
+    tenant_index,
+    timeout_deadline,
+)
+from .usage import Usage, usage_tokens
+
+# One slot per (model, algorithm) and per extra window or tenant: the name, whether each
+# counter holds a state, the time the counters expire, then the calls and tokens
+# states padded to three doubles each. A slot is looked up from the hash of its
+# name, probing the next slots until an unused one.
+_SLOT = struct.Struct("<64sBB6xd3d3d")
+_NAME_BYTES = 64
+# The longest model name and algorithm/window suffix kept as they are in the name
+# of a slot, longer ones are replaced by their hash.
+_MODEL_BYTES = 31
+_SUFFIX_BYTES = _NAME_BYTES - _MODEL_BYTES - 1
+
+
+def _digest(text: bytes, size: int) -> bytes:
+    return (
+        b"~" + hashlib.blake2b(text, digest_size=(size - 1) // 2).hexdigest().encode()
+    )
+
+
+def _encode(state: Any) -> Tuple[float, float, float]:
+    if state is None:
+        return 0.0, 0.0, 0.0
+    if isinstance(state, tuple):
+        return (tuple(state) + (0.0, 0.0, 0.0))[:3]  # type: ignore
+    return state, 0.0, 0.0
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Alive, run by another user
+    return True
+
+
+def _decode(algorithm: str, state: Tuple[float, float, float]) -> Any:
+    if algorithm == "fixed":
+        return state[:2]
+    if algorithm == "sliding":
+        return state
+    return state[0]
+
+
+class SharedMemoryStore:
+    """
+    Rate limiting state shared by the processes of one host through a memory
+    mapped file, a fixed-size slot per model and algorithm.
+
+    Every update happens under an exclusive `flock` on the file, together with a
+    thread lock since `flock` does not exclude threads sharing the descriptor.
+    Windows are timed with `time.monotonic()`, which is the same clock in every
+    process of the host. Only POSIX systems are supported.
+    """
+
+    def __init__(self, path: Optional[str] = None, slots: int = 256):
+        """
+        Args:
+            path (str | None): The file holding the state, by default
+                               `openai_ratelimiter.shm` in the temporary directory.
+                               Processes sharing a budget must use the same file.
+            slots (int): The number of models the file can hold, ignored when the
+                         file already exists.
+        """
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), "openai_ratelimiter.shm"
+        )
+        self.slots = slots
+        self._open()
+
+    def _open(self):
+        # A forked child gets its own descriptor, flock would not exclude it from
+        # its parent if they shared one.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._flock():
+            size = os.fstat(self._fd).st_size
+            if size < _SLOT.size:
+                size = self.slots * _SLOT.size
+                os.ftruncate(self._fd, size)
+        self.slots = size // _SLOT.size
+        self._map = mmap.mmap(self._fd, self.slots * _SLOT.size)
+
+    @contextmanager
+    def _flock(self) -> Iterator[None]:
+        import fcntl
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Holds the lock of the store across threads and processes."""
+        if self._pid != os.getpid():
+            self.close()
+            self._open()
+        with self._lock, self._flock():
+            yield
+
+    def _find(self, name: bytes, create: bool) -> Optional[int]:
+        # The name of a slot is never erased, so the slots probed for a name stay
+        # in use until the name is found or an unused slot ends the search.
+        now = time.monotonic()
+        free = None
+        start = zlib.crc32(name) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            slot_name, has_calls, has_tokens, deadline, *_ = _SLOT.unpack_from(
+                self._map, slot * _SLOT.size
+            )
+            if slot_name == name:
+                return slot
+            if free is None and (not (has_calls or has_tokens) or deadline <= now):
+                free = slot  # Empty, or its state no longer limits anything
+            if not slot_name.strip(b"\0"):
+                break
+        if not create:
+            return None
+        if free is None:
+            raise RuntimeError(
+                f"The shared memory store {self.path} is full, "
+                "use a larger number of slots."
+            )
+        return free
+
+    def load(
+        self, model_name: str, algorithm: str, window: str = ""
+    ) -> Tuple[Any, Any]:
+        """
+        Returns the calls and tokens states of the model, the lock must be held.
+
+        Args:
+            model_name (str): The name of the model.
+            algorithm (str): The algorithm of the states.
+            window (str): The name of an extra window of the budget, empty for the main one.
+
+        Returns:
+            Tuple[Any, Any]: The states, None for the missing ones.
+        """
+        name = self._name(model_name, algorithm + window)
+        slot = self._find(name, create=False)
+        if slot is None:
+            return None, None
+        _, has_calls, has_tokens, _, *values = _SLOT.unpack_from(
+            self._map, slot * _SLOT.size
+        )
+        calls = _decode(algorithm, tuple(values[:3])) if has_calls else None
+        tokens = _decode(algorithm, tuple(values[3:])) if has_tokens else None
+        return calls, tokens
+
+    def store(
+        self,
+        model_name: str,
+        algorithm: str,
+        calls: Any,
+        tokens: Any,
+        period: float,
+        window: str = "",
+    ):
+        """
+        Stores the calls and tokens states of the model, the lock must be held.
+
+        Args:
+            model_name (str): The name of the model.
+            algorithm (str): The algorithm of the states.
+            calls (Any): The calls state, None if the window does not limit calls.
+            tokens (Any): The tokens state, None if the window does not limit tokens.
+            period (float): The period the limits apply to in seconds.
+            window (str): The name of an extra window of the budget, empty for the main one.
+        """
+        name = self._name(model_name, algorithm + window)
+        slot = self._find(name, create=True)
+        deadline = max(
+            state_expiry(algorithm, state, period)
+            for state in (calls, tokens)
+            if state is not None
+        )
+        _SLOT.pack_into(
+            self._map,
+            slot * _SLOT.size,
+            name,
+            calls is not None,
+            tokens is not None,
+            deadline,
+            *_encode(calls),
+            *_encode(tokens),
+        )
+
+    def load_holders(self, model_name: str) -> List[Tuple[int, float, int]]:
+        """
+        Returns the processes holding in-flight slots of the model, the lock must
+        be held.
+
+        Args:
+            model_name (str): The name of the model.
+
+        Returns:
+            List[Tuple[int, float, int]]: The pid of each process, the time its slots
+            expire and the number of slots it holds.
+        """
+        holders = []
+        for i in itertools.count():
+            slot = self._find(self._holder_name(model_name, i), create=False)
+            if slot is None:
+                break
+            _, has_slots, _, _, pid, deadline, count, *_ = _SLOT.unpack_from(
+                self._map, slot * _SLOT.size
+            )
+            if not has_slots:
+                break
+            holders.append((int(pid), deadline, int(count)))
+        return holders
+
+    def store_holders(self, model_name: str, holders: List[Tuple[int, float, int]]):
+        """
+        Stores the processes holding in-flight slots of the model, one slot each,
+        the lock must be held.
+
+        Args:
+            model_name (str): The name of the model.
+            holders (List[Tuple[int, float, int]]): The pid of each process, the time
+                                                    its slots expire and their number.
+        """
+        # Every entry lives as long as the last one, so that no entry of the table
+        # is reused by another state while the ones after it are still read.
+        deadline = max((holder[1] for holder in holders), default=0.0)
+        for i, holder in enumerate(holders):
+            name = self._holder_name(model_name, i)
+            slot = self._find(name, create=True)
+            _SLOT.pack_into(
+                self._map,
+                slot * _SLOT.size,
+                name,
+                1,
+                0,
+                deadline,
+                *holder,
+                *(0.0,) * 3,
+            )
+        name = self._holder_name(model_name, len(holders))
+        slot = self._find(name, create=False)
+        if slot is not None:  # Ends the table
+            _SLOT.pack_into(self._map, slot * _SLOT.size, name, 0, 0, 0.0, *(0.0,) * 6)
+
+    def _holder_name(self, model_name: str, index: int) -> bytes:
+        return self._name(model_name, f"fixed@in_flight:{index}")
+
+    def clear(self, model_name: str) -> bool:
+        """
+        Removes the states of the model for every algorithm.
+
+        Args:
+            model_name (str): The name of the model.
+
+        Returns:
+            bool: True if a state was removed, False otherwise.
+        """
+        prefix = self._model_key(model_name) + b":"
+        cleared = False
+        with self.transaction():
+            for slot in range(self.slots):
+                offset = slot * _SLOT.size
+                slot_name, has_calls, has_tokens, *_ = _SLOT.unpack_from(
+                    self._map, offset
+                )
+                if not (has_calls or has_tokens) or not slot_name.startswith(prefix):
+                    continue
+                suffix = slot_name[len(prefix) :].rstrip(b"\0")
+                algorithm = suffix.split(b"@")[0].split(b"#")[0]
+                if algorithm.decode(errors="replace") in ALGORITHM_FUNCTIONS:
+                    # The name is kept for the slots probed after this one.
+                    _SLOT.pack_into(
+                        self._map, offset, slot_name, 0, 0, 0.0, *(0.0,) * 6
+                    )
+                    cleared = True
+        return cleared
+
+    @staticmethod
+    def _model_key(model_name: str) -> bytes:
+        key = model_name.encode()
+        return key if len(key) <= _MODEL_BYTES else _digest(key, _MODEL_BYTES)
+
+    @classmethod
+    def _name(cls, model_name: str, algorithm: str) -> bytes:
+        """
+        Returns the name of the slot of a state, `{model}:{algorithm}{window}`. A
+        model name longer than 31 bytes or a window name making the suffix longer
+        than 32 bytes is replaced by its hash, the algorithm being kept.
+        """
+        suffix = algorithm.encode()
+        if len(suffix) > _SUFFIX_BYTES:
+            kind = min(i for i in (suffix.find(b"@"), suffix.find(b"#")) if i >= 0)
+            suffix = suffix[: kind + 1] + _digest(
+                suffix[kind + 1 :], _SUFFIX_BYTES - kind - 1
+            )
+        return (cls._model_key(model_name) + b":" + suffix).ljust(_NAME_BYTES, b"\0")
+
+    def close(self):
+        """Unmaps the file, the state stays in it for the other processes."""
+        self._map.close()
+        os.close(self._fd)
+
+
+class SharedMemoryLimiter:
+    def __init__(
+        self,
+        model_name: str,
+        max_calls: int,
+        max_tokens: int,
+        period: int,
+        tokens: int,
+        store: SharedMemoryStore,
+        algorithm: str = "fixed",
+        jitter: float = 0.0,
+        windows: Sequence[Window] = (),
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        priorities: Sequence[float] = (),
+        tenants: Sequence[Tenant] = (),
+        priority: int = 0,
+        tenant: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.period = period
+        self.tokens = tokens
+        self.store = store
+        self.algorithm = algorithm
+        self.jitter = jitter
+        self.windows = windows
+        self.max_in_flight = max_in_flight
+        # The seconds the request waits for the budget, None to wait as long as needed.
+        self.timeout = timeout
+        self.priorities = priorities
+        self.tenants = tenants
+        self.priority = priority
+        self.tenant = tenant
+        self._priority_share = priority_share(priorities, priority)
+        self._tenant = tenant_index(tenants, tenant)
+        self.used_tokens: Optional[int] = None
+        self._deadline = 0.0
+        self._in_flight = False
+
+    def _admit(self, dry_run: bool = False) -> float:
+        """
+        Checks and reserves the budget with the algorithm in one transaction on the
+        store, nothing is reserved when the request does not fit.
+
+        Args:
+            dry_run (bool): Only check the budget without reserving it.
+
+        Returns:
+            float: The seconds to wait before the request fits, 0 if it was admitted.
+        """
+        algorithm = ALGORITHM_FUNCTIONS[self.algorithm]
+        with self.store.transaction():
+            calls, tokens = self.store.load(self.model_name, self.algorithm)
+            now = time.monotonic()
+            calls_wait, current_calls, calls_state = algorithm(
+                calls, now, self.period, self.max_calls, 1
+            )
+            tokens_wait, current_tokens, tokens_state = algorithm(
+                tokens, now, self.period, self.max_tokens, self.tokens
+            )
+            windows_wait, windows = reserve_windows(
+                self.algorithm,
+                self._load_windows(),
+                now,
+                self._window_limits(),
+                1,
+                self.tokens,
+            )
+            shares_wait, tenant_wait, tenant = reserve_shares(
+                self.algorithm,
+                self._load_shares(),
+                (calls, tokens),
+                now,
+                self.period,
+                (self.max_calls, self.max_tokens),
+                1,
+                self.tokens,
+            )
+            in_flight_wait, slots = self._take_in_flight(now, 1)
+            wait = max(
+                calls_wait,
+                tokens_wait,
+                windows_wait,
+                shares_wait,
+                tenant_wait,
+                in_flight_wait,
+            )
+            if wait > 0 or dry_run:
+                self.current_calls = round(current_calls)
+                self.current_tokens = round(current_tokens)
+                return wait
+            self.store.store(
+                self.model_name, self.algorithm, calls_state, tokens_state, self.period
+            )
+            self._store_windows(windows, slots, tenant)
+        self.current_calls = round(current_calls + 1)
+        self.current_tokens = round(current_tokens + self.tokens)
+        self._deadline = reservation_deadline(self.algorithm, tokens_state, self.period)
+        return 0
+
+    def _window_limits(self) -> List[WindowLimits]:
+        return [(window.calls, window.tokens, window.period) for window in self.windows]
+
+    def _load_windows(self) -> List[Tuple[Any, Any]]:
+        """Returns the states of the extra windows, the lock must be held."""
+        return [
+            self.store.load(self.model_name, self.algorithm, f"@{window.period:g}")
+            for window in self.windows
+        ]
+
+    def _load_shares(self) -> Shares:
+        """Returns the shares of the budget, the lock must be held."""
+        return Shares(
+            self._priority_share,
+            self._tenant,
+            [
+                (tenant.weight, tenant.min_calls, tenant.min_tokens)
+                for tenant in self.tenants
+            ],
+            [
+                self.store.load(self.model_name, self.algorithm, f"#{tenant.name}")
+                for tenant in self.tenants
+            ],
+        )
+
+    def _take_in_flight(self, now: float, count: int) -> Tuple[float, Any]:
+        """
+        Checks the in-flight slots of `count` requests, the lock must be held. The
+        slots are counted per process, each holder with its own expiry renewed by
+        its own admissions, so that the slots of a process that died are freed as
+        soon as it is found gone, or `in_flight_timeout` seconds after its last
+        admission.
+
+        Returns:
+            Tuple[float, Any]: The seconds to wait for the slots (0 if they are free)
+            and the holders to store if they are taken, None without an in-flight limit.
+        """
+        if self.max_in_flight is None:
+            return 0.0, None
+        holders = self._holders(now)
+        held = sum(slots for _, _, slots in holders)
+        wait = in_flight_poll if held + count > self.max_in_flight else 0.0
+        pid = os.getpid()
+        mine = sum(slots for holder, _, slots in holders if holder == pid)
+        holders = [holder for holder in holders if holder[0] != pid]
+        holders.append((pid, now + in_flight_timeout, mine + count))
+        return wait, holders
+
+    def _holders(self, now: float) -> List[Tuple[int, float, int]]:
+        """Returns the live holders of in-flight slots, the lock must be held."""
+        return [
+            (pid, deadline, slots)
+            for pid, deadline, slots in self.store.load_holders(self.model_name)
+            if deadline > now and slots > 0 and _alive(pid)
+        ]
+
+    def _store_windows(
+        self,
+        windows: List[Tuple[Any, Any]],
+        slots: Any,
+        tenant: Optional[Tuple[Any, Any]] = None,
+    ):
+        """
+        Stores the states of the extra windows, of the in-flight slots and of the
+        tenant of the request.
+        """
+        for window, (calls, tokens) in zip(self.windows, windows):
+            if calls is not None or tokens is not None:
+                self.store.store(
+                    self.model_name,
+                    self.algorithm,
+                    calls,
+                    tokens,
+                    window.period,
+                    f"@{window.period:g}",
+                )
+        if slots is not None:
+            self.store.store_holders(self.model_name, slots)
+            self._in_flight = True
+        if tenant is not None and tenant != (None, None):
+            self.store.store(
+                self.model_name, self.algorithm, *tenant, self.period, f"#{self.tenant}"
+            )
+
+    def _release_in_flight(self):
+        with self.store.transaction():
+            pid = os.getpid()
+            holders = []
+            for holder, deadline, slots in self._holders(time.monotonic()):
+                if holder == pid:
+                    slots -= 1
+                if slots > 0:
+                    holders.append((holder, deadline, slots))
+            self.store.store_holders(self.model_name, holders)
+
+    def _admit_batch(self, costs: List[int], whole: bool = False) -> Tuple[int, float]:
+        """
+        Admits the longest prefix of a batch of requests that fits in the budget, in
+        one transaction on the store.
+
+        Args:
+            costs (List[int]): The tokens of each request, in order.
+            whole (bool): Admit all the requests or none of them.
+
+        Returns:
+            Tuple[int, float]: The number of admitted requests and the seconds to wait
+            before the next one fits, 0 if all were admitted.
+        """
+        with self.store.transaction():
+            calls, tokens = self.store.load(self.model_name, self.algorithm)
+            now = time.monotonic()
+            free = None
+            if self.max_in_flight is not None:
+                held = sum(slots for _, _, slots in self._holders(now))
+                free = max(self.max_in_flight - held, 0)
+            admitted, wait, calls, tokens, windows, tenant = admit_batch(
+                self.algorithm,
+                calls,
+                tokens,
+                now,
+                self.period,
+                self.max_calls,
+                self.max_tokens,
+                costs[:free],
+                self._load_windows(),
+                self._window_limits(),
+                self._load_shares(),
+            )
+            if admitted < len(costs) and not wait:
+                wait = in_flight_poll  # Out of in-flight slots
+            if whole and admitted < len(costs):
+                admitted = 0  # All or nothing
+            if admitted:
+                self.store.store(
+                    self.model_name, self.algorithm, calls, tokens, self.period
+                )
+                self._store_windows(
+                    windows, self._take_in_flight(now, admitted)[1], tenant
+                )
+                self._deadline = reservation_deadline(
+                    self.algorithm, tokens, self.period
+                )
+        return admitted, wait
+
+    def _usage(self) -> Usage:
+        with self.store.transaction():
+            calls, tokens = self.store.load(self.model_name, self.algorithm)
+        return snapshot(
+            self.algorithm,
+            calls,
+            tokens,
+            time.monotonic(),
+            self.period,
+            self.max_calls,
+            self.max_tokens,
+        )
+
+    def _observe(self, observation: Observation):
+        with self.store.transaction():
+            calls, tokens = self.store.load(self.model_name, self.algorithm)
+            calls, tokens = observe_states(
+                self.algorithm,
+                calls,
+                tokens,
+                time.monotonic(),
+                self.period,
+                self.max_calls,
+                self.max_tokens,
+                observation,
+            )
+            self.store.store(
+                self.model_name, self.algorithm, calls, tokens, self.period
+            )
+
+    def refund(self, tokens: int, calls: int = 0):
+        """
+        Credits reserved budget back to the window it was reserved in. Nothing is
+        credited once that window is over.
+
+        Args:
+            tokens (int): The number of tokens to give back.
+            calls (int): The number of calls to give back.
+        """
+        refund = REFUND_FUNCTIONS[self.algorithm]
+        with self.store.transaction():
+            now = time.monotonic()
+            if now >= self._deadline:
+                return
+            # Every state is refunded on its own, a missing one is skipped.
+            calls_state, tokens_state = self.store.load(self.model_name, self.algorithm)
+            if calls_state is not None and calls > 0:
+                calls_state = refund(
+                    calls_state, now, self.period, self.max_calls, calls
+                )
+            if tokens_state is not None and tokens > 0:
+                tokens_state = refund(
+                    tokens_state, now, self.period, self.max_tokens, tokens
+                )
+            if calls_state is not None or tokens_state is not None:
+                self.store.store(
+                    self.model_name,
+                    self.algorithm,
+                    calls_state,
+                    tokens_state,
+                    self.period,
+                )
+            windows = refund_windows(
+                self.algorithm,
+                self._load_windows(),
+                now,
+                self._window_limits(),
+                calls,
+                tokens,
+            )
+            tenant = None
+            if self.tenant is not None:
+                # The counters of the tenant are refunded as one more window.
+                [tenant] = refund_windows(
+                    self.algorithm,
+                    [
+                        self.store.load(
+                            self.model_name, self.algorithm, f"#{self.tenant}"
+                        )
+                    ],
+                    now,
+                    [(self.max_calls, self.max_tokens, self.period)],
+                    calls,
+                    tokens,
+                )
+            self._store_windows(windows, None, tenant)
+
+    def record_usage(self, usage: Any):
+        """
+        Records the tokens actually used by the request, the unused part of the
+        reservation is given back when the context manager exits.
+
+        Args:
+            usage (CompletionUsage | Dict[str, int] | int): The `usage` of the OpenAI response.
+        """
+        self.used_tokens = usage_tokens(usage)
+
+    def __enter__(self):
+        deadline = timeout_deadline(self.timeout)
+        while True:
+            wait = self._admit()
+            if not wait:
+                break
+            check_timeout(deadline, wait)
+            time.sleep(backoff(wait, self.jitter))
+        return self
+
+    def try_acquire(self) -> float:
+        """
+        Reserves the budget if the request fits right now, without waiting.
+
+        Returns:
+            float: 0 if the request was admitted, to be released with `release()`,
+            otherwise the predicted seconds until it fits, nothing being reserved.
+        """
+        return self._admit()
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[types.TracebackType],
+    ) -> Optional[bool]:
+        if self.used_tokens is not None:
+            if self.used_tokens < self.tokens:
+                self.refund(self.tokens - self.used_tokens)
+        elif exc_type is not None:
+            # The request failed before a response was received.
+            self.refund(self.tokens)
+        if self._in_flight:
+            self._in_flight = False
+            self._release_in_flight()
+
+    def release(self):
+        """
+        Releases a reservation taken with `limit_many()` instead of the context
+        manager, giving back the tokens that were not used.
+        """
+        self.__exit__(None, None, None)
+
+    def clear_locks(self) -> bool:
+        """
+        This method will clear all locks associated with the model.
+        returns True if the locks were cleared successfully, otherwise returns False.
+        """
+        return self.store.clear(self.model_name)
+
+    def is_locked(self, tokens: int) -> bool:
+        """
+        This method will check if there are any locks associated with the model.
+
+        Args:
+            tokens (int): The number of tokens to be used for the check.
+
+        Returns:
+            bool: True if the lock is held, False otherwise.
+        """
+        return self._admit(dry_run=True) > 0
@@ -0,0 +1,379 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from tiktoken.core import Encoding
+
+# Approximate memory taken by one cache entry: the key tuple, the digest, the
+# count and the ordered dict node.
+_ENTRY_BYTES = 256
+
+# Number of threads used by tiktoken to encode batches of texts.
+num_threads = 8
+# Smallest number of texts encoded as a batch, smaller sets are encoded inline
+# since starting the thread pool costs more than it saves.
+batch_threshold = 16
+
+
+# Encoders loaded so far by model name, None for models unknown to tiktoken.
+_encoders: Dict[str, Optional["Encoding"]] = {}
+_encoder_locks: Dict[str, threading.Lock] = {}
+
+
+def get_encoder(model_name: str) -> Optional["Encoding"]:
+    """
+    Returns the encoder of the model, loading it on first use. Encoders are shared
+    by every limiter of the process.
+
+    Args:
+        model_name (str): The name of the model.
+
+    Returns:
+        Encoding | None: The encoder, None if tiktoken does not know the model.
+    """
+    try:
+        return _encoders[model_name]
+    except KeyError:
+        pass
+    with _encoder_locks.setdefault(model_name, threading.Lock()):
+        if model_name not in _encoders:
+            import tiktoken
+
+            try:
+                _encoders[model_name] = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                _encoders[model_name] = None
+    return _encoders[model_name]
+
+
+def prewarm_encoders(
+    model_names: Iterable[str], background: bool = True
+) -> Optional[threading.Thread]:
+    """
+    Loads the encoders of the models ahead of their first use.
+
+    Args:
+        model_names (Iterable[str]): The names of the models.
+        background (bool): Load them in a daemon thread instead of blocking.
+
+    Returns:
+        threading.Thread | None: The loading thread when loading in the background.
+    """
+    model_names = list(model_names)
+
+    def load():
+        for model_name in model_names:
+            get_encoder(model_name)
+
+    if not background:
+        load()
+        return None
+    thread = threading.Thread(
+        target=load, name="openai-ratelimiter-prewarm", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _key(text: str, encoder: "Encoding") -> Tuple[str, bytes]:
+    return encoder.name, hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def _encode_batch(
+    texts: List[str], encoder: "Encoding", threads: Optional[int] = None
+) -> List[int]:
+    threads = threads or num_threads
+    if len(texts) >= batch_threshold and threads > 1:
+        encodings = encoder.encode_ordinary_batch(texts, num_threads=threads)
+    else:
+        encodings = [encoder.encode_ordinary(text) for text in texts]
+    return [len(encoding) for encoding in encodings]
+
+
+class TokenCountCache:
+    """
+    Thread-safe LRU cache of token counts keyed by the hash of the content.
+
+    Counts are scoped per encoding, so the same cache can be shared by limiters
+    of models using different encodings. The memory of the cache is estimated at a
+    fixed 256 bytes per entry rather than measured, whatever the length of the texts.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        """
+        Args:
+            max_bytes (int): The approximate memory the cache may use, the least
+                             recently used counts are evicted above it. Holds
+                             `max_bytes // 256` entries.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._counts: "OrderedDict[Tuple[str, bytes], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """The approximate memory used by the cache in bytes."""
+        return len(self._counts) * _ENTRY_BYTES
+
+    def count(self, text: str, encoder: "Encoding") -> int:
+        """
+        Returns the number of tokens of the text, encoding it only on a cache miss.
+
+        Args:
+            text (str): The text to count.
+            encoder (Encoding): The encoding of the model.
+
+        Returns:
+            int: The number of tokens.
+        """
+        key = _key(text, encoder)
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+
+        tokens = len(encoder.encode_ordinary(text))
+        with self._lock:
+            self._store(key, tokens)
+        return tokens
+
+    def count_many(
+        self, texts: List[str], encoder: "Encoding", threads: Optional[int] = None
+    ) -> List[int]:
+        """
+        Returns the number of tokens of each text, the cache misses are encoded as
+        one batch.
+
+        Args:
+            texts (List[str]): The texts to count.
+            encoder (Encoding): The encoding of the model.
+            threads (int | None): The number of threads encoding the batch, defaults
+                                  to `num_threads`.
+
+        Returns:
+            List[int]: The number of tokens of each text.
+        """
+        keys = [_key(text, encoder) for text in texts]
+        counts: List[Optional[int]] = []
+        missing: Dict[Tuple[str, bytes], str] = {}
+        with self._lock:
+            for key, text in zip(keys, texts):
+                tokens = self._counts.get(key)
+                if tokens is None:
+                    self.misses += 1
+                    missing[key] = text
+                else:
+                    self._counts.move_to_end(key)
+                    self.hits += 1
+                counts.append(tokens)
+
+        if missing:
+            encoded = dict(
+                zip(missing, _encode_batch(list(missing.values()), encoder, threads))
+            )
+            with self._lock:
+                for key, tokens in encoded.items():
+                    self._store(key, tokens)
+            counts = [
+                encoded[key] if tokens is None else tokens
+                for key, tokens in zip(keys, counts)
+            ]
+        return counts  # type: ignore
+
+    def _store(self, key: Tuple[str, bytes], tokens: int):
+        self._counts[key] = tokens
+        while len(self._counts) * _ENTRY_BYTES > self.max_bytes:
+            self._counts.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the hit and miss statistics of the cache.
+
+        Returns:
+            Dict[str, int]: The hits, misses, number of entries and size in bytes.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._counts),
+                "size": len(self._counts) * _ENTRY_BYTES,
+            }
+
+    def clear(self):
+        """Removes every count and resets the statistics."""
+        with self._lock:
+            self._counts.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# The cache shared by every limiter of the process.
+token_cache = TokenCountCache()
+
+
+def count_tokens(
+    text: str, encoder: "Encoding", cache: Optional[TokenCountCache] = token_cache
+) -> int:
+    """
+    Returns the number of tokens of the text.
+
+    Args:
+        text (str): The text to count.
+        encoder (Encoding): The encoding of the model.
+        cache (TokenCountCache | None): The cache to use, None to always encode.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if cache is None:
+        return len(encoder.encode_ordinary(text))
+    return cache.count(text, encoder)
+
+
+def count_tokens_batch(
+    texts: List[str],
+    encoder: "Encoding",
+    cache: Optional[TokenCountCache] = token_cache,
+    threads: Optional[int] = None,
+) -> List[int]:
+    """
+    Returns the number of tokens of each text, encoding them with tiktoken's
+    batch encoder when there are at least `batch_threshold` of them.
+
+    Args:
+        texts (List[str]): The texts to count.
+        encoder (Encoding): The encoding of the model.
+        cache (TokenCountCache | None): The cache to use, None to always encode.
+        threads (int | None): The number of threads encoding the batch, defaults
+                              to `num_threads`.
+
+    Returns:
+        List[int]: The number of tokens of each text.
+    """
+    if cache is None:
+        return _encode_batch(texts, encoder, threads)
+    return cache.count_many(texts, encoder, threads)
+
+
+def num_tokens_consumed_by_chat_request(
+    messages: List[Dict[str, str]],
+    encoder: "Encoding",
+    max_tokens: int = 15,
+    n: int = 1,
+    cache: Optional[TokenCountCache] = token_cache,
+    threads: Optional[int] = None,
+):
+    request = {"messages": messages, "max_tokens": max_tokens, "n": n}
+    return num_tokens_consumed_by_chat_requests([request], encoder, cache, threads)[0]
+
+
+def num_tokens_consumed_by_chat_requests(
+    requests: List[Dict[str, Any]],
+    encoder: "Encoding",
+    cache: Optional[TokenCountCache] = token_cache,
+    threads: Optional[int] = None,
+) -> List[int]:
+    """
+    Returns the tokens consumed by each chat request, the contents of all the
+    requests are counted as one batch.
+
+    Args:
+        requests (List[Dict[str, Any]]): The requests, each with its `messages` and
+                                         optionally its `max_tokens` and `n`.
+        encoder (Encoding): The encoding of the model.
+        cache (TokenCountCache | None): The cache to use, None to always encode.
+        threads (int | None): The number of threads encoding the batch.
+
+    Returns:
+        List[int]: The tokens consumed by each request.
+    """
+    totals: List[int] = []
+    values: List[str] = []
+    owners: List[int] = []
+    for index, request in enumerate(requests):
+        num_tokens = request.get("n", 1) * request.get("max_tokens", 15)
+        for message in request["messages"]:
+            num_tokens += (
+                4  # Every message follows <im_start>{role/name}\n{content}<im_end>\n
+            )
+            for key, value in message.items():
+                values.append(value)
+                owners.append(index)
+
+                if key == "name":  # If there's a name, the role is omitted
+                    num_tokens -= 1
+
+        num_tokens += 2  # Every reply is primed with <im_start>assistant
+        totals.append(num_tokens)
+
+    counts = count_tokens_batch(values, encoder, cache, threads)
+    for index, tokens in zip(owners, counts):
+        totals[index] += tokens
+    return totals
+
+
+def num_tokens_consumed_by_completion_request(
+    prompt: Union[str, list[str], Any],
+    encoder: "Encoding",
+    max_tokens: int = 15,
+    n: int = 1,
+    cache: Optional[TokenCountCache] = token_cache,
+    threads: Optional[int] = None,
+):
+    request = {"prompt": prompt, "max_tokens": max_tokens, "n": n}
+    return num_tokens_consumed_by_completion_requests(
+        [request], encoder, cache, threads
+    )[0]
+
+
+def num_tokens_consumed_by_completion_requests(
+    requests: List[Dict[str, Any]],
+    encoder: "Encoding",
+    cache: Optional[TokenCountCache] = token_cache,
+    threads: Optional[int] = None,
+) -> List[int]:
+    """
+    Returns the tokens consumed by each completion request, the prompts of all the
+    requests are counted as one batch.
+
+    Args:
+        requests (List[Dict[str, Any]]): The requests, each with its `prompt` and
+                                         optionally its `max_tokens` and `n`.
+        encoder (Encoding): The encoding of the model.
+        cache (TokenCountCache | None): The cache to use, None to always encode.
+        threads (int | None): The number of threads encoding the batch.
+
+    Returns:
+        List[int]: The tokens consumed by each request.
+    """
+    totals: List[int] = []
+    prompts: List[str] = []
+    owners: List[int] = []
+    for index, request in enumerate(requests):
+        prompt = request["prompt"]
+        num_tokens = request.get("n", 1) * request.get("max_tokens", 15)
+        if isinstance(prompt, str):  # Single prompt
+            prompts.append(prompt)
+            owners.append(index)
+        elif isinstance(prompt, list):  # Multiple prompts
+            num_tokens *= len(prompt)
+            prompts.extend(prompt)
+            owners.extend(index for _ in prompt)
+        else:
+            raise TypeError(
+                "Either a string or list of strings expected for 'prompt' field in completion request."
+            )
+        totals.append(num_tokens)
+
+    counts = count_tokens_batch(prompts, encoder, cache, threads)
+    for index, tokens in zip(owners, counts):
+        totals[index] += tokens
+    return totals
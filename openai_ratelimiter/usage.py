@@ -0,0 +1,62 @@
+from typing import Any, NamedTuple, Optional
+
+
+def usage_tokens(usage: Any) -> int:
+    """
+    Returns the number of tokens billed for a request.
+
+    Args:
+        usage (CompletionUsage | Dict[str, int] | int): The `usage` of an OpenAI response,
+            either the object, its dict form or the total number of tokens.
+
+    Returns:
+        int: The total number of tokens.
+    """
+    if isinstance(usage, int):
+        return usage
+    if isinstance(usage, dict):
+        get = usage.get
+    else:
+        get = lambda key: getattr(usage, key, None)  # noqa: E731
+    total = get("total_tokens")
+    if total is None:
+        total = (get("prompt_tokens") or 0) + (get("completion_tokens") or 0)
+    return total
+
+
+class Usage(NamedTuple):
+    """A snapshot of the budget of a model."""
+
+    # The calls and tokens used in the current window.
+    calls: int
+    tokens: int
+    # The calls and tokens still available in the current window.
+    remaining_calls: int
+    remaining_tokens: int
+    # The seconds until the whole budget is available again.
+    reset: float
+
+
+class Utilization(NamedTuple):
+    """The part of the limits of a window of the budget in use."""
+
+    # The length of the window in seconds.
+    period: float
+    # The parts of the calls and tokens limits in use, None for no limit.
+    calls: Optional[float]
+    tokens: Optional[float]
+
+
+def utilization(
+    period: float,
+    max_calls: Optional[int],
+    max_tokens: Optional[int],
+    calls: int,
+    tokens: int,
+) -> Utilization:
+    """Returns the utilization of a window from its limits and usage."""
+    return Utilization(
+        period,
+        None if max_calls is None else calls / max_calls,
+        None if max_tokens is None else tokens / max_tokens,
+    )
@@ -1,9 +1,19 @@
 import asyncio
+import threading
+import time
 
 import pytest
 import redis.asyncio as redis
 
-from openai_ratelimiter.asyncio import AsyncChatCompletionLimiter, AsyncDalleLimiter
+from openai_ratelimiter import APIKey, RateLimitTimeout
+from openai_ratelimiter.asyncio import (
+    AsyncChatCompletionLimiter,
+    AsyncDalleLimiter,
+    AsyncKeyPool,
+    LimiterManager,
+)
+from openai_ratelimiter.asyncio.base import _stores
+from openai_ratelimiter.tokens import get_encoder, num_tokens_consumed_by_chat_request
 
 model_name = "gpt-3.5-turbo-16k"
 messages = [
@@ -103,3 +113,292 @@ async def test_async_dalle():
     await asyncio.sleep(7)
     if await achatlimiter.is_locked():
         pytest.fail("The lock should have expired.")
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_gcra():
+    max_tokens = 200
+    achatlimiter = AsyncChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+        algorithm="gcra",
+    )
+    await achatlimiter.clear_locks()
+    achatlimiter.period = 5
+
+    async def make_request():
+        await achatlimiter.limit(messages=messages, max_tokens=max_tokens).__aenter__()
+
+    for _ in range(5):
+        try:
+            await asyncio.wait_for(make_request(), timeout=2)
+        except asyncio.TimeoutError:
+            pytest.fail("The request should have been completed.")
+    if not await achatlimiter.is_locked(messages=messages, max_tokens=max_tokens):
+        pytest.fail("The request should have timed out.")
+    # One request worth of tokens drips back every 5 / 5 seconds.
+    try:
+        await asyncio.wait_for(make_request(), timeout=2)
+    except asyncio.TimeoutError:
+        pytest.fail("The request should have been admitted within a second.")
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_refund():
+    max_tokens = 200
+    achatlimiter = AsyncChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+    )
+    await achatlimiter.clear_locks()
+
+    for _ in range(5):
+        async with achatlimiter.limit(
+            messages=messages, max_tokens=max_tokens
+        ) as limiter:
+            limiter.record_usage({"prompt_tokens": 25, "completion_tokens": 10})
+    try:
+        async with achatlimiter.limit(messages=messages, max_tokens=max_tokens):
+            raise RuntimeError("The request failed before reaching the API.")
+    except RuntimeError:
+        pass
+    if await achatlimiter.is_locked(messages=messages, max_tokens=max_tokens):
+        pytest.fail("The unused tokens should have been refunded.")
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_fifo():
+    max_tokens = 200
+    achatlimiter = AsyncChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=450,  # 450 = 225 * 2
+    )
+    await achatlimiter.clear_locks()
+    achatlimiter.period = 2
+    order = []
+
+    async def make_request(i):
+        async with achatlimiter.limit(messages=messages, max_tokens=max_tokens):
+            order.append(i)
+
+    await asyncio.wait_for(
+        asyncio.gather(*(make_request(i) for i in range(6))), timeout=6
+    )
+    assert order == list(range(6))
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_sjf():
+    manager = LimiterManager()
+    alimiter = manager.register(model_name, RPM=3_000, TPM=1_000, scheduler="sjf")
+    await alimiter.clear_locks()
+    alimiter.period = 1
+    await manager.acquire(model_name, 700)
+    order = []
+
+    async def make_request(name, tokens):
+        await manager.acquire(model_name, tokens)
+        order.append(name)
+
+    large = asyncio.ensure_future(make_request("large", 900))
+    await asyncio.sleep(0.01)
+    small = [asyncio.ensure_future(make_request(i, 100)) for i in range(3)]
+    # The small requests fit in what is left of the window, the large one does not.
+    await asyncio.wait_for(asyncio.gather(*small), timeout=0.5)
+    assert order == [0, 1, 2]
+    [window] = await alimiter.utilization()
+    assert window.tokens == 1.0
+    # A lower priority never passes the waiting large request.
+    low = asyncio.ensure_future(manager.acquire(model_name, 0, priority=1))
+    await asyncio.sleep(0.1)
+    assert not low.done()
+    await asyncio.wait_for(large, timeout=3)
+    await asyncio.wait_for(low, timeout=1)
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_priorities():
+    adallelimiter = AsyncDalleLimiter(
+        model_name="dall-e-2", IPM=1, priorities=(1.0, 1.0)
+    )
+    await adallelimiter.clear_locks()
+    adallelimiter.period = 1
+    await adallelimiter.acquire()
+    order = []
+
+    async def make_request(priority):
+        await adallelimiter.acquire(priority=priority)
+        order.append(priority)
+
+    low = asyncio.ensure_future(make_request(1))
+    await asyncio.sleep(0.1)
+    high = asyncio.ensure_future(make_request(0))
+    # The request of priority 0 goes ahead of the one already waiting.
+    await asyncio.wait_for(asyncio.gather(low, high), timeout=4)
+    assert order == [0, 1]
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_key_pool():
+    pool = AsyncKeyPool(
+        model_name,
+        [APIKey("org-a", RPM=1, TPM=1_000), APIKey("org-b", RPM=1, TPM=1_000)],
+    )
+    await pool.clear_locks()
+    pool.period = 1
+    first = await pool.acquire(100)
+    second = await pool.acquire(100)
+    assert {first.key, second.key} == {"org-a", "org-b"}
+    # Clearing the budget of the model leaves the budgets of the pool alone.
+    await AsyncChatCompletionLimiter(
+        model_name=model_name, RPM=3_000, TPM=1_125
+    ).clear_locks()
+    assert (await pool.usage("org-a")).calls == 1
+    start = asyncio.get_running_loop().time()
+    third = await pool.acquire(100, timeout=3)
+    assert asyncio.get_running_loop().time() - start >= 0.5
+    assert third.key == first.key
+    for limiter in (first, second, third):
+        await limiter.release()
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_cancel():
+    adallelimiter = AsyncDalleLimiter(model_name="dall-e-2", IPM=1)
+    await adallelimiter.clear_locks()
+    adallelimiter.period = 2
+    await adallelimiter.acquire()
+    with pytest.raises(RateLimitTimeout):
+        await adallelimiter.acquire(timeout=0.5)
+    waiting = asyncio.ensure_future(adallelimiter.acquire())
+    await asyncio.sleep(0.1)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    # Neither request left a reservation behind.
+    await asyncio.sleep(2)
+    assert await adallelimiter.limit().try_acquire() == 0
+
+
+def test_async_memory_loops():
+    adallelimiter = AsyncDalleLimiter(model_name="dall-e-2", IPM=1)
+    adallelimiter.period = 1
+    loops = [asyncio.new_event_loop() for _ in range(2)]
+
+    async def admit(limiter=adallelimiter):
+        return await limiter.limit().try_acquire()
+
+    try:
+        # Every event loop keeps its own budgets.
+        for loop in loops:
+            assert loop.run_until_complete(admit()) == 0
+        assert loops[0].run_until_complete(admit()) > 0
+        assert list(_stores[loops[0]]) == [("dall-e-2", "fixed")]
+        # The budgets unused for a whole window are dropped when another is added.
+        time.sleep(1.1)
+        other = AsyncDalleLimiter(model_name="dall-e-3", IPM=1)
+        assert loops[0].run_until_complete(admit(other)) == 0
+        assert list(_stores[loops[0]]) == [("dall-e-3", "fixed")]
+        assert list(_stores[loops[1]]) == [("dall-e-2", "fixed")]
+    finally:
+        for loop in loops:
+            loop.close()
+
+
+class BlockingEncoder:
+    """Encodes only once the event loop has released it."""
+
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.name = encoder.name
+        self.released = threading.Event()
+
+    def encode_ordinary(self, text):
+        assert self.released.wait(5)
+        return self.encoder.encode_ordinary(text)
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_offload():
+    achatlimiter = AsyncChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_000_000,
+    )
+    await achatlimiter.clear_locks()
+    encoder = get_encoder(model_name)
+    long_messages = [{"role": "user", "content": "Offloaded words. " * 2_000}]
+    tokens = num_tokens_consumed_by_chat_request(
+        long_messages, encoder, 200, cache=None
+    )
+    # A long request is counted outside of the event loop, which keeps running.
+    achatlimiter.encoder = BlockingEncoder(encoder)
+    acquiring = asyncio.ensure_future(achatlimiter.acquire(long_messages, 200))
+    await asyncio.sleep(0.1)
+    assert not acquiring.done()
+    achatlimiter.encoder.released.set()
+    limiter = await acquiring
+    assert limiter.tokens == tokens
+    assert (await achatlimiter.usage()).tokens == tokens
+    await limiter.release()
+
+
+@pytest.mark.asyncio()
+async def test_async_memory_acquire_batch():
+    max_tokens = 200
+    achatlimiter = AsyncChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+    )
+    await achatlimiter.clear_locks()
+    achatlimiter.period = 5
+    requests = [{"messages": messages, "max_tokens": max_tokens}] * 8
+    admitted, wait = await achatlimiter.acquire_batch(requests)
+    assert len(admitted) == 5
+    assert 0 < wait <= 5
+    for limiter in admitted:
+        limiter.record_usage(25)
+        await limiter.release()
+    admitted, wait = await achatlimiter.acquire_batch(requests[5:])
+    assert len(admitted) == 3
+    assert wait == 0
+    # The window resets before the request at the head of the queue is woken, the
+    # batch still waits behind it.
+    adallelimiter = AsyncDalleLimiter(model_name="dall-e-2", IPM=1)
+    await adallelimiter.clear_locks()
+    adallelimiter.period = 1
+    await adallelimiter.acquire()
+    head = asyncio.ensure_future(adallelimiter.acquire())
+    await asyncio.sleep(0.01)
+    time.sleep(1.1)
+    admitted, wait = await adallelimiter.acquire_batch(2)
+    assert admitted == []
+    assert wait > 0
+    await asyncio.wait_for(head, timeout=1)
+
+
+@pytest.mark.asyncio()
+async def test_async_redis_manager():
+    redis_instance = redis.Redis(
+        host="localhost",
+        port=6379,
+    )
+    manager = LimiterManager(redis_instance)
+    models = ["gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo"]
+    for model in models:
+        await manager.register(model, RPM=5, TPM=10_000).clear_locks()
+
+    # The admissions of every model are sent in the same pipeline.
+    limiters = await asyncio.wait_for(
+        asyncio.gather(*(manager.acquire(model, 100) for model in models * 5)),
+        timeout=2,
+    )
+    assert len(limiters) == 15
+    for model in models:
+        assert await manager.is_locked(model, 100)
+    for limiter in limiters:
+        await limiter.release()
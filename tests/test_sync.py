@@ -1,10 +1,34 @@
+import os
+import threading
 import time
+import types
 from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import pytest
 import redis
+import tiktoken
 
-from openai_ratelimiter import ChatCompletionLimiter, DalleLimiter
+from openai_ratelimiter import (
+    APIKey,
+    ChatCompletionLimiter,
+    DalleLimiter,
+    KeyPool,
+    RateLimitedOpenAI,
+    RateLimitTimeout,
+    Tenant,
+    TokenCountCache,
+    prewarm_encoders,
+    Window,
+)
+from openai_ratelimiter import tokens
+from openai_ratelimiter.keys import limiter_keys
+from openai_ratelimiter.shm import SharedMemoryStore
+from openai_ratelimiter.tokens import (
+    get_encoder,
+    num_tokens_consumed_by_chat_request,
+    num_tokens_consumed_by_chat_requests,
+    num_tokens_consumed_by_completion_request,
+)
 
 model_name = "gpt-3.5-turbo-16k"
 messages = [
@@ -51,6 +75,41 @@ def test_TPM():
         pytest.fail("The lock should have expired.")
 
 
+def test_atomic_admission():
+    redis_instance = redis.Redis(
+        host="localhost",
+        port=6379,
+    )
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,
+        redis_instance=redis_instance,
+        namespace="test",
+    )
+    chatlimiter.clear_locks()
+    encoder = get_encoder(model_name)
+    assert encoder is not None
+    cost = num_tokens_consumed_by_chat_request(messages, encoder, 200)
+    # Concurrent callers never reserve more than the budget between them.
+    with Executor(max_workers=16) as executor:
+        waits = list(
+            executor.map(
+                lambda _: chatlimiter.limit(messages, 200).try_acquire(), range(40)
+            )
+        )
+    assert waits.count(0) == 1_125 // cost
+    calls_key, tokens_key = limiter_keys(model_name, "fixed", "test")
+    assert int(redis_instance.get(calls_key)) == 1_125 // cost
+    assert int(redis_instance.get(tokens_key)) == 1_125 // cost * cost
+    # A rejected request reserves nothing and waits for the TTL of the window.
+    ttl = redis_instance.pttl(tokens_key)
+    wait = chatlimiter.limit(messages, 200).try_acquire()
+    assert ttl - 100 <= wait * 1000 <= ttl
+    assert int(redis_instance.get(calls_key)) == 1_125 // cost
+    assert int(redis_instance.get(tokens_key)) == 1_125 // cost * cost
+
+
 def test_dalle():
     redis_instance = redis.Redis(
         host="localhost",
@@ -78,3 +137,475 @@ def test_dalle():
     time.sleep(7)
     if chatlimiter.is_locked():
         pytest.fail("The lock should have expired.")
+
+
+def test_lease():
+    redis_instance = redis.Redis(
+        host="localhost",
+        port=6379,
+    )
+    max_tokens = 200
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=250_000,
+        redis_instance=redis_instance,
+        lease=True,
+    )
+    chatlimiter.clear_locks()
+    for _ in range(20):
+        with chatlimiter.limit(messages=messages, max_tokens=max_tokens) as limiter:
+            limiter.record_usage(25)
+    chatlimiter.close()
+    # Once the lease is given back, only the used budget remains reserved.
+    usage = chatlimiter.usage()
+    assert usage.calls == 20
+    assert usage.tokens == 20 * 25
+
+
+def test_shards():
+    redis_instance = redis.Redis(
+        host="localhost",
+        port=6379,
+    )
+    dallelimiter = DalleLimiter(
+        model_name="dall-e-2",
+        IPM=5,
+        redis_instance=redis_instance,
+        namespace="test",
+        shards=2,
+    )
+    dallelimiter.clear_locks()
+    # Requests move to the other shard when theirs is full.
+    for _ in range(5):
+        assert not dallelimiter.is_locked()
+        with dallelimiter.limit():
+            pass
+    assert dallelimiter.is_locked()
+    assert dallelimiter.usage().calls == 5
+    assert redis_instance.exists("test:{dall-e-2:0}:api_calls")
+    assert redis_instance.exists("test:{dall-e-2:1}:api_calls")
+    # A request larger than every shard could never be admitted.
+    chatlimiter = ChatCompletionLimiter(
+        model_name="gpt-3.5-turbo",
+        RPM=100,
+        TPM=1000,
+        redis_instance=redis_instance,
+        namespace="test",
+        shards=4,
+    )
+    with pytest.raises(ValueError):
+        chatlimiter.limit([{"role": "user", "content": "Hello"}], 600)
+
+
+def test_windows():
+    dallelimiter = DalleLimiter(
+        model_name="dall-e-3",
+        IPM=100,
+        windows=[Window(86400, calls=3)],
+        max_in_flight=2,
+    )
+    dallelimiter.clear_locks()
+    first = dallelimiter.limit().__enter__()
+    with dallelimiter.limit():
+        # Both in-flight slots are taken.
+        assert dallelimiter.is_locked()
+    first.release()
+    # The slot is free again, but the daily cap holds the last request.
+    with dallelimiter.limit():
+        pass
+    assert dallelimiter.is_locked()
+    assert dallelimiter.usage().calls == 3
+
+
+def test_timeout():
+    dallelimiter = DalleLimiter(model_name="dall-e-2", IPM=1)
+    dallelimiter.clear_locks()
+    dallelimiter.period = 5
+    assert dallelimiter.limit().try_acquire() == 0
+    assert 0 < dallelimiter.limit().try_acquire() <= 5
+    start = time.monotonic()
+    with pytest.raises(RateLimitTimeout) as error:
+        with dallelimiter.limit(timeout=1):
+            pass
+    # The wait is predicted, the request fails without waiting for the timeout.
+    assert time.monotonic() - start < 1
+    assert 0 < error.value.wait <= 5
+    assert dallelimiter.usage().calls == 1
+
+
+def test_priorities_and_tenants():
+    dallelimiter = DalleLimiter(
+        model_name="dall-e-2",
+        IPM=10,
+        priorities=(1.0, 0.5),
+        tenants=[Tenant("batch"), Tenant("web", min_calls=3)],
+    )
+    dallelimiter.clear_locks()
+
+    def admitted(count, **kwargs):
+        return sum(
+            dallelimiter.limit(**kwargs).try_acquire() == 0 for _ in range(count)
+        )
+
+    # Half of the budget is left to priority 0, and the minimum of "web" is reserved.
+    assert admitted(10, priority=1, tenant="batch") == 2
+    assert admitted(10, tenant="batch") == 5
+    assert admitted(10, tenant="web") == 3
+    assert dallelimiter.usage().calls == 10
+
+
+def test_key_pool():
+    pool = KeyPool(
+        model_name,
+        [APIKey("org-a", RPM=2, TPM=1_000), APIKey("org-b", RPM=3, TPM=3_000)],
+    )
+    pool.clear_locks()
+    keys = []
+    for _ in range(5):
+        limiter = pool.limit(500)
+        assert limiter.try_acquire() == 0
+        keys.append(limiter.key)
+    # Every request goes to the key with the most headroom left after it.
+    assert keys == ["org-b", "org-a", "org-b", "org-a", "org-b"]
+    assert pool.usage("org-b").tokens == 1_500
+    # Both keys are out of calls, the request waits for the one that frees up first.
+    assert pool.limit(500).try_acquire() > 0
+    assert pool.is_locked(500)
+    # Clearing the budget of the model leaves the budgets of the pool alone.
+    ChatCompletionLimiter(model_name=model_name, RPM=3_000, TPM=1_125).clear_locks()
+    assert pool.usage("org-b").tokens == 1_500
+
+
+def test_memory():
+    max_tokens = 200
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+    )
+    chatlimiter.clear_locks()
+    chatlimiter.period = 5
+    with Executor(max_workers=8) as executor:
+        futures = [
+            executor.submit(
+                chatlimiter.limit(messages=messages, max_tokens=max_tokens).__enter__
+            )
+            for _ in range(5)
+        ]
+        try:
+            for future in futures:
+                future.result(timeout=2)
+        except TimeoutError:
+            pytest.fail("The requests should have been completed.")
+    if not chatlimiter.is_locked(messages=messages, max_tokens=max_tokens):
+        pytest.fail("The request should have timed out.")
+    time.sleep(6)
+    if chatlimiter.is_locked(messages=messages, max_tokens=max_tokens):
+        pytest.fail("The lock should have expired.")
+
+
+def test_shared_memory(tmp_path):
+    max_tokens = 200
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+        shared_memory=SharedMemoryStore(str(tmp_path / "ratelimiter.shm")),
+    )
+    chatlimiter.clear_locks()
+    for _ in range(5):
+        with chatlimiter.limit(messages=messages, max_tokens=max_tokens):
+            pass
+    # Another process opening the same file sees the same budget.
+    other = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,
+        shared_memory=SharedMemoryStore(str(tmp_path / "ratelimiter.shm")),
+    )
+    assert other.is_locked(messages=messages, max_tokens=max_tokens)
+    assert other.clear_locks()
+    assert not chatlimiter.is_locked(messages=messages, max_tokens=max_tokens)
+    # Clearing a model leaves the models whose names start like it alone, and
+    # clears the tenants whose names hold ":". Long names are hashed to fit a slot.
+    store = SharedMemoryStore(str(tmp_path / "names.shm"), slots=8)
+    tenant = "team:" + "a" * 40
+    limiters = [
+        DalleLimiter(
+            model_name=name, IPM=2, tenants=[Tenant(tenant)], shared_memory=store
+        )
+        for name in ("ft", "ft:gpt-3.5-turbo:org", "ft:" + "b" * 60)
+    ]
+    for dallelimiter in limiters:
+        dallelimiter.clear_locks()
+        for _ in range(2):
+            assert dallelimiter.limit(tenant=tenant).try_acquire() == 0
+        assert dallelimiter.limit(tenant=tenant).try_acquire() > 0
+    assert limiters[0].clear_locks()
+    assert limiters[0].limit(tenant=tenant).try_acquire() == 0
+    assert limiters[1].is_locked()
+    assert limiters[2].is_locked()
+    # The in-flight slot of a process that died is freed while traffic goes on.
+    dallelimiter = DalleLimiter(
+        model_name="dall-e-3",
+        IPM=100,
+        max_in_flight=1,
+        shared_memory=SharedMemoryStore(str(tmp_path / "in_flight.shm")),
+    )
+    dallelimiter.clear_locks()
+    pid = os.fork()
+    if pid == 0:
+        dallelimiter.limit().__enter__()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    for _ in range(3):
+        with dallelimiter.limit(timeout=1):
+            assert dallelimiter.is_locked()
+    assert not dallelimiter.is_locked()
+
+
+def test_limit_many():
+    max_tokens = 200
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,  # 1_125 = 225 * 5
+    )
+    chatlimiter.clear_locks()
+    chatlimiter.period = 5
+    requests = [{"messages": messages, "max_tokens": max_tokens}] * 8
+    admitted, wait = chatlimiter.limit_many(requests)
+    assert len(admitted) == 5
+    assert 0 < wait <= 5
+    for limiter in admitted:
+        limiter.record_usage(25)
+        limiter.release()
+    admitted, wait = chatlimiter.limit_many(requests[5:])
+    assert len(admitted) == 3
+    assert wait == 0
+    # A thread at the head of the queue that was not woken yet still holds the
+    # batch back, although the budget has room for it.
+    state = admitted[0].state
+    with state.lock:
+        head = chatlimiter.limit(messages=messages, max_tokens=max_tokens)
+        state.enqueue((head, threading.Condition(state.lock)))
+    admitted, wait = chatlimiter.limit_many(requests)
+    assert admitted == []
+    assert wait > 0
+    state.waiters.clear()
+
+
+def test_encoders(monkeypatch):
+    loads = []
+    encoding_for_model = tiktoken.encoding_for_model
+
+    def load(name):
+        loads.append(name)
+        return encoding_for_model(name)
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", load)
+    monkeypatch.setattr(tokens, "_encoders", {})
+    # Nothing is loaded or contacted until the encoder is first used.
+    chatlimiters = [
+        ChatCompletionLimiter(
+            model_name=model_name,
+            RPM=3_000,
+            TPM=1_125,
+            redis_instance=redis.Redis(host="localhost", port=6379),
+            check_connection=False,
+        )
+        for _ in range(2)
+    ]
+    assert loads == []
+    # The limiters of a model share one encoder, loaded once.
+    assert chatlimiters[0].encoder is not None
+    assert chatlimiters[1].encoder is chatlimiters[0].encoder
+    assert loads == [model_name]
+    thread = prewarm_encoders([model_name, "gpt-4"])
+    assert thread is not None
+    thread.join()
+    assert loads == [model_name, "gpt-4"]
+    assert tokens.get_encoder("gpt-4") is tokens.get_encoder("gpt-4")
+    assert loads == [model_name, "gpt-4"]
+
+
+def test_token_counts():
+    encoder = get_encoder(model_name)
+    assert encoder is not None
+    # The messages and the reply priming, then the reply itself.
+    expected = 4 * len(messages) + 2 + 15
+    for message in messages:
+        expected += sum(len(encoder.encode(value)) for value in message.values())
+    assert (
+        num_tokens_consumed_by_chat_request(messages, encoder, cache=None) == expected
+    )
+    # A list of prompts counts as that many requests.
+    prompts = [f"Prompt number {i} of the list." for i in range(20)]
+    assert num_tokens_consumed_by_completion_request(
+        prompts, encoder, max_tokens=10, cache=None
+    ) == sum(
+        num_tokens_consumed_by_completion_request(
+            prompt, encoder, max_tokens=10, cache=None
+        )
+        for prompt in prompts
+    )
+    # Counting the messages of many requests as one batch changes nothing.
+    requests = [
+        {
+            "messages": [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "name": "user", "content": f"What is {i} + {i}?"},
+            ],
+            "max_tokens": i,
+        }
+        for i in range(20)
+    ]
+    assert num_tokens_consumed_by_chat_requests(requests, encoder, cache=None) == [
+        num_tokens_consumed_by_chat_request(
+            request["messages"], encoder, request["max_tokens"], cache=None
+        )
+        for request in requests
+    ]
+
+
+def test_token_cache():
+    encoder = get_encoder(model_name)
+    assert encoder is not None
+    cache = TokenCountCache(max_bytes=3 * 256)
+    for text in ("one", "two", "three"):
+        cache.count(text, encoder)
+    assert cache.count("one", encoder) == len(encoder.encode("one"))
+    # The least recently used count is evicted to stay within the bound.
+    cache.count("four", encoder)
+    assert cache.stats() == {"hits": 1, "misses": 4, "entries": 3, "size": 768}
+    cache.count_many(["one", "two", "four"], encoder)
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 5
+    assert cache.size <= cache.max_bytes
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "entries": 0, "size": 0}
+
+
+def test_usage():
+    max_tokens = 200
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,
+    )
+    chatlimiter.clear_locks()
+    chatlimiter.period = 5
+    assert chatlimiter.usage().calls == 0
+    with chatlimiter.limit(messages=messages, max_tokens=max_tokens) as limiter:
+        pass
+    usage = chatlimiter.usage()
+    assert usage.calls == 1
+    assert usage.tokens == limiter.tokens
+    assert usage.remaining_tokens == 1_125 - limiter.tokens
+    assert 0 < usage.reset <= 5
+    with chatlimiter.limit(messages=messages, max_tokens=max_tokens):
+        pass
+    # A recent snapshot is reused.
+    assert chatlimiter.usage(max_age=60).calls == 1
+
+
+def test_update_from_headers():
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,
+    )
+    chatlimiter.clear_locks()
+    # Another service sharing the organization used most of the budget.
+    chatlimiter.update_from_headers(
+        {
+            "x-ratelimit-remaining-requests": "2999",
+            "x-ratelimit-remaining-tokens": "125",
+            "x-ratelimit-reset-requests": "20ms",
+            "x-ratelimit-reset-tokens": "1m0s",
+        }
+    )
+    assert chatlimiter.usage().tokens == 1_000
+    assert chatlimiter.is_locked(messages=messages, max_tokens=200)
+    # Without a reset the usage fills the current window.
+    chatlimiter.update_from_headers({"x-ratelimit-remaining-tokens": "125"})
+    assert chatlimiter.is_locked(messages=messages, max_tokens=200)
+    chatlimiter.update_from_headers({"x-ratelimit-remaining-tokens": "1125"})
+    assert not chatlimiter.is_locked(messages=messages, max_tokens=200)
+    chatlimiter.update_from_headers({"retry-after": "1"})
+    assert chatlimiter.is_locked(messages=messages, max_tokens=200)
+    time.sleep(1.5)
+    assert not chatlimiter.is_locked(messages=messages, max_tokens=200)
+    for algorithm in ("fixed", "sliding"):
+        chatlimiter = ChatCompletionLimiter(
+            model_name=model_name,
+            RPM=3_000,
+            TPM=1_125,
+            redis_instance=redis.Redis(host="localhost", port=6379),
+            algorithm=algorithm,
+        )
+        chatlimiter.clear_locks()
+        chatlimiter.update_from_headers({"x-ratelimit-remaining-tokens": "125"})
+        assert chatlimiter.usage().tokens == 1_000
+        assert chatlimiter.is_locked(messages=messages, max_tokens=200)
+
+
+def test_client():
+    class Completions:
+        def create(self, **kwargs):
+            if kwargs.get("stream"):
+                return iter(
+                    types.SimpleNamespace(
+                        choices=[
+                            types.SimpleNamespace(
+                                delta=types.SimpleNamespace(content=word)
+                            )
+                        ]
+                    )
+                    for word in ["Rabat", "."]
+                )
+            return types.SimpleNamespace(
+                usage={"prompt_tokens": 25, "completion_tokens": 5}
+            )
+
+    chatlimiter = ChatCompletionLimiter(
+        model_name=model_name,
+        RPM=3_000,
+        TPM=1_125,
+    )
+    chatlimiter.clear_locks()
+    client = RateLimitedOpenAI(
+        [chatlimiter],
+        client=types.SimpleNamespace(
+            chat=types.SimpleNamespace(completions=Completions())
+        ),
+    )
+    client.chat.completions.create(model=model_name, messages=messages, max_tokens=200)
+    # Only the tokens of the response stay reserved.
+    assert chatlimiter.usage().tokens == 30
+    stream = client.chat.completions.create(
+        model=model_name, messages=messages, max_tokens=200, stream=True
+    )
+    assert chatlimiter.usage().tokens > 200
+    assert len(list(stream)) == 2
+    assert chatlimiter.usage().tokens < 100
+    # The images of a request are reserved together, a request that times out
+    # holds none of them.
+    dallelimiter = DalleLimiter(model_name="dall-e-2", IPM=5)
+    dallelimiter.clear_locks()
+    client = RateLimitedOpenAI(
+        [dallelimiter],
+        client=types.SimpleNamespace(
+            images=types.SimpleNamespace(generate=lambda **kwargs: kwargs["n"])
+        ),
+        wait_timeout=0.5,
+    )
+    held = dallelimiter.limit_many(2).admitted
+    with pytest.raises(RateLimitTimeout):
+        client.images.generate(model="dall-e-2", n=4)
+    assert dallelimiter.usage().calls == 2
+    assert client.images.generate(model="dall-e-2", n=3) == 3
+    assert dallelimiter.usage().calls == 5
+    for limiter in held:
+        limiter.release()